@@ -0,0 +1,362 @@
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+ENDPOINTS = ("chat_completion", "add_evaluation", "get_modellist")
+RESULTS_VERSION = 1
+
+
+@dataclass
+class Result:
+    endpoint: str
+    concurrency: int
+    requests: int
+    errors: int
+    error_kinds: Dict[str, int]
+    seconds: float
+    throughput: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    mean_ms: float
+    max_ms: float
+
+
+@dataclass
+class Regression:
+    endpoint: str
+    concurrency: int
+    metric: str
+    baseline: float
+    current: float
+    change: float
+
+
+@dataclass
+class Run:
+    meta: Dict[str, Any]
+    results: List[Result] = field(default_factory=list)
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    # nearest rank
+    if not sorted_values:
+        return 0.0
+    i = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[i]
+
+
+def load_body(name: str) -> bytes:
+    with open(os.path.join(HERE, f"req_post_{name}.json"), "rb") as f:
+        return f.read()
+
+
+def make_request(
+    endpoint: str, model: Optional[str]
+) -> Callable[[httpx.Client], httpx.Response]:
+    headers = {"Content-Type": "application/json"}
+    if endpoint == "get_modellist":
+        return lambda client: client.get("/get_modellist")
+    if endpoint == "chat_completion":
+        data = json.loads(load_body("chat_completion"))
+        if model is not None:
+            data["selected_model"] = model
+        body = json.dumps(data).encode("utf-8")
+    else:
+        body = load_body(endpoint)
+    path = "/" + endpoint
+    return lambda client: client.post(path, content=body, headers=headers)
+
+
+def measure(
+    client: httpx.Client,
+    request: Callable[[httpx.Client], httpx.Response],
+    endpoint: str,
+    concurrency: int,
+    requests: int,
+) -> Result:
+    latencies: List[float] = []
+    error_kinds: Dict[str, int] = {}
+    lock = threading.Lock()
+
+    def one(_: int) -> None:
+        start = time.perf_counter()
+        try:
+            response = request(client)
+            kind = None if response.is_success else str(response.status_code)
+        except httpx.HTTPError as e:
+            kind = e.__class__.__name__
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if kind is not None:
+                error_kinds[kind] = error_kinds.get(kind, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return Result(
+        endpoint=endpoint,
+        concurrency=concurrency,
+        requests=requests,
+        errors=sum(error_kinds.values()),
+        error_kinds=error_kinds,
+        seconds=round(seconds, 3),
+        throughput=round(requests / seconds, 2),
+        p50_ms=round(percentile(latencies, 50) * 1000, 2),
+        p95_ms=round(percentile(latencies, 95) * 1000, 2),
+        p99_ms=round(percentile(latencies, 99) * 1000, 2),
+        mean_ms=round(sum(latencies) / len(latencies) * 1000, 2),
+        max_ms=round(latencies[-1] * 1000, 2),
+    )
+
+
+def git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=HERE,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def serve() -> Tuple[str, Callable[[], None]]:
+    # the app of this tree on a free port, configured from the environment
+    # (PRE_RUNMODE=Mock, PRE_DB_URI, ...) like wsgi.py
+    from werkzeug.serving import make_server
+
+    import app
+
+    # one access log line per request would be measured too
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app.create_app(), threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return f"http://127.0.0.1:{server.server_port}", server.shutdown
+
+
+def compare(
+    baseline: Run, current: Run, threshold: float, error_tolerance: float
+) -> Tuple[List[Regression], List[str]]:
+    # higher latency, lower throughput or more errors than the baseline
+    regressions: List[Regression] = []
+    missing: List[str] = []
+    base = {(r.endpoint, r.concurrency): r for r in baseline.results}
+    for result in current.results:
+        old = base.get((result.endpoint, result.concurrency))
+        if old is None:
+            missing.append(f"{result.endpoint} c={result.concurrency}")
+            continue
+        checks = [
+            ("p50_ms", old.p50_ms, result.p50_ms, 1),
+            ("p95_ms", old.p95_ms, result.p95_ms, 1),
+            ("p99_ms", old.p99_ms, result.p99_ms, 1),
+            ("throughput", old.throughput, result.throughput, -1),
+        ]
+        for metric, before, after, sign in checks:
+            if before <= 0:
+                continue
+            change = (after - before) / before
+            if change * sign > threshold:
+                regressions.append(
+                    Regression(
+                        result.endpoint,
+                        result.concurrency,
+                        metric,
+                        before,
+                        after,
+                        round(change, 4),
+                    )
+                )
+        before_rate = old.errors / old.requests if old.requests else 0.0
+        after_rate = result.errors / result.requests if result.requests else 0.0
+        # absolute: one failed request in a short run is not a regression
+        if after_rate - before_rate > error_tolerance:
+            regressions.append(
+                Regression(
+                    result.endpoint,
+                    result.concurrency,
+                    "error_rate",
+                    round(before_rate, 4),
+                    round(after_rate, 4),
+                    round(after_rate - before_rate, 4),
+                )
+            )
+    return regressions, missing
+
+
+def load_run(path: str) -> Run:
+    with open(path) as f:
+        data = json.load(f)
+    if data.get("version") != RESULTS_VERSION:
+        raise ValueError(f"{path}: unsupported results version {data.get('version')}")
+    return Run(meta=data["meta"], results=[Result(**r) for r in data["results"]])
+
+
+def save_run(run: Run, path: str) -> None:
+    with open(path, "w") as f:
+        json.dump({"version": RESULTS_VERSION, **asdict(run)}, f, indent=2)
+        f.write("\n")
+
+
+def print_results(run: Run) -> None:
+    print(
+        f"{'endpoint':<16} {'conc':>5} {'reqs':>6} {'errors':>6} {'req/s':>9}"
+        f" {'p50_ms':>9} {'p95_ms':>9} {'p99_ms':>9} {'max_ms':>9}"
+    )
+    for r in run.results:
+        print(
+            f"{r.endpoint:<16} {r.concurrency:>5} {r.requests:>6} {r.errors:>6}"
+            f" {r.throughput:>9.1f} {r.p50_ms:>9.2f} {r.p95_ms:>9.2f}"
+            f" {r.p99_ms:>9.2f} {r.max_ms:>9.2f}"
+        )
+        if r.error_kinds:
+            print(f"{'':<16} errors: {r.error_kinds}")
+
+
+def print_comparison(
+    regressions: List[Regression], missing: List[str], threshold: float
+) -> None:
+    for name in missing:
+        print(f"not in baseline: {name}")
+    if not regressions:
+        print(f"no regressions (threshold {threshold:.0%})")
+        return
+    print(f"regressions (threshold {threshold:.0%}):")
+    for g in regressions:
+        print(
+            f"  {g.endpoint} c={g.concurrency} {g.metric}:"
+            f" {g.baseline:g} -> {g.current:g} ({g.change:+.1%})"
+        )
+
+
+def run_bench(args: argparse.Namespace) -> int:
+    endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    unknown = [e for e in endpoints if e not in ENDPOINTS]
+    if unknown:
+        print(f"unknown endpoints: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    levels = [int(c) for c in args.concurrency.split(",")]
+
+    url = args.url
+    shutdown = None
+    if url is None:
+        url, shutdown = serve()
+    run = Run(
+        meta={
+            "commit": git_commit(),
+            "label": args.label,
+            "started": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "url": args.url or "in-process",
+            "runmode": os.environ.get("PRE_RUNMODE"),
+            "db": (os.environ.get("PRE_DB_URI") or "").split(":", 1)[0],
+            "python": platform.python_version(),
+            "requests": args.requests,
+            "warmup": args.warmup,
+        }
+    )
+    try:
+        limits = httpx.Limits(
+            max_connections=max(levels), max_keepalive_connections=max(levels)
+        )
+        with httpx.Client(base_url=url, timeout=args.timeout, limits=limits) as client:
+            for endpoint in endpoints:
+                request = make_request(endpoint, args.model)
+                for concurrency in levels:
+                    if args.warmup > 0:
+                        measure(client, request, endpoint, concurrency, args.warmup)
+                    run.results.append(
+                        measure(client, request, endpoint, concurrency, args.requests)
+                    )
+    finally:
+        if shutdown is not None:
+            shutdown()
+
+    print_results(run)
+    if args.output is not None:
+        save_run(run, args.output)
+        print(f"results written to {args.output}")
+    if args.compare is not None:
+        regressions, missing = compare(
+            load_run(args.compare), run, args.threshold, args.error_tolerance
+        )
+        print_comparison(regressions, missing, args.threshold)
+        if regressions:
+            return 1
+    return 0
+
+
+def run_compare(args: argparse.Namespace) -> int:
+    current = load_run(args.current)
+    regressions, missing = compare(
+        load_run(args.baseline), current, args.threshold, args.error_tolerance
+    )
+    print_results(current)
+    print_comparison(regressions, missing, args.threshold)
+    return 1 if regressions else 0
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(
+        description="Load-test the backend endpoints and compare runs."
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = sub.add_parser("run", help="run the benchmark")
+    run_parser.add_argument(
+        "--url", help="a running backend; by default the app is served in-process"
+    )
+    run_parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    run_parser.add_argument(
+        "--concurrency", default="1,8,32", help="comma separated levels"
+    )
+    run_parser.add_argument(
+        "-n", "--requests", type=int, default=200, help="per endpoint and level"
+    )
+    run_parser.add_argument("--warmup", type=int, default=20)
+    run_parser.add_argument("--timeout", type=float, default=60.0)
+    run_parser.add_argument("--model", help="selected_model for /chat_completion")
+    run_parser.add_argument("--label", help="stored with the results")
+    run_parser.add_argument("-o", "--output", help="write the results as JSON")
+    run_parser.add_argument("--compare", help="baseline results to compare with")
+    run_parser.add_argument("--threshold", type=float, default=0.20)
+    run_parser.add_argument("--error-tolerance", type=float, default=0.01)
+    run_parser.set_defaults(func=run_bench)
+
+    compare_parser = sub.add_parser("compare", help="compare two results files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.20)
+    compare_parser.add_argument("--error-tolerance", type=float, default=0.01)
+    compare_parser.set_defaults(func=run_compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,92 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import timeit
+from dataclasses import asdict
+from typing import Any, Callable, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pre_add_evaluation  # noqa: E402
+import pre_chat_completion  # noqa: E402
+import pre_payload  # noqa: E402
+from pre_payload import Schema  # noqa: E402
+
+# apitest/req_post_<endpoint>.json -> the schema of that endpoint
+SCHEMAS: Dict[str, Schema] = {
+    "chat_completion": pre_chat_completion.REQUEST_SCHEMA,
+    "add_evaluation": pre_add_evaluation.REQUEST_SCHEMA,
+}
+
+RESPONSE = pre_chat_completion.ResponseData(
+    finish_reason="stop",
+    content="Type annotation in Python is a way to specify the data types. " * 20,
+    completion_tokens=60,
+    prompt_tokens=26,
+    qa_id="20240101_120000_000_0123456789ABCDEF_A123",
+    lines=3,
+    prompt_class="test-case-005",
+    temperature=0.2,
+)
+
+
+def legacy_load(schema: Schema, body: bytes) -> Any:
+    # json.loads and one key at a time, as app.py did before pre_payload
+    data = json.loads(body)
+    return schema.cls(
+        **{spec.name: data[spec.name] for spec in schema.fields if spec.name in data}
+    )
+
+
+def legacy_dumps(obj: Any) -> bytes:
+    # what Flask's default provider does with a dataclass
+    return json.dumps(asdict(obj), sort_keys=True, separators=(",", ":")).encode()
+
+
+def measure(func: Callable[[], Any], number: int) -> float:
+    best = min(timeit.repeat(func, number=number, repeat=5))
+    return best / number * 1e6
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(
+        description="Time request parsing/validation and response encoding."
+    )
+    parser.add_argument("-n", "--number", type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    print(f"encoder: {'orjson' if pre_payload.orjson is not None else 'json'}")
+    rows: List[Tuple[str, float, float]] = []
+    for path in sorted(glob.glob(os.path.join(here, "req_post_*.json"))):
+        name = os.path.basename(path)[len("req_post_") : -len(".json")]
+        schema = SCHEMAS.get(name)
+        if schema is None:
+            continue
+        with open(path, "rb") as f:
+            body = f.read()
+        rows.append(
+            (
+                f"load {name}",
+                measure(lambda: legacy_load(schema, body), args.number),
+                measure(lambda: schema.load(pre_payload.parse_json(body)), args.number),
+            )
+        )
+    rows.append(
+        (
+            "dump chat_completion response",
+            measure(lambda: legacy_dumps(RESPONSE), args.number),
+            measure(lambda: pre_payload.dumps(RESPONSE), args.number),
+        )
+    )
+
+    print(f"{'case':<32} {'before_us':>10} {'after_us':>10} {'speedup':>8}")
+    for case, before, after in rows:
+        print(f"{case:<32} {before:>10.2f} {after:>10.2f} {before / after:>7.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
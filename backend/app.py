@@ -1,30 +1,140 @@
-import json
-import os
+import atexit
 import traceback
+from typing import Optional
 
-from dotenv import load_dotenv
-from flask import Flask, Response, jsonify, make_response, request
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    current_app,
+    g,
+    jsonify,
+    make_response,
+    request,
+    stream_with_context,
+)
 from flask_cors import CORS
-from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import BadRequest, HTTPException
 
 import pre_add_evaluation
 import pre_chat_completion
+import pre_completion_cache
+import pre_conversation
+import pre_evaluation_writer
+import pre_export
+import pre_fanout
+import pre_get_evaluations
+import pre_get_health
 import pre_get_modellist
+import pre_get_qa_log
+import pre_lifecycle
+import pre_llm_client
 import pre_logger
-from pre_response_errordata import ResponseErrorData
+import pre_metrics
+import pre_model
+import pre_openai_mock
+import pre_payload
+import pre_qa_log
+import pre_router
+import pre_settings
+import pre_tokens
+from pre_response_errordata import ResponseErrorData, ResponseFieldErrorData
 
-app = Flask(__name__)
-CORS(app)
+DRAINING_RETRY_AFTER = 1
 
-load_dotenv()
+bp = Blueprint("pre", __name__)
 
-log_dir = os.environ.get("PRE_LOG_DIR")
-if log_dir is None:
-    raise Exception("PRE_LOG_DIR not defined")
-app.logger = pre_logger.pre_logger(module_name=__name__, log_dir=log_dir)
 
+def create_app(settings: Optional[pre_settings.Settings] = None) -> Flask:
+    app = Flask(__name__)
+    pre_payload.install(app)
+    CORS(app)
 
-@app.errorhandler(Exception)
+    if settings is None:
+        settings = pre_settings.load_settings()
+    app.logger = pre_logger.pre_logger(
+        module_name=__name__, log_dir=settings.log_dir, level=settings.log_level
+    )
+
+    pre_settings.on_reload("llm_clients", pre_llm_client.drop_clients)
+    pre_settings.on_reload("mock_cache", pre_openai_mock.clear_cache)
+    pre_settings.on_reload(
+        "log_level", lambda s: pre_logger.set_level(app.logger, s.log_level)
+    )
+    pre_settings.on_reload(
+        "metrics", lambda s: pre_metrics.set_sample_rate(s.metrics_sample_rate)
+    )
+    pre_settings.on_reload("qa_log", lambda s: pre_qa_log.replace_sink(s, app.logger))
+    pre_settings.on_reload(
+        "evaluation_writer",
+        lambda s: pre_evaluation_writer.replace_writer(s, app.logger),
+    )
+    pre_settings.on_reload("done", lambda s: app.logger.info("settings reloaded"))
+    pre_settings.install_reload_signal(
+        lambda e: app.logger.error("settings reload failed, keeping current: %s", e)
+    )
+
+    pre_metrics.set_sample_rate(settings.metrics_sample_rate)
+
+    for shutdown in (pre_evaluation_writer.shutdown_writer, pre_qa_log.shutdown_sink):
+        # once, however often create_app is called
+        atexit.unregister(shutdown)
+        atexit.register(shutdown)
+
+    app.register_blueprint(bp)
+
+    with app.app_context():
+        try:
+            pre_get_health.check_on_startup(settings)
+        except Exception as e:
+            app.logger.warning("startup table check failed: %s", e)
+    try:
+        models = pre_model.get_pre_model(settings.def_model).get_list()
+        estimated = pre_tokens.estimated_limits(models)
+        if estimated:
+            app.logger.warning(
+                "tiktoken or its encoding is not available: prompt tokens of %s"
+                " are estimated from the text length (see TIKTOKEN_CACHE_DIR)",
+                ", ".join(estimated),
+            )
+    except Exception as e:
+        app.logger.warning("startup model check failed: %s", e)
+    return app
+
+
+@bp.before_app_request
+def before_request() -> None:
+    pre_lifecycle.request_started()
+    g.pre_lifecycle_started = True
+    pre_metrics.before_request()
+
+
+@bp.after_app_request
+def after_request(response: Response) -> Response:
+    # for streamed responses this is when the headers are sent
+    pre_metrics.after_request(response.status_code)
+    return response
+
+
+@bp.teardown_app_request
+def teardown_request(e: Optional[BaseException]) -> None:
+    # a streamed response keeps its context until the last chunk is sent
+    pre_metrics.teardown_request()
+    if g.pop("pre_lifecycle_started", False):
+        pre_lifecycle.request_finished()
+
+
+@bp.app_errorhandler(pre_payload.PayloadError)
+def handle_payload_error(e: pre_payload.PayloadError) -> Response:
+    # rejected before any database or LLM work
+    error_response = ResponseFieldErrorData(
+        error=e.__class__.__name__, detail=str(e), fields=e.errors
+    )
+    current_app.logger.info("payload rejected: %s", e.errors)
+    return make_response(jsonify(error_response), 400)
+
+
+@bp.app_errorhandler(Exception)
 def handle_exception(e: Exception) -> Response:
     if not isinstance(e, HTTPException):
         status_code = 500
@@ -36,63 +146,333 @@ def handle_exception(e: Exception) -> Response:
 
     t = traceback.format_exception_only(type(e), e)
     error_response = ResponseErrorData(error=e.__class__.__name__, detail=t[0])
-    app.logger.error(error_response)
+    current_app.logger.error(error_response)
     response = make_response(jsonify(error_response), status_code)
     return response
 
 
-@app.route("/", methods=["GET"])
+def draining_response() -> Response:
+    error_response = ResponseErrorData(
+        error="ServiceUnavailable", detail="The server is shutting down."
+    )
+    response = make_response(jsonify(error_response), 503)
+    response.headers["Retry-After"] = str(DRAINING_RETRY_AFTER)
+    return response
+
+
+@bp.route("/", methods=["GET"])
 def get_hello() -> str:
     return "<p>Hello World!</p>"
 
 
-@app.route("/get_modellist", methods=["GET"])
+@bp.route("/health", methods=["GET"])
+def get_health() -> Response:
+    refresh = request.args.get("refresh") is not None
+    response_data, status_code = pre_get_health.get_health(
+        pre_settings.get_settings(), refresh=refresh
+    )
+    return make_response(jsonify(response_data), status_code)
+
+
+@bp.route("/get_modellist", methods=["GET"])
 def get_get_modellist() -> Response:
-    app.logger.info("--- GET /get_modellist received ---")
-    response_data, status_code = pre_get_modellist.get_modellist()
-    response = make_response(jsonify(response_data), status_code)
-    app.logger.debug("jsonify(response_data)")
-    app.logger.debug(jsonify(response_data))
-    app.logger.info("--- GET /get_modellist return ---")
+    current_app.logger.info("--- GET /get_modellist received ---")
+    response_body, status_code = pre_get_modellist.get_modellist_body(
+        pre_settings.get_settings()
+    )
+    if isinstance(response_body, pre_get_modellist.ResponseErrorData):
+        return make_response(jsonify(response_body), status_code)
+
+    if request.if_none_match.contains(response_body.etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(response_body.body, status_code)
+        response.mimetype = "application/json"
+    response.set_etag(response_body.etag)
+    current_app.logger.info("--- GET /get_modellist return ---")
     return response
 
 
-@app.route("/chat_completion", methods=["POST"])
+@bp.route("/chat_completion", methods=["POST"])
 def post_chat_completion() -> Response:
-    app.logger.info("--- POST /chat_completion received ---")
-    app.logger.debug(request)
-    request_data_dict = json.loads(request.data)
-    request_data = pre_chat_completion.RequestData(
-        system_content=request_data_dict["system_content"],
-        user_content=request_data_dict["user_content"],
-        temperature=request_data_dict["temperature"],
-        prompt_class=request_data_dict["prompt_class"],
-        user_id=request_data_dict["user_id"],
-        selected_model=request_data_dict["selected_model"],
-    )
-
-    response_data, status_code = pre_chat_completion.chat_completion(request_data)
-    response = make_response(jsonify(response_data), status_code)
-    app.logger.info("--- POST /chat_evaluation return ---")
+    current_app.logger.info("--- POST /chat_completion received ---")
+    if pre_lifecycle.is_draining():
+        return draining_response()
+    current_app.logger.debug(request)
+    request_data = pre_chat_completion.REQUEST_SCHEMA.load(
+        pre_payload.parse_json(request.get_data())
+    )
+
+    response_data, status_code = pre_chat_completion.chat_completion(
+        request_data, pre_settings.get_settings()
+    )
+    response = completion_response(response_data, status_code)
+    current_app.logger.info("--- POST /chat_evaluation return ---")
+    return response
+
+
+def completion_response(response_data: object, status_code: int) -> Response:
+    # also for the async /chat_completion of asgi.py
+    with pre_metrics.stage("serialize"):
+        response = make_response(jsonify(response_data), status_code)
+    if isinstance(response_data, pre_chat_completion.ResponseRejectedData):
+        response.headers["Retry-After"] = str(response_data.retry_after)
+    return response
+
+
+@bp.route("/chat_completion_stream", methods=["POST"])
+def post_chat_completion_stream() -> Response:
+    current_app.logger.info("--- POST /chat_completion_stream received ---")
+    if pre_lifecycle.is_draining():
+        return draining_response()
+    request_data = pre_chat_completion.REQUEST_SCHEMA.load(
+        pre_payload.parse_json(request.get_data())
+    )
+
+    events, status_code = pre_chat_completion.chat_completion_stream(
+        request_data, pre_settings.get_settings()
+    )
+    if isinstance(events, pre_chat_completion.ResponseErrorData):
+        response = make_response(jsonify(events), status_code)
+        if isinstance(events, pre_chat_completion.ResponseRejectedData):
+            response.headers["Retry-After"] = str(events.retry_after)
+        return response
+    response = Response(
+        stream_with_context(events), status=status_code, mimetype="text/event-stream"
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    current_app.logger.info("--- POST /chat_completion_stream return ---")
+    return response
+
+
+@bp.route("/chat_completion_fanout", methods=["POST"])
+def post_chat_completion_fanout() -> Response:
+    current_app.logger.info("--- POST /chat_completion_fanout received ---")
+    if pre_lifecycle.is_draining():
+        return draining_response()
+    request_data = pre_fanout.REQUEST_SCHEMA.load(
+        pre_payload.parse_json(request.get_data())
+    )
+
+    fanout, status_code = pre_fanout.chat_completion_fanout(
+        request_data, pre_settings.get_settings()
+    )
+    if isinstance(fanout, pre_fanout.ResponseErrorData):
+        return make_response(jsonify(fanout), status_code)
+    response = Response(
+        stream_with_context(fanout.lines),
+        status=status_code,
+        mimetype="application/x-ndjson",
+    )
+    response.headers["X-Fanout-ID"] = fanout.fanout_id
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    current_app.logger.info("--- POST /chat_completion_fanout return ---")
     return response
 
 
-@app.route("/add_evaluation", methods=["POST"])
+@bp.route("/conversations", methods=["POST"])
+def post_conversations() -> Response:
+    request_data = pre_conversation.CREATE_REQUEST_SCHEMA.load(
+        pre_payload.parse_json(request.get_data())
+    )
+    response_data, status_code = pre_conversation.create_conversation(
+        request_data, pre_settings.get_settings()
+    )
+    return make_response(jsonify(response_data), status_code)
+
+
+@bp.route("/conversations/<conversation_id>", methods=["POST"])
+def post_conversation_turn(conversation_id: str) -> Response:
+    current_app.logger.info("--- POST /conversations/<id> received ---")
+    if pre_lifecycle.is_draining():
+        return draining_response()
+    turn = pre_conversation.TURN_REQUEST_SCHEMA.load(
+        pre_payload.parse_json(request.get_data())
+    )
+
+    response_data, status_code = pre_conversation.conversation_turn(
+        conversation_id, turn, pre_settings.get_settings()
+    )
+    with pre_metrics.stage("serialize"):
+        response = make_response(jsonify(response_data), status_code)
+    if isinstance(response_data, pre_chat_completion.ResponseRejectedData):
+        response.headers["Retry-After"] = str(response_data.retry_after)
+    current_app.logger.info("--- POST /conversations/<id> return ---")
+    return response
+
+
+@bp.route("/conversations/<conversation_id>", methods=["GET"])
+def get_conversation(conversation_id: str) -> Response:
+    response_data, status_code = pre_conversation.get_conversation(
+        conversation_id, pre_settings.get_settings()
+    )
+    return make_response(jsonify(response_data), status_code)
+
+
+@bp.route("/conversations/<conversation_id>", methods=["DELETE"])
+def delete_conversation(conversation_id: str) -> Response:
+    response_data, status_code = pre_conversation.delete_conversation(
+        conversation_id, pre_settings.get_settings()
+    )
+    return make_response(jsonify(response_data), status_code)
+
+
+@bp.route("/log_level", methods=["GET", "PUT"])
+def log_level() -> Response:
+    if request.method == "PUT":
+        body = pre_payload.parse_json(request.get_data())
+        if not isinstance(body, dict):
+            raise pre_payload.PayloadError({"body": "must be a JSON object"})
+        level = str(body.get("level", "")).upper()
+        try:
+            pre_logger.set_level(current_app.logger, level)
+        except ValueError as e:
+            raise pre_payload.PayloadError({"level": str(e)})
+        current_app.logger.info("log level set to %s", level)
+    return make_response(
+        jsonify({"level": pre_logger.get_level(current_app.logger)}), 200
+    )
+
+
+@bp.route("/metrics", methods=["GET"])
+def get_metrics() -> Response:
+    response = make_response(pre_metrics.render(), 200)
+    response.mimetype = "text/plain"
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
+
+
+@bp.route("/cache/stats", methods=["GET"])
+def get_cache_stats() -> Response:
+    return make_response(jsonify(pre_completion_cache.get_stats()), 200)
+
+
+@bp.route("/router/stats", methods=["GET"])
+def get_router_stats() -> Response:
+    return make_response(jsonify({"groups": pre_router.get_stats()}), 200)
+
+
+@bp.route("/qa_log/search", methods=["GET"])
+def get_qa_log_search() -> Response:
+    response_data, status_code = pre_get_qa_log.search_qa_logs(
+        pre_settings.get_settings(),
+        text=request.args.get("q"),
+        user_id=request.args.get("user_id"),
+        prompt_class=request.args.get("prompt_class"),
+        model=request.args.get("model"),
+        before=request.args.get("before"),
+        limit=request.args.get("limit", 50, type=int),
+    )
+    return make_response(jsonify(response_data), status_code)
+
+
+@bp.route("/qa_log/<qa_id>", methods=["GET"])
+def get_qa_log(qa_id: str) -> Response:
+    response_data, status_code = pre_get_qa_log.get_qa_log(
+        pre_settings.get_settings(), qa_id
+    )
+    return make_response(jsonify(response_data), status_code)
+
+
+@bp.route("/add_evaluation", methods=["POST"])
 def post_add_evaluation() -> Response:
-    app.logger.info("--- POST /add_evaluation received ---")
-    request_data_dict = json.loads(request.data)
-    request_data = pre_add_evaluation.RequestData(
-        qa_id=request_data_dict["qa_id"],
-        lines=request_data_dict["lines"],
-        prompt_class=request_data_dict["prompt_class"],
-        temperature=request_data_dict["temperature"],
-        completion_tokens=request_data_dict["completion_tokens"],
-        prompt_tokens=request_data_dict["prompt_tokens"],
-        rating=request_data_dict["rating"],
-        comment=request_data_dict["comment"],
-    )
-
-    response_data, status_code = pre_add_evaluation.add_evaluation(request_data)
+    current_app.logger.info("--- POST /add_evaluation received ---")
+    request_data = pre_add_evaluation.REQUEST_SCHEMA.load(
+        pre_payload.parse_json(request.get_data())
+    )
+
+    response_data, status_code = pre_add_evaluation.add_evaluation(
+        request_data, pre_settings.get_settings()
+    )
+    response = make_response(jsonify(response_data), status_code)
+    current_app.logger.info("--- POST /add_evaluation return ---")
+    return response
+
+
+@bp.route("/evaluations/summary", methods=["GET"])
+def get_evaluation_summary() -> Response:
+    response_data, status_code = pre_get_evaluations.get_evaluation_summary(
+        pre_settings.get_settings(),
+        prompt_class=request.args.get("prompt_class"),
+        model=request.args.get("model"),
+        source=request.args.get("source", "rollup"),
+        percentiles=request.args.get("percentiles") is not None,
+    )
+    return make_response(jsonify(response_data), status_code)
+
+
+@bp.route("/evaluations", methods=["GET"])
+def get_evaluations() -> Response:
+    after_id = request.args.get("after_id", 0, type=int)
+    limit = request.args.get("limit", 100, type=int)
+    response_data, status_code = pre_get_evaluations.get_evaluations(
+        pre_settings.get_settings(),
+        prompt_class=request.args.get("prompt_class"),
+        model=request.args.get("model"),
+        after_id=after_id,
+        limit=limit,
+    )
+    return make_response(jsonify(response_data), status_code)
+
+
+@bp.route("/export", methods=["GET"])
+def get_export() -> Response:
+    export_format = request.args.get("format", "parquet")
+    if export_format not in pre_export.EXPORT_FORMATS:
+        raise BadRequest(
+            f"format must be one of {', '.join(pre_export.EXPORT_FORMATS)}"
+        )
+    chunk_rows = request.args.get("chunk_rows", pre_export.CHUNK_ROWS, type=int)
+    if not 1 <= chunk_rows <= pre_export.CHUNK_ROWS_MAX:
+        raise BadRequest(
+            f"chunk_rows must be between 1 and {pre_export.CHUNK_ROWS_MAX}"
+        )
+    gaps = request.args.get("since_evaluation_gaps", "")
+    try:
+        evaluation_gaps = [int(gap) for gap in gaps.split(",") if gap]
+    except ValueError:
+        raise BadRequest("since_evaluation_gaps must be comma-separated integers")
+    since = pre_export.Watermark(
+        qa_id=request.args.get("since_qa_id", ""),
+        evaluation_id=request.args.get("since_evaluation_id", 0, type=int),
+        evaluation_gaps=evaluation_gaps[-pre_export.EVALUATION_GAPS_MAX :],
+    )
+
+    export, status_code = pre_export.export_stream(
+        pre_settings.get_settings(), export_format, since, chunk_rows
+    )
+    if isinstance(export, pre_export.ResponseErrorData):
+        return make_response(jsonify(export), status_code)
+    response = Response(
+        stream_with_context(export.chunks),
+        status=status_code,
+        mimetype="application/octet-stream",
+    )
+    response.headers["Content-Disposition"] = (
+        "attachment; filename=qa_export" + pre_export.EXPORT_EXTENSIONS[export_format]
+    )
+    # where the next incremental export starts
+    response.headers["X-Export-Until-QA-ID"] = export.until.qa_id
+    response.headers["X-Export-Until-Evaluation-ID"] = str(export.until.evaluation_id)
+    response.headers["X-Export-Until-Evaluation-Gaps"] = ",".join(
+        str(gap) for gap in export.until.evaluation_gaps
+    )
+    return response
+
+
+@bp.route("/add_evaluations", methods=["POST"])
+def post_add_evaluations() -> Response:
+    current_app.logger.info("--- POST /add_evaluations received ---")
+    request_data = pre_add_evaluation.REQUEST_SCHEMA.load_list(
+        pre_payload.parse_json(request.get_data()),
+        max_items=pre_add_evaluation.MAX_EVALUATIONS,
+    )
+
+    response_data, status_code = pre_add_evaluation.add_evaluations(
+        request_data, pre_settings.get_settings()
+    )
     response = make_response(jsonify(response_data), status_code)
-    app.logger.info("--- POST /add_evaluation return ---")
+    current_app.logger.info("--- POST /add_evaluations return ---")
     return response
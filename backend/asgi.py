@@ -0,0 +1,103 @@
+import io
+import os
+from typing import Any, Awaitable, Callable, cast
+
+from a2wsgi import WSGIMiddleware
+from a2wsgi.asgi_typing import HTTPScope, Receive, Scope, Send
+from a2wsgi.wsgi import build_environ
+from flask import Response, current_app, request
+
+import pre_chat_completion
+import pre_lifecycle
+import pre_payload
+import pre_settings
+from app import completion_response, create_app, draining_response
+
+# uvicorn asgi:app, or gunicorn -c gunicorn.conf.py asgi:app with
+# PRE_GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker
+
+# the other routes run in a pool of this many threads
+WSGI_THREADS = int(os.environ.get("PRE_GUNICORN_THREADS", "8"))
+
+flask_app = create_app()
+wsgi_app = WSGIMiddleware(cast(Any, flask_app), workers=WSGI_THREADS)
+
+
+async def post_chat_completion() -> Response:
+    # /chat_completion of app.py, but a request waiting for the model holds
+    # no thread: a worker keeps as many in flight as the limits allow
+    current_app.logger.info("--- POST /chat_completion received (async) ---")
+    if pre_lifecycle.is_draining():
+        return draining_response()
+    current_app.logger.debug(request)
+    request_data = pre_chat_completion.REQUEST_SCHEMA.load(
+        pre_payload.parse_json(request.get_data())
+    )
+
+    response_data, status_code = await pre_chat_completion.chat_completion_async(
+        request_data, pre_settings.get_settings()
+    )
+    response = completion_response(response_data, status_code)
+    current_app.logger.info("--- POST /chat_completion return (async) ---")
+    return response
+
+
+ASYNC_ROUTES = {("POST", "/chat_completion"): post_chat_completion}
+
+
+async def read_body(receive: Receive) -> bytes:
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            return body
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return body
+
+
+async def dispatch(
+    scope: HTTPScope,
+    receive: Receive,
+    send: Send,
+    view: Callable[[], Awaitable[Response]],
+) -> None:
+    # the request goes through the hooks and error handlers of the Flask
+    # app, as in Flask.full_dispatch_request
+    body = await read_body(receive)
+    environ = build_environ(scope, cast(Any, io.BytesIO(body)))
+    ctx = flask_app.request_context(cast(Any, environ))
+    ctx.push()
+    try:
+        try:
+            rv = flask_app.preprocess_request()
+            if rv is None:
+                rv = await view()
+            response = flask_app.finalize_request(rv)
+        except Exception as e:
+            response = flask_app.finalize_request(
+                flask_app.handle_user_exception(e), from_error_handler=True
+            )
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": [
+                    (name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in response.headers.items()
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": response.get_data()})
+    finally:
+        ctx.pop()
+
+
+async def app(scope: Scope, receive: Receive, send: Send) -> None:
+    view = None
+    if scope["type"] == "http":
+        view = ASYNC_ROUTES.get((scope["method"], scope["path"]))
+    if view is None:
+        await wsgi_app(scope, receive, send)
+        return
+    await dispatch(cast(HTTPScope, scope), receive, send, view)
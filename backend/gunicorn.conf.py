@@ -0,0 +1,57 @@
+import multiprocessing
+import os
+import signal
+
+import pre_evaluation_writer
+import pre_lifecycle
+import pre_qa_log
+import pre_settings
+
+# gunicorn -c gunicorn.conf.py wsgi:app
+bind = os.environ.get("PRE_GUNICORN_BIND", "127.0.0.1:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+# the app reads it as well: state kept in a worker's memory is not shared
+os.environ["WEB_CONCURRENCY"] = str(workers)
+# completions spend most of their time waiting for the LLM service; with
+# uvicorn.workers.UvicornWorker (and asgi:app) /chat_completion waits on an
+# event loop instead of a thread
+worker_class = os.environ.get("PRE_GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("PRE_GUNICORN_THREADS", "8"))
+# import the app once in the master; workers are forked from it
+preload_app = True
+timeout = int(os.environ.get("PRE_GUNICORN_TIMEOUT", "300"))
+graceful_timeout = int(os.environ.get("PRE_GUNICORN_GRACEFUL_TIMEOUT", "120"))
+keepalive = 5
+
+
+def post_fork(server, worker):
+    # the pre_* modules drop pools, clients and threads inherited from the
+    # master (os.register_at_fork); variables set in the environment keep
+    # precedence over .env, only SIGHUP lets .env override them
+    try:
+        pre_settings.load_settings()
+    except Exception as e:
+        server.log.error("worker %s: settings load failed: %s", worker.pid, e)
+
+
+def post_worker_init(worker):
+    handle_term = signal.getsignal(signal.SIGTERM)
+
+    def drain_and_handle_term(signum, frame):
+        pre_lifecycle.start_drain()
+        if callable(handle_term):
+            handle_term(signum, frame)
+
+    signal.signal(signal.SIGTERM, drain_and_handle_term)
+
+
+def worker_exit(server, worker):
+    pre_lifecycle.start_drain()
+    if not pre_lifecycle.wait_idle(graceful_timeout):
+        server.log.warning(
+            "worker %s: %s requests still in flight at exit",
+            worker.pid,
+            pre_lifecycle.in_flight(),
+        )
+    pre_evaluation_writer.shutdown_writer()
+    pre_qa_log.shutdown_sink()
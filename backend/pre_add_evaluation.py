@@ -1,23 +1,27 @@
-import os
 import traceback
-from dataclasses import dataclass
-from typing import Optional, Tuple, Union
+from dataclasses import asdict, dataclass
+from typing import List, Optional, Tuple, Union
 
-from dotenv import load_dotenv
 from flask import current_app
-from sqlalchemy import inspect
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
 
 from pre_evaluation import Evaluation
-from pre_get_session import get_session
+from pre_evaluation_writer import WriterQueueFullError, get_writer, is_write_behind
+from pre_metrics import stage
+from pre_payload import Schema
+from pre_get_session import get_session, remove_session
 from pre_response_errordata import ResponseErrorData
-
-
-class EnvironmentVariableNotSetError(Exception):
-    pass
-
-
-class TableNotFoundError(Exception):
-    pass
+from pre_settings import Settings
+from pre_table_registry import (
+    SchemaOutdatedError,
+    TableNotFoundError,
+    invalidate,
+    is_missing_column_error,
+    is_missing_table_error,
+    is_table_ready,
+    outdated,
+)
 
 
 @dataclass
@@ -30,6 +34,12 @@ class RequestData:
     prompt_tokens: int
     rating: float
     comment: str
+    model: str = ""
+
+
+REQUEST_SCHEMA = Schema(RequestData, bounds={"temperature": (0.0, 2.0)})
+# evaluations in one /add_evaluations request
+MAX_EVALUATIONS = 10000
 
 
 @dataclass
@@ -39,28 +49,29 @@ class ResponseData:
 
 def add_evaluation(
     request_data: RequestData,
+    settings: Settings,
 ) -> Tuple[Union[ResponseData, ResponseErrorData], int]:
+    logger = current_app.logger
+    session: Optional[Session] = None
     try:
-        logger = current_app.logger
         logger.debug("- add_evaluation called -")
         logger.debug(request_data)
 
-        load_dotenv()
-        db_uri: Optional[str] = os.environ.get("PRE_DB_URI")
-        if db_uri is None:
-            raise EnvironmentVariableNotSetError(
-                "Environment variable PRE_DB_URI is not set."
-            )
-
-        session = get_session(db_uri)
-        logger.debug(session)
+        with stage("inspect"):
+            table_ready = is_table_ready(settings, Evaluation.__tablename__)
+        if not table_ready:
+            raise TableNotFoundError("Database or table does not exist.")
 
-        if session.bind is None:
-            raise TableNotFoundError("Session bind is None.")
+        if is_write_behind(settings):
+            get_writer(settings, logger).submit([asdict(request_data)])
+            response_data = ResponseData(result="accepted")
+            logger.debug(response_data)
+            logger.debug("- add_evaluation return -")
+            return response_data, 202
 
-        inspector = inspect(session.bind)
-        if not inspector.has_table(Evaluation.__tablename__):
-            raise TableNotFoundError("Database or table does not exist.")
+        with stage("db_connect"):
+            session = get_session(settings)
+        logger.debug(session)
 
         evaluation = Evaluation(
             request_data.qa_id,
@@ -71,31 +82,118 @@ def add_evaluation(
             request_data.prompt_tokens,
             request_data.rating,
             request_data.comment,
+            request_data.model,
         )
         session.add(evaluation)
-        session.commit()
-
-        response_data: ResponseData = ResponseData(result="success")
+        try:
+            with stage("commit"):
+                session.commit()
+        except Exception as e:
+            if is_missing_column_error(e):
+                invalidate(settings.db_uri, Evaluation.__tablename__)
+                raise outdated(Evaluation.__tablename__, []) from e
+            if not is_missing_table_error(e):
+                raise
+            invalidate(settings.db_uri, Evaluation.__tablename__)
+            raise TableNotFoundError("Database or table does not exist.") from e
+
+        response_data = ResponseData(result="success")
         logger.debug(response_data)
         logger.debug("- add_evaluation return -")
         return response_data, 201
 
-    except TableNotFoundError as e:
+    except (TableNotFoundError, SchemaOutdatedError) as e:
         if session:
             session.rollback()
         logger.debug(e)
         error_response = ResponseErrorData(error=e.__class__.__name__, detail=str(e))
-        logger.debug(f"error_response: {error_response}")
+        logger.debug("error_response: %s", error_response)
+        return error_response, 500
+
+    except WriterQueueFullError as e:
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=str(e))
+        logger.error("error_response: %s", error_response)
+        return error_response, 503
+
+    except Exception as e:
+        if session:
+            session.rollback()
+        t = traceback.format_exception_only(type(e), e)
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=t[0])
+        logger.error("error_response: %s", error_response)
         return error_response, 500
 
+    finally:
+        if session:
+            remove_session()
+
+
+def add_evaluations(
+    request_data_list: List[RequestData],
+    settings: Settings,
+) -> Tuple[Union[ResponseData, ResponseErrorData], int]:
+    logger = current_app.logger
+    session: Optional[Session] = None
+    try:
+        logger.debug("- add_evaluations called -")
+        logger.debug("number of evaluations: %s", len(request_data_list))
+
+        with stage("inspect"):
+            table_ready = is_table_ready(settings, Evaluation.__tablename__)
+        if not table_ready:
+            raise TableNotFoundError("Database or table does not exist.")
+
+        rows = [asdict(request_data) for request_data in request_data_list]
+
+        if is_write_behind(settings):
+            get_writer(settings, logger).submit(rows)
+            response_data = ResponseData(result="accepted")
+            logger.debug(response_data)
+            logger.debug("- add_evaluations return -")
+            return response_data, 202
+
+        with stage("db_connect"):
+            session = get_session(settings)
+        try:
+            with stage("commit"):
+                if rows:
+                    session.execute(insert(Evaluation), rows)
+                session.commit()
+        except Exception as e:
+            if is_missing_column_error(e):
+                invalidate(settings.db_uri, Evaluation.__tablename__)
+                raise outdated(Evaluation.__tablename__, []) from e
+            if not is_missing_table_error(e):
+                raise
+            invalidate(settings.db_uri, Evaluation.__tablename__)
+            raise TableNotFoundError("Database or table does not exist.") from e
+
+        response_data = ResponseData(result="success")
+        logger.debug(response_data)
+        logger.debug("- add_evaluations return -")
+        return response_data, 201
+
+    except (TableNotFoundError, SchemaOutdatedError) as e:
+        if session:
+            session.rollback()
+        logger.debug(e)
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=str(e))
+        logger.debug("error_response: %s", error_response)
+        return error_response, 500
+
+    except WriterQueueFullError as e:
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=str(e))
+        logger.error("error_response: %s", error_response)
+        return error_response, 503
+
     except Exception as e:
         if session:
             session.rollback()
         t = traceback.format_exception_only(type(e), e)
         error_response = ResponseErrorData(error=e.__class__.__name__, detail=t[0])
-        logger.error(f"error_response: {error_response}")
+        logger.error("error_response: %s", error_response)
         return error_response, 500
 
     finally:
         if session:
-            session.close()
+            remove_session()
@@ -0,0 +1,314 @@
+import asyncio
+import email.utils
+import os
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+from openai import APIConnectionError, APIStatusError
+
+from pre_model import ModelDef
+
+T = TypeVar("T")
+
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_MAX = 8.0
+RETRY_AFTER_MAX = 60.0
+RETRY_STATUS_CODES = (408, 409, 429)
+# how often a coroutine waiting for a concurrency slot looks again
+SLOT_POLL_INTERVAL = 0.01
+
+
+class AdmissionRejectedError(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    # refills per_minute tokens per minute up to per_minute; reservations may
+    # take it below zero, and the caller waits until the debt is repaid
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        self._refill(now)
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+    def refund(self, amount: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+def share(limit: Optional[int], workers: int) -> Optional[int]:
+    # each worker process keeps its own buckets: it gets its part of the limit
+    if not limit:
+        return None
+    return max(1, limit // workers)
+
+
+class ModelLimiter:
+    def __init__(self, model_def: ModelDef, workers: int = 1):
+        self.name = model_def.name
+        self.max_queue = model_def.max_queue
+        self.queue_timeout = model_def.queue_timeout
+        rpm = share(model_def.rpm, workers)
+        tpm = share(model_def.tpm, workers)
+        max_concurrency = share(model_def.max_concurrency, workers)
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.slots = (
+            threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        )
+        self.waiting = 0
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self, estimated_tokens: int) -> float:
+        now = time.monotonic()
+        wait = max(0.0, self.blocked_until - now)
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(estimated_tokens, now))
+        return wait
+
+    def _refund(self, estimated_tokens: int) -> None:
+        if self.requests is not None:
+            self.requests.refund(1)
+        if self.tokens is not None:
+            self.tokens.refund(estimated_tokens)
+
+    def _admit(self, estimated_tokens: int) -> float:
+        # the seconds to wait before the call; the caller is counted as
+        # waiting until it is done
+        with self._lock:
+            wait = self._reserve(estimated_tokens)
+            if wait > 0 or self.slots is not None:
+                if self.waiting >= self.max_queue:
+                    self._refund(estimated_tokens)
+                    raise AdmissionRejectedError(
+                        f"{self.name}: too many requests waiting", max(wait, 1.0)
+                    )
+                if wait > self.queue_timeout:
+                    self._refund(estimated_tokens)
+                    raise AdmissionRejectedError(
+                        f"{self.name}: rate limit exceeded", wait
+                    )
+            self.waiting += 1
+            return wait
+
+    def _done_waiting(self) -> None:
+        with self._lock:
+            self.waiting -= 1
+
+    def _no_slot(self, estimated_tokens: int) -> AdmissionRejectedError:
+        self.refund(estimated_tokens)
+        return AdmissionRejectedError(f"{self.name}: too many requests in flight", 1.0)
+
+    def acquire(self, estimated_tokens: int) -> None:
+        deadline = time.monotonic() + self.queue_timeout
+        wait = self._admit(estimated_tokens)
+        try:
+            if wait > 0:
+                time.sleep(wait)
+            if self.slots is not None:
+                timeout = max(0.0, deadline - time.monotonic())
+                if not self.slots.acquire(timeout=timeout):
+                    raise self._no_slot(estimated_tokens)
+        finally:
+            self._done_waiting()
+
+    async def acquire_async(self, estimated_tokens: int) -> None:
+        # the same budget as acquire(), without holding a thread while waiting
+        deadline = time.monotonic() + self.queue_timeout
+        wait = self._admit(estimated_tokens)
+        try:
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if self.slots is not None:
+                while not self.slots.acquire(blocking=False):
+                    if time.monotonic() >= deadline:
+                        raise self._no_slot(estimated_tokens)
+                    await asyncio.sleep(SLOT_POLL_INTERVAL)
+        finally:
+            self._done_waiting()
+
+    def reserve(self, estimated_tokens: int) -> float:
+        # another attempt of an admitted request: its slot is already held
+        with self._lock:
+            return self._reserve(estimated_tokens)
+
+    def refund(self, estimated_tokens: int) -> None:
+        with self._lock:
+            self._refund(estimated_tokens)
+
+    def release(self) -> None:
+        if self.slots is not None:
+            self.slots.release()
+
+    def settle(self, estimated_tokens: int, actual_tokens: int) -> None:
+        # charge the difference once the real usage is known
+        if self.tokens is None:
+            return
+        with self._lock:
+            self.tokens.reserve(actual_tokens - estimated_tokens, time.monotonic())
+
+    def block(self, seconds: float) -> None:
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+LimiterKey = Tuple[str, Optional[int], Optional[int], Optional[int], int, float, int]
+
+_lock = threading.Lock()
+_limiters: Dict[LimiterKey, ModelLimiter] = {}
+
+
+def limiter_key(model_def: ModelDef, workers: int) -> LimiterKey:
+    return (
+        model_def.name,
+        model_def.rpm,
+        model_def.tpm,
+        model_def.max_concurrency,
+        model_def.max_queue,
+        model_def.queue_timeout,
+        workers,
+    )
+
+
+def get_limiter(model_def: ModelDef, workers: int = 1) -> ModelLimiter:
+    key = limiter_key(model_def, workers)
+    limiter = _limiters.get(key)
+    if limiter is not None:
+        return limiter
+    with _lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = ModelLimiter(model_def, workers)
+            _limiters[key] = limiter
+        return limiter
+
+
+def retry_after_from_error(e: Exception) -> Optional[float]:
+    if not isinstance(e, APIStatusError):
+        return None
+    headers = e.response.headers
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_date.timestamp() - time.time())
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, APIConnectionError):
+        return True
+    if isinstance(e, APIStatusError):
+        return e.status_code in RETRY_STATUS_CODES or e.status_code >= 500
+    return False
+
+
+def retry_delay(
+    limiter: ModelLimiter,
+    e: Exception,
+    attempt: int,
+    max_retries: int,
+    estimated_tokens: int,
+) -> Optional[float]:
+    # the seconds before the next attempt, or None to give up
+    if not is_retryable(e):
+        return None
+    retry_after = retry_after_from_error(e)
+    if retry_after is not None:
+        # the upstream said to back off: hold back everyone, not just us
+        limiter.block(min(retry_after, RETRY_AFTER_MAX))
+    if attempt >= max_retries or (retry_after or 0) > RETRY_AFTER_MAX:
+        return None
+    # full jitter, but never sooner than the upstream asked for
+    delay = random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2**attempt))
+    delay = max(delay, retry_after or 0)
+    # the retry counts against rpm and tpm like the first attempt
+    wait = limiter.reserve(estimated_tokens)
+    if wait > limiter.queue_timeout:
+        limiter.refund(estimated_tokens)
+        return None
+    return max(delay, wait)
+
+
+def call_with_retries(
+    model_def: ModelDef,
+    limiter: ModelLimiter,
+    call: Callable[[], T],
+    on_error: Callable[[Exception], None],
+    estimated_tokens: int,
+    max_retries: Optional[int] = None,
+) -> T:
+    if max_retries is None:
+        max_retries = model_def.max_retries
+    attempt = 0
+    while True:
+        try:
+            return call()
+        except Exception as e:
+            on_error(e)
+            delay = retry_delay(limiter, e, attempt, max_retries, estimated_tokens)
+            if delay is None:
+                raise
+            attempt += 1
+            time.sleep(delay)
+
+
+async def call_with_retries_async(
+    model_def: ModelDef,
+    limiter: ModelLimiter,
+    call: Callable[[], Awaitable[T]],
+    on_error: Callable[[Exception], None],
+    estimated_tokens: int,
+    max_retries: Optional[int] = None,
+) -> T:
+    if max_retries is None:
+        max_retries = model_def.max_retries
+    attempt = 0
+    while True:
+        try:
+            return await call()
+        except Exception as e:
+            on_error(e)
+            delay = retry_delay(limiter, e, attempt, max_retries, estimated_tokens)
+            if delay is None:
+                raise
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+def _reset_after_fork() -> None:
+    # waiters and semaphore holders belong to the parent's threads
+    global _lock
+    _lock = threading.Lock()
+    _limiters.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,351 @@
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, fields
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import toml
+from flask import Flask
+
+import pre_logger
+from pre_chat_completion import RequestData, ResponseData, chat_completion
+from pre_model import get_pre_model
+from pre_qa_index import get_index
+from pre_qa_log import (
+    QA_LOGFILE_EXTENSION,
+    QA_SEGMENT_EXTENSION,
+    QA_SEGMENT_PREFIX,
+    shutdown_sink,
+)
+from pre_settings import Settings, load_settings
+
+# a hash of the case as it was read, recorded in its QA logs as batch_case
+CaseKey = str
+
+
+@dataclass
+class BatchCase:
+    system_content: str
+    user_content: str
+    prompt_class: str
+
+
+@dataclass
+class BatchTask:
+    case_index: int
+    case: BatchCase
+    model: str
+    temperature: float
+
+
+@dataclass
+class BatchResult:
+    case_index: int
+    model: str
+    temperature: float
+    prompt_class: str
+    status: int
+    seconds: float
+    qa_id: str = ""
+    finish_reason: str = ""
+    completion_tokens: int = 0
+    prompt_tokens: int = 0
+    content: str = ""
+    error: str = ""
+
+
+def load_cases(cases_file: str) -> List[BatchCase]:
+    if cases_file.endswith(".toml"):
+        case_data_list = toml.load(cases_file).get("case", [])
+    else:
+        with open(cases_file, encoding="utf-8") as f:
+            case_data_list = [json.loads(line) for line in f if line.strip()]
+    return [
+        BatchCase(
+            system_content=case_data["system_content"],
+            user_content=case_data["user_content"],
+            prompt_class=case_data["prompt_class"],
+        )
+        for case_data in case_data_list
+    ]
+
+
+def case_key(
+    model: str,
+    system_content: str,
+    user_content: str,
+    temperature: float,
+    prompt_class: str,
+) -> CaseKey:
+    payload = json.dumps(
+        [model, system_content, user_content, temperature, prompt_class],
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def qa_request_key(qa_request: Dict[str, Any]) -> Optional[CaseKey]:
+    if "batch_case" in qa_request:
+        return str(qa_request["batch_case"])
+    # QA logs of runs before batch_case was recorded: the messages sent, which
+    # differ from the case if the prompt was truncated
+    contents = {m.get("role"): m.get("content") for m in qa_request.get("messages", [])}
+    if "system" not in contents or "user" not in contents:
+        return None
+    # QA logs written before selected_model was recorded only know the
+    # deployment, which several model names may share
+    if "selected_model" in qa_request:
+        model = "model:" + qa_request["selected_model"]
+    else:
+        model = "deployment:" + qa_request["model"]
+    return case_key(
+        model,
+        contents["system"],
+        contents["user"],
+        float(qa_request["temperature"]),
+        qa_request["prompt_class"],
+    )
+
+
+def iter_qa_requests(settings: Settings, user_id: str) -> Iterable[Dict[str, Any]]:
+    if settings.qa_index_file is not None:
+        for record in get_index(settings.qa_index_file).user_records(user_id):
+            yield record["qa_request"]
+        return
+    qa_log_dir = settings.qa_log_dir
+    suffix = "_" + user_id
+    for logfile in glob.glob(
+        os.path.join(qa_log_dir, "*" + suffix + QA_LOGFILE_EXTENSION)
+    ):
+        try:
+            yield toml.load(logfile)["qa_request"]
+        except Exception:
+            continue
+    for segment in glob.glob(
+        os.path.join(qa_log_dir, QA_SEGMENT_PREFIX + "*" + QA_SEGMENT_EXTENSION)
+    ):
+        with open(segment, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a segment cut short by a crash ends with a partial line
+                    continue
+                if record["qa_id"].endswith(suffix):
+                    yield record["qa_request"]
+
+
+def scan_completed(settings: Settings, user_id: str) -> Set[CaseKey]:
+    completed: Set[CaseKey] = set()
+    for qa_request in iter_qa_requests(settings, user_id):
+        key = qa_request_key(qa_request)
+        if key is not None:
+            completed.add(key)
+    return completed
+
+
+class ResultWriter:
+    def __init__(self, results_file: str):
+        is_new = not os.path.exists(results_file) or os.path.getsize(results_file) == 0
+        self._file = open(results_file, "a", newline="", encoding="utf-8")
+        self._writer = csv.DictWriter(
+            self._file, fieldnames=[f.name for f in fields(BatchResult)]
+        )
+        if is_new:
+            self._writer.writeheader()
+        self._lock = threading.Lock()
+
+    def write(self, result: BatchResult) -> None:
+        with self._lock:
+            self._writer.writerow(asdict(result))
+            self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def run_task(
+    app: Flask, settings: Settings, task: BatchTask, user_id: str
+) -> BatchResult:
+    request_data = RequestData(
+        system_content=task.case.system_content,
+        user_content=task.case.user_content,
+        temperature=task.temperature,
+        prompt_class=task.case.prompt_class,
+        user_id=user_id,
+        selected_model=task.model,
+    )
+    start = time.perf_counter()
+    key = case_key(
+        "model:" + task.model,
+        task.case.system_content,
+        task.case.user_content,
+        task.temperature,
+        task.case.prompt_class,
+    )
+    with app.app_context():
+        response_data, status_code = chat_completion(
+            request_data, settings, links={"batch_case": key}
+        )
+    result = BatchResult(
+        case_index=task.case_index,
+        model=task.model,
+        temperature=task.temperature,
+        prompt_class=task.case.prompt_class,
+        status=status_code,
+        seconds=round(time.perf_counter() - start, 3),
+    )
+    if isinstance(response_data, ResponseData):
+        result.qa_id = response_data.qa_id
+        result.finish_reason = response_data.finish_reason
+        result.completion_tokens = response_data.completion_tokens
+        result.prompt_tokens = response_data.prompt_tokens
+        result.content = response_data.content or ""
+    else:
+        result.error = response_data.detail.strip()
+    return result
+
+
+def summarize(results: List[BatchResult]) -> str:
+    groups: Dict[Tuple[str, float], List[BatchResult]] = {}
+    for result in results:
+        groups.setdefault((result.model, result.temperature), []).append(result)
+    lines = [
+        f"{'model':<24} {'temp':>5} {'ok':>5} {'failed':>6} {'avg_s':>7} "
+        f"{'prompt_tok':>10} {'compl_tok':>10}"
+    ]
+    for (model, temperature), group in sorted(groups.items()):
+        ok = [r for r in group if r.status == 200]
+        avg = sum(r.seconds for r in ok) / len(ok) if ok else 0.0
+        lines.append(
+            f"{model:<24} {temperature:>5g} {len(ok):>5} {len(group) - len(ok):>6} "
+            f"{avg:>7.2f} {sum(r.prompt_tokens for r in ok):>10} "
+            f"{sum(r.completion_tokens for r in ok):>10}"
+        )
+    return "\n".join(lines)
+
+
+def run_batch(
+    cases: List[BatchCase],
+    models: List[str],
+    temperatures: List[float],
+    user_id: str,
+    parallel: int,
+    results_file: str,
+    resume: bool = True,
+) -> List[BatchResult]:
+    settings = load_settings()
+    app = Flask(__name__)
+    app.logger = pre_logger.pre_logger(
+        module_name="pre_batch_runner", log_dir=settings.log_dir, level="INFO"
+    )
+
+    pre_model = get_pre_model(settings.def_model)
+    deployment_names: Dict[str, str] = {}
+    for model in models:
+        group = pre_model.get_group(model)
+        model_def = pre_model.get_def(model)
+        if group is not None:
+            deployment_names[model] = group.name
+        elif model_def is not None:
+            deployment_names[model] = model_def.deployment_name
+        else:
+            raise ValueError(f"model {model!r} is not defined in {settings.def_model}")
+
+    completed = scan_completed(settings, user_id) if resume else set()
+    tasks: List[BatchTask] = []
+    skipped = 0
+    for model in models:
+        for temperature in temperatures:
+            for case_index, case in enumerate(cases):
+                keys = [
+                    case_key(
+                        prefix + name,
+                        case.system_content,
+                        case.user_content,
+                        temperature,
+                        case.prompt_class,
+                    )
+                    for prefix, name in [
+                        ("model:", model),
+                        ("deployment:", deployment_names[model]),
+                    ]
+                ]
+                if any(key in completed for key in keys):
+                    skipped += 1
+                    continue
+                tasks.append(BatchTask(case_index, case, model, temperature))
+    app.logger.info("batch: %d tasks to run, %d already done", len(tasks), skipped)
+
+    results: List[BatchResult] = []
+    writer = ResultWriter(results_file)
+    try:
+        with ThreadPoolExecutor(
+            max_workers=parallel, thread_name_prefix="pre-batch"
+        ) as executor:
+            futures = [
+                executor.submit(run_task, app, settings, task, user_id)
+                for task in tasks
+            ]
+            for done, future in enumerate(futures, 1):
+                result = future.result()
+                writer.write(result)
+                results.append(result)
+                if result.status != 200:
+                    app.logger.warning(
+                        "batch: case %d %s t=%g failed: %s",
+                        result.case_index,
+                        result.model,
+                        result.temperature,
+                        result.error,
+                    )
+                if done % 10 == 0 or done == len(futures):
+                    app.logger.info("batch: %d/%d done", done, len(futures))
+    finally:
+        writer.close()
+        shutdown_sink()
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Run cases x models x temperatures through chat_completion."
+    )
+    parser.add_argument("cases", help="cases file (.jsonl, or .toml with [[case]])")
+    parser.add_argument("--models", required=True, help="comma separated model names")
+    parser.add_argument(
+        "--temperatures", default="0", help="comma separated temperatures"
+    )
+    parser.add_argument(
+        "--user-id", default="batch", help="user_id of the QA logs (used to resume)"
+    )
+    parser.add_argument("--parallel", type=int, default=4)
+    parser.add_argument("--results", default="batch_results.csv")
+    parser.add_argument(
+        "--no-resume", action="store_true", help="run cases already in the QA log"
+    )
+    args = parser.parse_args(argv)
+
+    results = run_batch(
+        cases=load_cases(args.cases),
+        models=[m.strip() for m in args.models.split(",") if m.strip()],
+        temperatures=[float(t) for t in args.temperatures.split(",") if t.strip()],
+        user_id=args.user_id,
+        parallel=args.parallel,
+        results_file=args.results,
+        resume=not args.no_resume,
+    )
+    print(summarize(results))
+    return 0 if all(r.status == 200 for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,25 +1,60 @@
-import os
+import asyncio
+import logging
+import math
 import traceback
-from dataclasses import asdict, dataclass
-from datetime import datetime
-from typing import Tuple, Union
-from unittest.mock import MagicMock
+from dataclasses import asdict, dataclass, replace
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
-import toml
-from dotenv import load_dotenv
 from flask import current_app
-from openai import AzureOpenAI, OpenAI
+from openai import RateLimitError
+from openai.types import CompletionUsage
 from openai.types.chat import (
     ChatCompletion,
+    ChatCompletionChunk,
+    ChatCompletionAssistantMessageParam,
     ChatCompletionMessageParam,
     ChatCompletionSystemMessageParam,
     ChatCompletionUserMessageParam,
 )
 
-from pre_model import PreModel
-from pre_openai_mock import get_response
-
-QA_LOGFILE_EXTENSION = ".toml"
+from pre_admission import (
+    AdmissionRejectedError,
+    call_with_retries,
+    call_with_retries_async,
+    get_limiter,
+    retry_after_from_error,
+)
+from pre_conversation_store import Turn
+from pre_completion_cache import (
+    get_cache,
+    is_cache_enabled,
+    make_key,
+    should_use_cache,
+)
+from pre_llm_client import get_async_client, get_client
+from pre_metrics import (
+    UPSTREAM_ERRORS,
+    UPSTREAM_REQUESTS,
+    count_cost,
+    count_tokens,
+    current_endpoint,
+    endpoint_of,
+    stage,
+)
+from pre_model import ModelDef, ModelGroup, PreModel, get_pre_model
+from pre_openai_mock import get_response, get_response_async, get_stream_response
+from pre_payload import Schema, dumps
+from pre_qa_id import new_qa_id
+from pre_qa_log import QaLogRecord, get_sink
+from pre_router import NoBackendAvailableError, get_router, route, route_async
+from pre_settings import Settings
+from pre_tokens import (
+    Preflight,
+    PromptTooLongError,
+    estimate_cost,
+    get_tokenizer,
+    preflight,
+)
 
 
 @dataclass
@@ -30,6 +65,10 @@ class RequestData:
     prompt_class: str
     user_id: str
     selected_model: str
+    use_cache: bool = False
+
+
+REQUEST_SCHEMA = Schema(RequestData, bounds={"temperature": (0.0, 2.0)})
 
 
 @dataclass
@@ -42,6 +81,7 @@ class ResponseData:
     lines: int
     prompt_class: str
     temperature: float
+    truncated: bool = False
 
 
 @dataclass
@@ -50,136 +90,802 @@ class ResponseErrorData:
     detail: str
 
 
-def get_current_datetime() -> str:
-    now = datetime.now()
-    formatted_datetime = now.strftime("%Y%m%d_%H%M%S")
-    return formatted_datetime
+@dataclass
+class ResponseRejectedData(ResponseErrorData):
+    retry_after: int
 
 
-def chat_completion(
+def to_rejected_data(e: Exception) -> ResponseRejectedData:
+    if isinstance(e, (AdmissionRejectedError, NoBackendAvailableError)):
+        retry_after: Optional[float] = e.retry_after
+    else:
+        retry_after = retry_after_from_error(e)
+    return ResponseRejectedData(
+        error=e.__class__.__name__,
+        detail=str(e),
+        retry_after=math.ceil(retry_after or 1),
+    )
+
+
+def build_messages(
+    request_data: RequestData, history: Sequence[Turn] = ()
+) -> list[ChatCompletionMessageParam]:
+    messages: list[ChatCompletionMessageParam] = [
+        ChatCompletionSystemMessageParam(
+            role="system", content=f"{request_data.system_content}"
+        )
+    ]
+    for turn in history:
+        if turn.role == "assistant":
+            messages.append(
+                ChatCompletionAssistantMessageParam(
+                    role="assistant", content=turn.content
+                )
+            )
+        else:
+            messages.append(
+                ChatCompletionUserMessageParam(role="user", content=turn.content)
+            )
+    messages.append(
+        ChatCompletionUserMessageParam(
+            role="user", content=f"{request_data.user_content}"
+        )
+    )
+    return messages
+
+
+def write_qa_log(
+    settings: Settings,
+    qa_id: str,
+    deployment_name: str,
+    backend: str,
+    messages: list[ChatCompletionMessageParam],
     request_data: RequestData,
-) -> Tuple[Union[ResponseData, ResponseErrorData], int]:
+    finish_reason: str,
+    content: str | None,
+    completion_tokens: int,
+    prompt_tokens: int,
+    links: Optional[Dict[str, str]] = None,
+) -> None:
+    logger = current_app.logger
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(asdict(request_data))
+    chat_completion_request = {
+        "model": deployment_name,
+        "messages": messages,
+        "temperature": request_data.temperature,
+        "prompt_class": request_data.prompt_class,
+        "selected_model": request_data.selected_model,
+        "backend": backend,
+        "user_id": request_data.user_id,
+    }
+    if links:
+        # ids shared with related QA logs (conversation_id, fanout_id, batch_case)
+        chat_completion_request.update(links)
+    chat_completion_response = {
+        "finish_reason": finish_reason,
+        "content": content,
+        "completion_tokens": completion_tokens,
+        "prompt_tokens": prompt_tokens,
+    }
+    get_sink(settings, logger).write(
+        QaLogRecord(
+            qa_id=qa_id,
+            qa_request=chat_completion_request,
+            qa_response=chat_completion_response,
+        )
+    )
+
+
+def backends_of(
+    pre_model: PreModel, group: Optional[ModelGroup], model_def: Optional[ModelDef]
+) -> List[ModelDef]:
+    if group is not None:
+        return [pre_model.index[name] for name in group.members]
+    return [model_def] if model_def is not None else []
+
+
+def count_usage(
+    model_def: Optional[ModelDef],
+    request_data: RequestData,
+    prompt_tokens: int,
+    completion_tokens: int,
+) -> None:
+    count_tokens(
+        request_data.selected_model,
+        request_data.prompt_class,
+        prompt_tokens,
+        completion_tokens,
+    )
+    if model_def is None:
+        return
+    cost = estimate_cost(model_def, prompt_tokens, completion_tokens)
+    if cost is not None:
+        count_cost(request_data.selected_model, request_data.prompt_class, cost)
+
+
+def create_completion(
+    settings: Settings,
+    model_def: ModelDef,
+    deployment_name: str,
+    messages: list[ChatCompletionMessageParam],
+    request_data: RequestData,
+    prompt_tokens: int,
+    max_retries: Optional[int] = None,
+) -> ChatCompletion:
+    logger = current_app.logger
+    model = model_def.name
+    limiter = get_limiter(model_def, settings.workers)
+
+    def on_error(e: Exception) -> None:
+        UPSTREAM_ERRORS.inc(model, e.__class__.__name__)
+        logger.warning("upstream error: %s: %s", model, e.__class__.__name__)
+
+    def call() -> ChatCompletion:
+        UPSTREAM_REQUESTS.inc(model)
+        if settings.is_mock and settings.mockdata_file is not None:
+            logger.debug("--OpenAI API Mocking--")
+            with stage("upstream"):
+                return get_response(settings, model, request_data.prompt_class)
+
+        logger.debug("--OpenAI API Call--")
+        with stage("client"):
+            client = get_client(model_def)
+        with stage("upstream"):
+            return client.chat.completions.create(
+                model=deployment_name,
+                messages=messages,
+                temperature=request_data.temperature,
+            )
+
+    with stage("admission"):
+        limiter.acquire(prompt_tokens)
     try:
-        logger = current_app.logger
-        logger.debug("- chat_completion called -")
-        logger.debug(request_data)
-        logger.debug(type(request_data))
+        response = call_with_retries(
+            model_def, limiter, call, on_error, prompt_tokens, max_retries
+        )
+    finally:
+        limiter.release()
+    if response.usage is not None:
+        limiter.settle(prompt_tokens, response.usage.total_tokens)
 
-        load_dotenv()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(response.model_dump_json(indent=2))
+    return response
 
-        pre_model = PreModel()
-        logger.debug(f"selected_model: {request_data.selected_model}")
-        model_def = pre_model.get_def(request_data.selected_model)
-        if model_def is None or model_def.api_key is None:
-            raise Exception("api_key not defined")
 
-        api_key = os.environ.get(model_def.api_key)
-
-        client: Union[AzureOpenAI, OpenAI]
-        if model_def.llm_service == "Azure":
-            logger.debug("llm_service: Azure")
-            if model_def.azure_endpoint is None:
-                raise Exception("azure_endpoint is None")
-            client = AzureOpenAI(
-                api_key=api_key,
-                api_version=model_def.api_version,
-                azure_endpoint=model_def.azure_endpoint,
+async def create_completion_async(
+    settings: Settings,
+    model_def: ModelDef,
+    deployment_name: str,
+    messages: list[ChatCompletionMessageParam],
+    request_data: RequestData,
+    prompt_tokens: int,
+    max_retries: Optional[int] = None,
+) -> ChatCompletion:
+    # create_completion() on the event loop of asgi.py
+    logger = current_app.logger
+    model = model_def.name
+    limiter = get_limiter(model_def, settings.workers)
+
+    def on_error(e: Exception) -> None:
+        UPSTREAM_ERRORS.inc(model, e.__class__.__name__)
+        logger.warning("upstream error: %s: %s", model, e.__class__.__name__)
+
+    async def call() -> ChatCompletion:
+        UPSTREAM_REQUESTS.inc(model)
+        if settings.is_mock and settings.mockdata_file is not None:
+            logger.debug("--OpenAI API Mocking (async)--")
+            with stage("upstream"):
+                return await get_response_async(
+                    settings, model, request_data.prompt_class
+                )
+
+        logger.debug("--OpenAI API Call (async)--")
+        with stage("client"):
+            client = get_async_client(model_def)
+        with stage("upstream"):
+            return await client.chat.completions.create(
+                model=deployment_name,
+                messages=messages,
+                temperature=request_data.temperature,
             )
-        elif model_def.llm_service == "OpenAI":
-            logger.debug("llm_service: OpenAI")
-            client = OpenAI(api_key=api_key)
-        else:
-            raise Exception("invalid llm_service")
 
-        deployment_name = model_def.deployment_name
+    with stage("admission"):
+        await limiter.acquire_async(prompt_tokens)
+    try:
+        response = await call_with_retries_async(
+            model_def, limiter, call, on_error, prompt_tokens, max_retries
+        )
+    finally:
+        limiter.release()
+    if response.usage is not None:
+        limiter.settle(prompt_tokens, response.usage.total_tokens)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(response.model_dump_json(indent=2))
+    return response
 
-        current_datetime = get_current_datetime()
-        qa_id = current_datetime + "_" + request_data.user_id
-        logger.debug(f"qa_id: {qa_id}")
 
-        lines = len(request_data.user_content.split("\n"))
-        logger.debug(f"Number of lines: {lines}")
+def create_completion_stream(
+    settings: Settings,
+    model_def: ModelDef,
+    deployment_name: str,
+    messages: list[ChatCompletionMessageParam],
+    request_data: RequestData,
+    prompt_tokens: int,
+    max_retries: Optional[int] = None,
+) -> Iterable[ChatCompletionChunk]:
+    logger = current_app.logger
+    model = model_def.name
+    limiter = get_limiter(model_def, settings.workers)
 
-        logger.debug(request_data.user_content)
+    def on_error(e: Exception) -> None:
+        UPSTREAM_ERRORS.inc(model, e.__class__.__name__)
+        logger.warning("upstream error: %s: %s", model, e.__class__.__name__)
 
-        messages: list[ChatCompletionMessageParam] = [
-            ChatCompletionSystemMessageParam(
-                role="system", content=f"{request_data.system_content}"
-            ),
-            ChatCompletionUserMessageParam(
-                role="user", content=f"{request_data.user_content}"
-            ),
-        ]
+    def call() -> Iterable[ChatCompletionChunk]:
+        UPSTREAM_REQUESTS.inc(model)
+        if settings.is_mock and settings.mockdata_file is not None:
+            logger.debug("--OpenAI API Mocking (stream)--")
+            return get_stream_response(settings, model, request_data.prompt_class)
 
-        runmode = os.environ.get("PRE_RUNMODE")
-        response: Union[MagicMock, ChatCompletion]
-        if runmode == "Mock":
-            logger.debug("--OpenAI API Mocking--")
-            loadfile = os.environ.get("PRE_MOCKDATA_FILE")
-            if loadfile is None:
-                raise Exception("PRE_MOCKDATA_FILE not defined")
-            response = get_response(loadfile)
-        else:
-            logger.debug("--OpenAI API Call--")
-            response = client.chat.completions.create(
+        logger.debug("--OpenAI API Call (stream)--")
+        with stage("client"):
+            client = get_client(model_def)
+        with stage("upstream"):
+            return client.chat.completions.create(
                 model=deployment_name,
                 messages=messages,
                 temperature=request_data.temperature,
+                stream=True,
             )
-            logger.debug(type(response))
-            response_json = response.model_dump_json(indent=2)
-            logger.debug(response_json)
 
-        if response.usage is not None:
-            completion_tokens = response.usage.completion_tokens
-            prompt_tokens = response.usage.prompt_tokens
-        else:
-            completion_tokens = 0
-            prompt_tokens = 0
+    with stage("admission"):
+        limiter.acquire(prompt_tokens)
+    try:
+        # the concurrency slot covers opening the stream, not reading it
+        return call_with_retries(
+            model_def, limiter, call, on_error, prompt_tokens, max_retries
+        )
+    finally:
+        limiter.release()
 
-        response_data: ResponseData = ResponseData(
-            finish_reason=response.choices[0].finish_reason,
-            content=response.choices[0].message.content,
-            completion_tokens=completion_tokens,
-            prompt_tokens=prompt_tokens,
-            qa_id=qa_id,
-            lines=lines,
-            prompt_class=request_data.prompt_class,
-            temperature=request_data.temperature,
+
+def routed_completion(
+    settings: Settings,
+    pre_model: PreModel,
+    group: ModelGroup,
+    messages: list[ChatCompletionMessageParam],
+    request_data: RequestData,
+    prompt_tokens: int,
+) -> Tuple[ModelDef, ChatCompletion]:
+    app = current_app._get_current_object()  # type: ignore[attr-defined]
+    endpoint = current_endpoint()
+
+    def call(name: str, last: bool) -> ChatCompletion:
+        model_def = pre_model.index[name]
+        # hedged requests run in threads of their own
+        with app.app_context(), endpoint_of(endpoint):
+            return create_completion(
+                settings,
+                model_def,
+                model_def.deployment_name,
+                messages,
+                request_data,
+                prompt_tokens,
+                # fail over to the next member rather than retry this one
+                max_retries=None if last else 0,
+            )
+
+    with stage("route"):
+        name, response = route(get_router(group), call)
+    current_app.logger.debug("routed to: %s", name)
+    return pre_model.index[name], response
+
+
+async def routed_completion_async(
+    settings: Settings,
+    pre_model: PreModel,
+    group: ModelGroup,
+    messages: list[ChatCompletionMessageParam],
+    request_data: RequestData,
+    prompt_tokens: int,
+) -> Tuple[ModelDef, ChatCompletion]:
+    async def call(name: str, last: bool) -> ChatCompletion:
+        model_def = pre_model.index[name]
+        return await create_completion_async(
+            settings,
+            model_def,
+            model_def.deployment_name,
+            messages,
+            request_data,
+            prompt_tokens,
+            max_retries=None if last else 0,
+        )
+
+    with stage("route"):
+        name, response = await route_async(get_router(group), call)
+    current_app.logger.debug("routed to: %s", name)
+    return pre_model.index[name], response
+
+
+def routed_completion_stream(
+    settings: Settings,
+    pre_model: PreModel,
+    group: ModelGroup,
+    messages: list[ChatCompletionMessageParam],
+    request_data: RequestData,
+    prompt_tokens: int,
+) -> Tuple[ModelDef, Iterable[ChatCompletionChunk]]:
+    def call(name: str, last: bool) -> Iterable[ChatCompletionChunk]:
+        model_def = pre_model.index[name]
+        return create_completion_stream(
+            settings,
+            model_def,
+            model_def.deployment_name,
+            messages,
+            request_data,
+            prompt_tokens,
+            max_retries=None if last else 0,
         )
 
-        # qa_log
-        request_data_dict = asdict(request_data)
-        logger.debug(request_data_dict)
-        qa_log_dir = os.environ.get("PRE_QA_LOG_DIR")
-        if qa_log_dir is None:
-            raise Exception("PRE_QA_LOG_DIR is not set.")
-        logger.debug(qa_log_dir)
-        logfile = qa_log_dir + qa_id + QA_LOGFILE_EXTENSION
-        chat_completion_request = {
-            "model": deployment_name,
-            "messages": messages,
-            "temperature": request_data.temperature,
-            "prompt_class": request_data.prompt_class,
-        }
-        request_qa_log = {"qa_request": chat_completion_request}
-        chat_completion_response = {
-            "finish_reason": response.choices[0].finish_reason,
-            "content": response.choices[0].message.content,
-            "completion_tokens": completion_tokens,
-            "prompt_tokens": prompt_tokens,
-        }
-        response_qa_log = {"qa_response": chat_completion_response}
-        with open(logfile, "w") as f:
-            toml.dump(request_qa_log, f)
-            toml.dump(response_qa_log, f)
-
-        logger.debug(response_data)
+    # a stream is not hedged: only opening it fails over
+    name, chunks = route(get_router(group), call, hedge=False)
+    current_app.logger.debug("routed to: %s", name)
+    return pre_model.index[name], chunks
+
+
+def complete(
+    settings: Settings,
+    pre_model: PreModel,
+    group: Optional[ModelGroup],
+    model_def: Optional[ModelDef],
+    messages: list[ChatCompletionMessageParam],
+    request_data: RequestData,
+    prompt_tokens: int,
+) -> Tuple[ModelDef, ChatCompletion]:
+    if group is not None:
+        return routed_completion(
+            settings, pre_model, group, messages, request_data, prompt_tokens
+        )
+    if model_def is None:
+        raise Exception("api_key not defined")
+    response = create_completion(
+        settings,
+        model_def,
+        model_def.deployment_name,
+        messages,
+        request_data,
+        prompt_tokens,
+    )
+    return model_def, response
+
+
+async def complete_async(
+    settings: Settings,
+    pre_model: PreModel,
+    group: Optional[ModelGroup],
+    model_def: Optional[ModelDef],
+    messages: list[ChatCompletionMessageParam],
+    request_data: RequestData,
+    prompt_tokens: int,
+) -> Tuple[ModelDef, ChatCompletion]:
+    if group is not None:
+        return await routed_completion_async(
+            settings, pre_model, group, messages, request_data, prompt_tokens
+        )
+    if model_def is None:
+        raise Exception("api_key not defined")
+    response = await create_completion_async(
+        settings,
+        model_def,
+        model_def.deployment_name,
+        messages,
+        request_data,
+        prompt_tokens,
+    )
+    return model_def, response
+
+
+@dataclass
+class PreparedCompletion:
+    pre_model: PreModel
+    group: Optional[ModelGroup]
+    model_def: Optional[ModelDef]
+    deployment_name: str
+    qa_id: str
+    lines: int
+    checked: Preflight
+    # with the user content as it is sent
+    request_data: RequestData
+    messages: list[ChatCompletionMessageParam]
+    cache_key: Optional[str]
+    cached: Optional[ChatCompletion]
+
+
+def prepare_completion(
+    request_data: RequestData,
+    settings: Settings,
+    history: Sequence[Turn] = (),
+    history_budget: Optional[int] = None,
+) -> PreparedCompletion:
+    # history: earlier messages of a conversation, of which the newest that
+    # fit in history_budget tokens (and the context window) are sent
+    logger = current_app.logger
+
+    with stage("model_registry"):
+        pre_model = get_pre_model(settings.def_model)
+    logger.debug("selected_model: %s", request_data.selected_model)
+    group = pre_model.get_group(request_data.selected_model)
+    model_def = pre_model.get_def(request_data.selected_model)
+    if group is not None:
+        logger.debug("model_group: %s", group.members)
+        # the members are equivalent: they share cached answers
+        deployment_name = group.name
+    elif model_def is None or model_def.api_key is None:
+        raise Exception("api_key not defined")
+    else:
+        logger.debug("llm_service: %s", model_def.llm_service)
+        deployment_name = model_def.deployment_name
+
+    qa_id = new_qa_id(request_data.user_id)
+    logger.debug("qa_id: %s", qa_id)
+
+    lines = request_data.user_content.count("\n") + 1
+    logger.debug("Number of lines: %s", lines)
+
+    logger.debug(request_data.user_content)
+
+    with stage("preflight"):
+        checked = preflight(
+            request_data.selected_model,
+            backends_of(pre_model, group, model_def),
+            request_data.system_content,
+            request_data.user_content,
+            [turn.tokens for turn in history],
+            history_budget,
+        )
+    logger.debug("prompt_tokens (pre-flight): %s", checked.prompt_tokens)
+    if checked.truncated:
+        logger.info("prompt truncated: %s", qa_id)
+        request_data = replace(request_data, user_content=checked.user_content)
+    if checked.dropped:
+        logger.debug("history messages left out: %s", checked.dropped)
+
+    messages = build_messages(request_data, history[checked.dropped :])
+
+    cache_key = None
+    if is_cache_enabled(settings) and should_use_cache(
+        request_data.temperature, request_data.use_cache
+    ):
+        cache_key = make_key(deployment_name, messages, request_data.temperature)
+
+    cached: Optional[ChatCompletion] = None
+    if cache_key is not None:
+        with stage("cache"):
+            cached = get_cache(settings).get(cache_key)
+        logger.debug("completion cache hit: %s", cached is not None)
+
+    return PreparedCompletion(
+        pre_model=pre_model,
+        group=group,
+        model_def=model_def,
+        deployment_name=deployment_name,
+        qa_id=qa_id,
+        lines=lines,
+        checked=checked,
+        request_data=request_data,
+        messages=messages,
+        cache_key=cache_key,
+        cached=cached,
+    )
+
+
+def finish_completion(
+    settings: Settings,
+    prepared: PreparedCompletion,
+    backend: Optional[ModelDef],
+    response: ChatCompletion,
+    links: Optional[Dict[str, str]] = None,
+) -> ResponseData:
+    logger = current_app.logger
+    request_data = prepared.request_data
+    checked = prepared.checked
+    # a cached answer costs nothing
+    cost_backend = None
+    if prepared.cached is None:
+        cost_backend = backend
+        if prepared.cache_key is not None:
+            get_cache(settings).put(prepared.cache_key, response)
+
+    if response.usage is not None:
+        completion_tokens = response.usage.completion_tokens
+        prompt_tokens = response.usage.prompt_tokens
+    else:
+        completion_tokens = 0
+        prompt_tokens = checked.prompt_tokens
+    count_usage(cost_backend, request_data, prompt_tokens, completion_tokens)
+
+    response_data: ResponseData = ResponseData(
+        finish_reason=response.choices[0].finish_reason,
+        content=response.choices[0].message.content,
+        completion_tokens=completion_tokens,
+        prompt_tokens=prompt_tokens,
+        qa_id=prepared.qa_id,
+        lines=prepared.lines,
+        prompt_class=request_data.prompt_class,
+        temperature=request_data.temperature,
+        truncated=checked.truncated,
+    )
+
+    # qa_log
+    with stage("qa_log"):
+        write_qa_log(
+            settings,
+            prepared.qa_id,
+            backend.deployment_name
+            if backend is not None
+            else prepared.deployment_name,
+            backend.name if backend is not None else "",
+            prepared.messages,
+            request_data,
+            response.choices[0].finish_reason,
+            response.choices[0].message.content,
+            completion_tokens,
+            prompt_tokens,
+            links,
+        )
+
+    logger.debug(response_data)
+    return response_data
+
+
+def run_chat_completion(
+    request_data: RequestData,
+    settings: Settings,
+    history: Sequence[Turn] = (),
+    history_budget: Optional[int] = None,
+    links: Optional[Dict[str, str]] = None,
+) -> Tuple[ResponseData, Preflight]:
+    prepared = prepare_completion(request_data, settings, history, history_budget)
+    backend, response = prepared.model_def, prepared.cached
+    if response is None:
+        backend, response = complete(
+            settings,
+            prepared.pre_model,
+            prepared.group,
+            prepared.model_def,
+            prepared.messages,
+            prepared.request_data,
+            prepared.checked.prompt_tokens,
+        )
+    response_data = finish_completion(settings, prepared, backend, response, links)
+    return response_data, prepared.checked
+
+
+async def run_chat_completion_async(
+    request_data: RequestData,
+    settings: Settings,
+) -> ResponseData:
+    # the cache, the QA log and the token counts are file and CPU work: they
+    # run in threads, and only the model call stays on the event loop
+    prepared = await asyncio.to_thread(prepare_completion, request_data, settings)
+    backend, response = prepared.model_def, prepared.cached
+    if response is None:
+        backend, response = await complete_async(
+            settings,
+            prepared.pre_model,
+            prepared.group,
+            prepared.model_def,
+            prepared.messages,
+            prepared.request_data,
+            prepared.checked.prompt_tokens,
+        )
+    return await asyncio.to_thread(
+        finish_completion, settings, prepared, backend, response
+    )
+
+
+def to_error_response(e: Exception) -> Tuple[ResponseErrorData, int]:
+    logger = current_app.logger
+    if isinstance(e, (AdmissionRejectedError, RateLimitError)):
+        rejected_response = to_rejected_data(e)
+        logger.warning("rejected_response: %s", rejected_response)
+        return rejected_response, 429
+    if isinstance(e, NoBackendAvailableError):
+        rejected_response = to_rejected_data(e)
+        logger.warning("rejected_response: %s", rejected_response)
+        return rejected_response, 503
+    if isinstance(e, PromptTooLongError):
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=str(e))
+        logger.warning("error_response: %s", error_response)
+        return error_response, 400
+    t = traceback.format_exception_only(type(e), e)
+    error_response = ResponseErrorData(error=e.__class__.__name__, detail=t[0])
+    logger.error("error_response: %s", error_response)
+    return error_response, 500
+
+
+def chat_completion(
+    request_data: RequestData,
+    settings: Settings,
+    links: Optional[Dict[str, str]] = None,
+) -> Tuple[Union[ResponseData, ResponseErrorData], int]:
+    try:
+        logger = current_app.logger
+        logger.debug("- chat_completion called -")
+        logger.debug(request_data)
+
+        response_data, _ = run_chat_completion(request_data, settings, links=links)
+
         logger.debug("- chat_completion return -")
         return response_data, 200
 
     except Exception as e:
-        t = traceback.format_exception_only(type(e), e)
-        error_response = ResponseErrorData(error=e.__class__.__name__, detail=t[0])
-        logger.error(f"error_response: {error_response}")
-        return error_response, 500
+        return to_error_response(e)
+
+
+async def chat_completion_async(
+    request_data: RequestData,
+    settings: Settings,
+) -> Tuple[Union[ResponseData, ResponseErrorData], int]:
+    try:
+        logger = current_app.logger
+        logger.debug("- chat_completion_async called -")
+        logger.debug(request_data)
+
+        response_data = await run_chat_completion_async(request_data, settings)
+
+        logger.debug("- chat_completion_async return -")
+        return response_data, 200
+
+    except Exception as e:
+        return to_error_response(e)
+
+
+def format_sse(event: str, data: object) -> str:
+    return f"event: {event}\ndata: {dumps(data).decode('utf-8')}\n\n"
+
+
+def chat_completion_stream(
+    request_data: RequestData,
+    settings: Settings,
+) -> Tuple[Union[Iterator[str], ResponseErrorData], int]:
+    try:
+        logger = current_app.logger
+        logger.debug("- chat_completion_stream called -")
+        logger.debug(request_data)
+
+        with stage("model_registry"):
+            pre_model = get_pre_model(settings.def_model)
+        logger.debug("selected_model: %s", request_data.selected_model)
+        group = pre_model.get_group(request_data.selected_model)
+        model_def = pre_model.get_def(request_data.selected_model)
+        if group is None and (model_def is None or model_def.api_key is None):
+            raise Exception("api_key not defined")
+
+        qa_id = new_qa_id(request_data.user_id)
+        logger.debug("qa_id: %s", qa_id)
+
+        lines = request_data.user_content.count("\n") + 1
+        logger.debug("Number of lines: %s", lines)
+
+        with stage("preflight"):
+            checked = preflight(
+                request_data.selected_model,
+                backends_of(pre_model, group, model_def),
+                request_data.system_content,
+                request_data.user_content,
+            )
+        logger.debug("prompt_tokens (pre-flight): %s", checked.prompt_tokens)
+        if checked.truncated:
+            logger.info("prompt truncated: %s", qa_id)
+            request_data = replace(request_data, user_content=checked.user_content)
+
+        messages = build_messages(request_data)
+
+        if group is not None:
+            logger.debug("model_group: %s", group.members)
+            backend, chunks = routed_completion_stream(
+                settings,
+                pre_model,
+                group,
+                messages,
+                request_data,
+                checked.prompt_tokens,
+            )
+        elif model_def is not None:
+            logger.debug("llm_service: %s", model_def.llm_service)
+            backend = model_def
+            chunks = create_completion_stream(
+                settings,
+                model_def,
+                model_def.deployment_name,
+                messages,
+                request_data,
+                checked.prompt_tokens,
+            )
+
+    except Exception as e:
+        return to_error_response(e)
+
+    def generate() -> Iterator[str]:
+        content_parts: list[str] = []
+        # tokens charged to the limiter once the stream ends
+        used: Optional[int] = None
+        try:
+            finish_reason = ""
+            completion_tokens = 0
+            prompt_tokens = 0
+            usage_reported = False
+            for chunk in chunks:
+                # usage is only present on the last chunk, and only if the
+                # upstream reports it for streamed completions
+                usage = getattr(chunk, "usage", None)
+                if usage is not None:
+                    completion_usage = CompletionUsage.model_validate(usage)
+                    completion_tokens = completion_usage.completion_tokens
+                    prompt_tokens = completion_usage.prompt_tokens
+                    usage_reported = True
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.delta.content:
+                    content_parts.append(choice.delta.content)
+                    yield format_sse("delta", {"content": choice.delta.content})
+                if choice.finish_reason is not None:
+                    finish_reason = choice.finish_reason
+
+            content = "".join(content_parts)
+            if not usage_reported:
+                prompt_tokens = checked.prompt_tokens
+                completion_tokens = get_tokenizer(backend).count(content)
+            count_usage(backend, request_data, prompt_tokens, completion_tokens)
+            used = prompt_tokens + completion_tokens
+            response_data = ResponseData(
+                finish_reason=finish_reason,
+                content=content,
+                completion_tokens=completion_tokens,
+                prompt_tokens=prompt_tokens,
+                qa_id=qa_id,
+                lines=lines,
+                prompt_class=request_data.prompt_class,
+                temperature=request_data.temperature,
+                truncated=checked.truncated,
+            )
+
+            # qa_log
+            with stage("qa_log"):
+                write_qa_log(
+                    settings,
+                    qa_id,
+                    backend.deployment_name,
+                    backend.name,
+                    messages,
+                    request_data,
+                    finish_reason,
+                    content,
+                    completion_tokens,
+                    prompt_tokens,
+                )
+
+            logger.debug(response_data)
+            logger.debug("- chat_completion_stream return -")
+            yield format_sse("done", asdict(response_data))
+
+        except Exception as e:
+            t = traceback.format_exception_only(type(e), e)
+            error_response = ResponseErrorData(error=e.__class__.__name__, detail=t[0])
+            logger.error("error_response: %s", error_response)
+            yield format_sse("error", asdict(error_response))
+
+        finally:
+            # also when the stream failed or the client went away
+            if used is None:
+                used = checked.prompt_tokens + get_tokenizer(backend).count(
+                    "".join(content_parts)
+                )
+            get_limiter(backend, settings.workers).settle(checked.prompt_tokens, used)
+
+    return generate(), 200
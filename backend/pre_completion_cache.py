@@ -0,0 +1,276 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from openai.types.chat import ChatCompletion
+
+from pre_settings import Settings
+
+
+@dataclass
+class CacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    puts: int = 0
+    evictions: int = 0
+    memory_entries: int = 0
+    disk_entries: int = 0
+
+
+def make_key(deployment_name: str, messages: Any, temperature: float) -> str:
+    payload = json.dumps(
+        [deployment_name, messages, temperature],
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryTier:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, Tuple[float, str]] = OrderedDict()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: str, expires_at: float) -> int:
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        evicted = 0
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            evicted += 1
+        return evicted
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# a hit moves an entry up in the LRU order at most this often
+TOUCH_SECONDS = 60.0
+# touches are written together, once this many are pending (or on a put)
+TOUCH_BATCH = 100
+
+
+class DiskTier:
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # WAL stays consistent without a sync on each commit; a crash loses
+        # at most the last cache entries
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS completion_cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS completion_cache_accessed_at"
+            " ON completion_cache (accessed_at)"
+        )
+        self._conn.commit()
+        # key -> accessed_at of hits not written yet
+        self._touched: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[float, str]]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at, accessed_at FROM completion_cache"
+                " WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at, accessed_at = row
+            if expires_at < now:
+                self._conn.execute("DELETE FROM completion_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            if accessed_at < now - TOUCH_SECONDS:
+                self._touched[key] = now
+                if len(self._touched) >= TOUCH_BATCH:
+                    self._flush_touched()
+                    self._conn.commit()
+            return expires_at, value
+
+    def _flush_touched(self) -> None:
+        self._conn.executemany(
+            "UPDATE completion_cache SET accessed_at = ? WHERE key = ?",
+            [(accessed_at, key) for key, accessed_at in self._touched.items()],
+        )
+        self._touched.clear()
+
+    def put(self, key: str, value: str, expires_at: float) -> int:
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            self._touched.pop(key, None)
+            self._flush_touched()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completion_cache"
+                " (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, expires_at, time.time()),
+            )
+            evicted = self._evict()
+            self._conn.commit()
+            return evicted
+
+    def _evict(self) -> int:
+        evicted = self._conn.execute(
+            "DELETE FROM completion_cache WHERE expires_at < ?", (time.time(),)
+        ).rowcount
+        # the file is shared by the worker processes: count what is in it
+        row = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM completion_cache"
+        ).fetchone()
+        over = int(row[0]) - self.max_bytes
+        if over <= 0:
+            return evicted
+        # least recently used first, until the file is back under max_bytes
+        keys: List[str] = []
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM completion_cache ORDER BY accessed_at"
+        ):
+            keys.append(key)
+            over -= size
+            if over <= 0:
+                break
+        self._conn.executemany(
+            "DELETE FROM completion_cache WHERE key = ?", [(key,) for key in keys]
+        )
+        return evicted + len(keys)
+
+    def __len__(self) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT COUNT(*) FROM completion_cache").fetchone()
+            return int(row[0])
+
+    def close(self) -> None:
+        with self._lock:
+            if self._touched:
+                self._flush_touched()
+                self._conn.commit()
+            self._conn.close()
+
+
+class CompletionCache:
+    def __init__(self, settings: Settings):
+        self.ttl = settings.completion_cache_ttl
+        self.memory = MemoryTier(settings.completion_cache_max_entries)
+        self.disk: Optional[DiskTier] = None
+        if settings.completion_cache_file is not None:
+            self.disk = DiskTier(
+                settings.completion_cache_file, settings.completion_cache_max_bytes
+            )
+        self.stats = CacheStats()
+        # the memory tier and the stats; the disk tier has its own lock
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[ChatCompletion]:
+        with self._lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.stats.memory_hits += 1
+        if value is None:
+            entry = self.disk.get(key) if self.disk is not None else None
+            with self._lock:
+                if entry is None:
+                    self.stats.misses += 1
+                    return None
+                expires_at, value = entry
+                self.stats.disk_hits += 1
+                self.stats.evictions += self.memory.put(key, value, expires_at)
+        return ChatCompletion.model_validate_json(value)
+
+    def put(self, key: str, response: ChatCompletion) -> None:
+        value = response.model_dump_json()
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self.stats.puts += 1
+            self.stats.evictions += self.memory.put(key, value, expires_at)
+        if self.disk is not None:
+            evicted = self.disk.put(key, value, expires_at)
+            with self._lock:
+                self.stats.evictions += evicted
+
+    def get_stats(self) -> CacheStats:
+        disk_entries = len(self.disk) if self.disk is not None else 0
+        with self._lock:
+            return CacheStats(
+                memory_hits=self.stats.memory_hits,
+                disk_hits=self.stats.disk_hits,
+                misses=self.stats.misses,
+                puts=self.stats.puts,
+                evictions=self.stats.evictions,
+                memory_entries=len(self.memory),
+                disk_entries=disk_entries,
+            )
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()
+
+
+_lock = threading.Lock()
+_cache: Optional[CompletionCache] = None
+
+
+def is_cache_enabled(settings: Settings) -> bool:
+    return settings.completion_cache_max_entries > 0
+
+
+def should_use_cache(temperature: float, use_cache: bool) -> bool:
+    # only deterministic requests are cached unless the client asks for it
+    return temperature == 0 or use_cache
+
+
+def get_cache(settings: Settings) -> CompletionCache:
+    global _cache
+    cache = _cache
+    if cache is not None:
+        return cache
+    with _lock:
+        if _cache is None:
+            _cache = CompletionCache(settings)
+        return _cache
+
+
+def get_stats() -> CacheStats:
+    cache = _cache
+    if cache is None:
+        return CacheStats()
+    return cache.get_stats()
+
+
+def _reset_after_fork() -> None:
+    # sqlite connections must not be shared with the parent process
+    global _lock, _cache
+    _lock = threading.Lock()
+    _cache = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,282 @@
+import traceback
+from dataclasses import asdict, dataclass
+from typing import List, Tuple, Union
+
+from flask import current_app
+
+from pre_chat_completion import (
+    RequestData,
+    ResponseData,
+    ResponseErrorData,
+    backends_of,
+    run_chat_completion,
+    to_error_response,
+)
+from pre_conversation_store import (
+    Conversation,
+    ConversationConflictError,
+    ConversationStoreUnavailableError,
+    Turn,
+    get_store,
+    new_conversation_id,
+)
+from pre_payload import Schema
+from pre_settings import Settings
+from pre_model import get_pre_model
+from pre_tokens import Tokenizer, get_tokenizer
+
+
+class ConversationNotFoundError(Exception):
+    pass
+
+
+@dataclass
+class CreateRequestData:
+    system_content: str
+    prompt_class: str
+    user_id: str
+    selected_model: str
+
+
+CREATE_REQUEST_SCHEMA = Schema(CreateRequestData)
+
+
+@dataclass
+class TurnRequestData:
+    user_content: str
+    temperature: float
+    use_cache: bool = False
+
+
+TURN_REQUEST_SCHEMA = Schema(TurnRequestData, bounds={"temperature": (0.0, 2.0)})
+
+
+@dataclass
+class CreateResponseData:
+    conversation_id: str
+
+
+@dataclass
+class TurnResponseData(ResponseData):
+    conversation_id: str = ""
+    # earlier messages left out of this turn's prompt
+    dropped: int = 0
+
+
+@dataclass
+class ConversationResponseData:
+    conversation_id: str
+    user_id: str
+    selected_model: str
+    prompt_class: str
+    system_content: str
+    turns: List[Turn]
+
+
+@dataclass
+class DeleteResponseData:
+    result: str
+
+
+def not_found(e: Exception) -> Tuple[ResponseErrorData, int]:
+    error_response = ResponseErrorData(error=e.__class__.__name__, detail=str(e))
+    current_app.logger.debug("error_response: %s", error_response)
+    return error_response, 404
+
+
+def unavailable(e: Exception) -> Tuple[ResponseErrorData, int]:
+    error_response = ResponseErrorData(error=e.__class__.__name__, detail=str(e))
+    current_app.logger.warning("error_response: %s", error_response)
+    return error_response, 503
+
+
+def tokenizer_of(settings: Settings, selected_model: str) -> Tokenizer:
+    # the tokenizer the pre-flight check counts this model's prompts with
+    pre_model = get_pre_model(settings.def_model)
+    model_defs = backends_of(
+        pre_model,
+        pre_model.get_group(selected_model),
+        pre_model.get_def(selected_model),
+    )
+    return get_tokenizer(model_defs[0]) if model_defs else Tokenizer()
+
+
+def get_existing(settings: Settings, conversation_id: str) -> Conversation:
+    conversation = get_store(settings).get(conversation_id)
+    if conversation is None:
+        raise ConversationNotFoundError(f"Conversation {conversation_id} not found.")
+    return conversation
+
+
+def create_conversation(
+    request_data: CreateRequestData, settings: Settings
+) -> Tuple[Union[CreateResponseData, ResponseErrorData], int]:
+    logger = current_app.logger
+    try:
+        logger.debug("- create_conversation called -")
+        logger.debug(request_data)
+
+        conversation = Conversation(
+            conversation_id=new_conversation_id(),
+            user_id=request_data.user_id,
+            selected_model=request_data.selected_model,
+            prompt_class=request_data.prompt_class,
+            system_content=request_data.system_content,
+        )
+        get_store(settings).create(conversation)
+
+        response_data = CreateResponseData(conversation_id=conversation.conversation_id)
+        logger.debug("- create_conversation return -")
+        return response_data, 201
+
+    except ConversationStoreUnavailableError as e:
+        return unavailable(e)
+
+    except Exception as e:
+        t = traceback.format_exception_only(type(e), e)
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=t[0])
+        logger.error("error_response: %s", error_response)
+        return error_response, 500
+
+
+def conversation_turn(
+    conversation_id: str, turn: TurnRequestData, settings: Settings
+) -> Tuple[Union[TurnResponseData, ResponseErrorData], int]:
+    logger = current_app.logger
+    try:
+        logger.debug("- conversation_turn called -")
+        logger.debug(turn)
+
+        store = get_store(settings)
+        conversation = get_existing(settings, conversation_id)
+        # the turns this answer follows; a second turn from the same point is
+        # a conflict before its model call
+        seq = conversation.next_seq
+        store.reserve(conversation_id, seq)
+        try:
+            return answer_turn(conversation, seq, turn, settings)
+        finally:
+            store.release(conversation_id, seq)
+
+    except ConversationNotFoundError as e:
+        return not_found(e)
+
+    except ConversationStoreUnavailableError as e:
+        return unavailable(e)
+
+    except ConversationConflictError as e:
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=str(e))
+        logger.warning("error_response: %s", error_response)
+        return error_response, 409
+
+    except Exception as e:
+        return to_error_response(e)
+
+
+def answer_turn(
+    conversation: Conversation, seq: int, turn: TurnRequestData, settings: Settings
+) -> Tuple[TurnResponseData, int]:
+    logger = current_app.logger
+    conversation_id = conversation.conversation_id
+    request_data = RequestData(
+        system_content=conversation.system_content,
+        user_content=turn.user_content,
+        temperature=turn.temperature,
+        prompt_class=conversation.prompt_class,
+        user_id=conversation.user_id,
+        selected_model=conversation.selected_model,
+        use_cache=turn.use_cache,
+    )
+    response_data, checked = run_chat_completion(
+        request_data,
+        settings,
+        conversation.turns,
+        settings.conversation_max_tokens or None,
+        {"conversation_id": conversation_id},
+    )
+
+    content = response_data.content or ""
+    completion_tokens = response_data.completion_tokens
+    if completion_tokens == 0 and content:
+        tokenizer = tokenizer_of(settings, conversation.selected_model)
+        completion_tokens = tokenizer.count(content)
+    get_store(settings).append(
+        conversation_id,
+        seq,
+        [
+            Turn(
+                "user",
+                checked.user_content,
+                checked.user_tokens,
+                response_data.qa_id,
+            ),
+            Turn("assistant", content, completion_tokens, response_data.qa_id),
+        ],
+    )
+
+    turn_response = TurnResponseData(
+        **asdict(response_data),
+        conversation_id=conversation_id,
+        dropped=checked.dropped,
+    )
+    logger.debug("- conversation_turn return -")
+    return turn_response, 200
+
+
+def get_conversation(
+    conversation_id: str, settings: Settings
+) -> Tuple[Union[ConversationResponseData, ResponseErrorData], int]:
+    logger = current_app.logger
+    try:
+        logger.debug("- get_conversation called -")
+
+        conversation = get_existing(settings, conversation_id)
+        response_data = ConversationResponseData(
+            conversation_id=conversation.conversation_id,
+            user_id=conversation.user_id,
+            selected_model=conversation.selected_model,
+            prompt_class=conversation.prompt_class,
+            system_content=conversation.system_content,
+            turns=conversation.turns,
+        )
+        logger.debug("- get_conversation return -")
+        return response_data, 200
+
+    except ConversationNotFoundError as e:
+        return not_found(e)
+
+    except ConversationStoreUnavailableError as e:
+        return unavailable(e)
+
+    except Exception as e:
+        t = traceback.format_exception_only(type(e), e)
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=t[0])
+        logger.error("error_response: %s", error_response)
+        return error_response, 500
+
+
+def delete_conversation(
+    conversation_id: str, settings: Settings
+) -> Tuple[Union[DeleteResponseData, ResponseErrorData], int]:
+    logger = current_app.logger
+    try:
+        logger.debug("- delete_conversation called -")
+
+        if not get_store(settings).delete(conversation_id):
+            raise ConversationNotFoundError(
+                f"Conversation {conversation_id} not found."
+            )
+        logger.debug("- delete_conversation return -")
+        return DeleteResponseData(result="deleted"), 200
+
+    except ConversationNotFoundError as e:
+        return not_found(e)
+
+    except ConversationStoreUnavailableError as e:
+        return unavailable(e)
+
+    except Exception as e:
+        t = traceback.format_exception_only(type(e), e)
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=t[0])
+        logger.error("error_response: %s", error_response)
+        return error_response, 500
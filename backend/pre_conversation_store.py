@@ -0,0 +1,383 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Optional
+
+from pre_settings import Settings
+
+# a turn whose worker died no longer blocks the conversation after this long
+RESERVATION_SECONDS = 600.0
+
+
+class ConversationConflictError(Exception):
+    pass
+
+
+class ConversationStoreUnavailableError(Exception):
+    pass
+
+
+@dataclass
+class Turn:
+    role: str
+    content: str
+    # counted once when the turn is added; trimming the history reuses it
+    tokens: int
+    qa_id: str
+
+
+@dataclass
+class Conversation:
+    conversation_id: str
+    user_id: str
+    selected_model: str
+    prompt_class: str
+    system_content: str
+    # the latest max_turns messages; next_seq counts every message added
+    turns: List[Turn] = field(default_factory=list)
+    next_seq: int = 0
+    updated_at: float = 0.0
+
+
+def new_conversation_id() -> str:
+    return uuid.uuid4().hex
+
+
+class DiskTier:
+    # a conversation row, and one row per message: a turn only appends rows
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS conversation ("
+            " conversation_id TEXT PRIMARY KEY,"
+            " user_id TEXT NOT NULL,"
+            " selected_model TEXT NOT NULL,"
+            " prompt_class TEXT NOT NULL,"
+            " system_content TEXT NOT NULL,"
+            " updated_at REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS conversation_updated_at"
+            " ON conversation (updated_at);"
+            "CREATE TABLE IF NOT EXISTS conversation_turn ("
+            " conversation_id TEXT NOT NULL,"
+            " seq INTEGER NOT NULL,"
+            " role TEXT NOT NULL,"
+            " content TEXT NOT NULL,"
+            " tokens INTEGER NOT NULL,"
+            " qa_id TEXT NOT NULL,"
+            " PRIMARY KEY (conversation_id, seq));"
+            # the turn being answered, one per conversation
+            "CREATE TABLE IF NOT EXISTS conversation_reservation ("
+            " conversation_id TEXT PRIMARY KEY,"
+            " seq INTEGER NOT NULL,"
+            " expires_at REAL NOT NULL);"
+        )
+        self._conn.commit()
+
+    def create(self, conversation: Conversation) -> None:
+        self._conn.execute(
+            "INSERT INTO conversation (conversation_id, user_id, selected_model,"
+            " prompt_class, system_content, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                conversation.conversation_id,
+                conversation.user_id,
+                conversation.selected_model,
+                conversation.prompt_class,
+                conversation.system_content,
+                conversation.updated_at,
+            ),
+        )
+        self._conn.commit()
+
+    def exists(self, conversation_id: str) -> bool:
+        row = self._conn.execute(
+            "SELECT 1 FROM conversation WHERE conversation_id = ?",
+            (conversation_id,),
+        ).fetchone()
+        return row is not None
+
+    def next_seq(self, conversation_id: str) -> int:
+        row = self._conn.execute(
+            "SELECT COALESCE(MAX(seq) + 1, 0) FROM conversation_turn"
+            " WHERE conversation_id = ?",
+            (conversation_id,),
+        ).fetchone()
+        return int(row[0])
+
+    def reserve(self, conversation_id: str, seq: int, now: float) -> bool:
+        # one statement: seq must still be next, and no other turn unexpired
+        with self._conn:
+            reserved = self._conn.execute(
+                "INSERT INTO conversation_reservation"
+                " (conversation_id, seq, expires_at)"
+                " SELECT ?, ?, ? WHERE (SELECT COALESCE(MAX(seq) + 1, 0)"
+                " FROM conversation_turn WHERE conversation_id = ?) = ?"
+                " ON CONFLICT (conversation_id) DO UPDATE SET"
+                " seq = excluded.seq, expires_at = excluded.expires_at"
+                " WHERE conversation_reservation.expires_at < ?",
+                (
+                    conversation_id,
+                    seq,
+                    now + RESERVATION_SECONDS,
+                    conversation_id,
+                    seq,
+                    now,
+                ),
+            ).rowcount
+        return reserved > 0
+
+    def release(self, conversation_id: str, seq: int) -> None:
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM conversation_reservation"
+                " WHERE conversation_id = ? AND seq = ?",
+                (conversation_id, seq),
+            )
+
+    def get(self, conversation_id: str, max_turns: int) -> Optional[Conversation]:
+        row = self._conn.execute(
+            "SELECT user_id, selected_model, prompt_class, system_content, updated_at"
+            " FROM conversation WHERE conversation_id = ?",
+            (conversation_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        next_seq = self.next_seq(conversation_id)
+        return Conversation(
+            conversation_id=conversation_id,
+            user_id=row[0],
+            selected_model=row[1],
+            prompt_class=row[2],
+            system_content=row[3],
+            turns=self.turns(conversation_id, next_seq - max_turns),
+            next_seq=next_seq,
+            updated_at=row[4],
+        )
+
+    def turns(self, conversation_id: str, from_seq: int) -> List[Turn]:
+        rows = self._conn.execute(
+            "SELECT role, content, tokens, qa_id FROM conversation_turn"
+            " WHERE conversation_id = ? AND seq >= ? ORDER BY seq",
+            (conversation_id, from_seq),
+        ).fetchall()
+        return [Turn(*row) for row in rows]
+
+    def append(
+        self,
+        conversation_id: str,
+        seq: int,
+        turns: List[Turn],
+        updated_at: float,
+        max_turns: int,
+    ) -> None:
+        try:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO conversation_turn"
+                    " (conversation_id, seq, role, content, tokens, qa_id)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (conversation_id, seq + i, t.role, t.content, t.tokens, t.qa_id)
+                        for i, t in enumerate(turns)
+                    ],
+                )
+                self._conn.execute(
+                    "DELETE FROM conversation_turn"
+                    " WHERE conversation_id = ? AND seq < ?",
+                    (conversation_id, seq + len(turns) - max_turns),
+                )
+                self._conn.execute(
+                    "UPDATE conversation SET updated_at = ? WHERE conversation_id = ?",
+                    (updated_at, conversation_id),
+                )
+        except sqlite3.IntegrityError as e:
+            # another worker added a turn first
+            raise ConversationConflictError(
+                f"Conversation {conversation_id} was changed by another request."
+            ) from e
+
+    def delete(self, conversation_id: str) -> bool:
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM conversation_reservation WHERE conversation_id = ?",
+                (conversation_id,),
+            )
+            self._conn.execute(
+                "DELETE FROM conversation_turn WHERE conversation_id = ?",
+                (conversation_id,),
+            )
+            deleted = self._conn.execute(
+                "DELETE FROM conversation WHERE conversation_id = ?",
+                (conversation_id,),
+            ).rowcount
+        return deleted > 0
+
+    def expire(self, before: float) -> int:
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM conversation_reservation WHERE expires_at < ?",
+                (before,),
+            )
+            self._conn.execute(
+                "DELETE FROM conversation_turn WHERE conversation_id IN"
+                " (SELECT conversation_id FROM conversation WHERE updated_at < ?)",
+                (before,),
+            )
+            return self._conn.execute(
+                "DELETE FROM conversation WHERE updated_at < ?", (before,)
+            ).rowcount
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class ConversationStore:
+    def __init__(self, settings: Settings):
+        self.max_entries = settings.conversation_max_entries
+        self.max_turns = settings.conversation_max_turns
+        self.ttl = settings.conversation_ttl
+        self.memory: OrderedDict[str, Conversation] = OrderedDict()
+        # without the disk tier: conversation_id -> seq of the turn being answered
+        self.reserved: Dict[str, int] = {}
+        self.disk: Optional[DiskTier] = None
+        if settings.conversation_file is not None:
+            self.disk = DiskTier(settings.conversation_file)
+        self._lock = threading.Lock()
+
+    def _remember(self, conversation: Conversation) -> None:
+        self.memory[conversation.conversation_id] = conversation
+        self.memory.move_to_end(conversation.conversation_id)
+        while len(self.memory) > self.max_entries:
+            # least recently used first out; the disk tier still has it
+            self.memory.popitem(last=False)
+
+    def create(self, conversation: Conversation) -> None:
+        conversation.updated_at = time.time()
+        with self._lock:
+            if self.disk is not None:
+                self.disk.expire(conversation.updated_at - self.ttl)
+                self.disk.create(conversation)
+            self._remember(conversation)
+
+    def get(self, conversation_id: str) -> Optional[Conversation]:
+        # a copy: the caller reads it while other requests may add turns
+        now = time.time()
+        with self._lock:
+            conversation = self.memory.get(conversation_id)
+            if conversation is not None and conversation.updated_at < now - self.ttl:
+                del self.memory[conversation_id]
+                conversation = None
+            if self.disk is not None:
+                if conversation is None:
+                    conversation = self.disk.get(conversation_id, self.max_turns)
+                elif not self.disk.exists(conversation_id):
+                    # deleted or expired through another worker
+                    del self.memory[conversation_id]
+                    return None
+                else:
+                    # turns added through another worker: read only those
+                    next_seq = self.disk.next_seq(conversation_id)
+                    if next_seq != conversation.next_seq:
+                        added = self.disk.turns(conversation_id, conversation.next_seq)
+                        conversation.turns = (conversation.turns + added)[
+                            -self.max_turns :
+                        ]
+                        conversation.next_seq = next_seq
+                if conversation is None or conversation.updated_at < now - self.ttl:
+                    return None
+            if conversation is None:
+                return None
+            self._remember(conversation)
+            return replace(conversation, turns=list(conversation.turns))
+
+    def reserve(self, conversation_id: str, seq: int) -> None:
+        # before the model is called: a second turn from seq is a conflict
+        with self._lock:
+            if self.disk is not None:
+                reserved = self.disk.reserve(conversation_id, seq, time.time())
+            else:
+                conversation = self.memory.get(conversation_id)
+                reserved = conversation is not None and (
+                    conversation.next_seq == seq
+                    and conversation_id not in self.reserved
+                )
+                if reserved:
+                    self.reserved[conversation_id] = seq
+            if not reserved:
+                raise ConversationConflictError(
+                    f"Conversation {conversation_id} was changed by another request."
+                )
+
+    def release(self, conversation_id: str, seq: int) -> None:
+        with self._lock:
+            if self.disk is not None:
+                self.disk.release(conversation_id, seq)
+            elif self.reserved.get(conversation_id) == seq:
+                del self.reserved[conversation_id]
+
+    def append(self, conversation_id: str, seq: int, turns: List[Turn]) -> None:
+        # seq is next_seq of the conversation the turns were made from
+        now = time.time()
+        with self._lock:
+            conversation = self.memory.get(conversation_id)
+            if conversation is not None and conversation.next_seq != seq:
+                raise ConversationConflictError(
+                    f"Conversation {conversation_id} was changed by another request."
+                )
+            if self.disk is not None:
+                self.disk.append(conversation_id, seq, turns, now, self.max_turns)
+            if conversation is None:
+                # evicted meanwhile; the disk tier (if any) has the turns
+                return
+            conversation.turns = (conversation.turns + turns)[-self.max_turns :]
+            conversation.next_seq = seq + len(turns)
+            conversation.updated_at = now
+            self.memory.move_to_end(conversation_id)
+
+    def delete(self, conversation_id: str) -> bool:
+        with self._lock:
+            deleted = self.memory.pop(conversation_id, None) is not None
+            self.reserved.pop(conversation_id, None)
+            if self.disk is not None:
+                deleted = self.disk.delete(conversation_id) or deleted
+            return deleted
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()
+
+
+_lock = threading.Lock()
+_store: Optional[ConversationStore] = None
+
+
+def get_store(settings: Settings) -> ConversationStore:
+    global _store
+    store = _store
+    if store is not None:
+        return store
+    if settings.conversation_file is None and settings.workers > 1:
+        raise ConversationStoreUnavailableError(
+            "Conversations need PRE_CONVERSATION_FILE when WEB_CONCURRENCY is"
+            " above 1: each worker process has its own memory."
+        )
+    with _lock:
+        if _store is None:
+            _store = ConversationStore(settings)
+        return _store
+
+
+def _reset_after_fork() -> None:
+    # sqlite connections must not be shared with the parent process
+    global _lock, _store
+    _lock = threading.Lock()
+    _store = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
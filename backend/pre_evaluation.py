@@ -1,3 +1,4 @@
+from sqlalchemy import Index
 from sqlalchemy.orm import (  # type: ignore[attr-defined]
     DeclarativeBase,
     Mapped,
@@ -21,6 +22,7 @@ class Evaluation(Base):
         prompt_tokens: int,
         rating: float,
         comment: str,
+        model: str = "",
     ):
         self.qa_id = qa_id
         self.lines = lines
@@ -30,11 +32,16 @@ class Evaluation(Base):
         self.prompt_tokens = prompt_tokens
         self.rating = rating
         self.comment = comment
+        self.model = model
 
     __tablename__ = "evaluation"
+    __table_args__ = (
+        Index("ix_evaluation_group", "prompt_class", "model", "temperature"),
+        Index("ix_evaluation_prompt_class_id", "prompt_class", "id"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    qa_id: Mapped[str] = mapped_column(String)
+    qa_id: Mapped[str] = mapped_column(String, index=True)
     lines: Mapped[int] = mapped_column(Integer)
     prompt_class: Mapped[str] = mapped_column(String)
     temperature: Mapped[float] = mapped_column(Float)
@@ -42,3 +49,27 @@ class Evaluation(Base):
     prompt_tokens: Mapped[int] = mapped_column(Integer)
     rating: Mapped[float] = mapped_column(Float)
     comment: Mapped[str] = mapped_column(String)
+    model: Mapped[str] = mapped_column(String, default="", server_default="")
+
+
+class EvaluationRollup(Base):
+    # aggregates per (prompt_class, model, temperature bucket of 0.1) of the
+    # evaluation rows with id <= RollupState.last_id
+    __tablename__ = "evaluation_rollup"
+
+    prompt_class: Mapped[str] = mapped_column(String, primary_key=True)
+    model: Mapped[str] = mapped_column(String, primary_key=True)
+    temperature_bucket: Mapped[int] = mapped_column(Integer, primary_key=True)
+    count: Mapped[int] = mapped_column(Integer, default=0)
+    rating_sum: Mapped[float] = mapped_column(Float, default=0.0)
+    rating_min: Mapped[float] = mapped_column(Float)
+    rating_max: Mapped[float] = mapped_column(Float)
+    completion_tokens_sum: Mapped[int] = mapped_column(Integer, default=0)
+    prompt_tokens_sum: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class RollupState(Base):
+    __tablename__ = "evaluation_rollup_state"
+
+    name: Mapped[str] = mapped_column(String, primary_key=True)
+    last_id: Mapped[int] = mapped_column(Integer, default=0)
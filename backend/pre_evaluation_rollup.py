@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Optional, Sequence, Tuple
+
+from sqlalchemy import Integer, func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.functions import GenericFunction
+
+from pre_evaluation import Evaluation, EvaluationRollup, RollupState
+
+ROLLUP_NAME = "evaluation"
+TEMPERATURE_BUCKETS_PER_UNIT = 10
+# ids are given out before commit: an id is folded into the rollup once it
+# has been the largest committed id for this long, so that the rows with
+# smaller ids of transactions open at that time have committed too
+SETTLE_SECONDS = 60.0
+
+
+class bucket_floor(GenericFunction):
+    type = Integer()
+    name = "floor"
+    inherit_cache = True
+    _register = False
+
+
+@compiles(bucket_floor, "sqlite")
+def _sqlite_floor(element: Any, compiler: Any, **kw: Any) -> str:
+    # floor() needs SQLite built with its math functions; the argument is
+    # never negative, so truncating is the same
+    return f"CAST({compiler.process(element.clauses, **kw)} AS INTEGER)"
+
+
+def temperature_bucket(temperature: Any) -> Any:
+    # 0.0-0.09.. -> 0, 0.1-0.19.. -> 1, ...; the epsilon keeps 0.3 in bucket 3
+    return bucket_floor(temperature * TEMPERATURE_BUCKETS_PER_UNIT + 1e-9)
+
+
+def bucket_to_temperature(bucket: int) -> float:
+    return round(bucket / TEMPERATURE_BUCKETS_PER_UNIT, 3)
+
+
+def aggregate(session: Session, *conditions: Any) -> Sequence[Any]:
+    # per (prompt_class, model, temperature bucket) of the matching evaluations
+    bucket = temperature_bucket(Evaluation.temperature)
+    return session.execute(
+        select(
+            Evaluation.prompt_class,
+            Evaluation.model,
+            bucket.label("temperature_bucket"),
+            func.count().label("n"),
+            func.sum(Evaluation.rating).label("rating_sum"),
+            func.min(Evaluation.rating).label("rating_min"),
+            func.max(Evaluation.rating).label("rating_max"),
+            func.sum(Evaluation.completion_tokens).label("completion_tokens_sum"),
+            func.sum(Evaluation.prompt_tokens).label("prompt_tokens_sum"),
+        )
+        .where(*conditions)
+        .group_by(Evaluation.prompt_class, Evaluation.model, bucket)
+    ).all()
+
+
+def rollup_last_id(session: Session) -> int:
+    # a query, not session.get(): another worker may have moved it meanwhile
+    last_id = session.scalar(
+        select(RollupState.last_id).where(RollupState.name == ROLLUP_NAME)
+    )
+    return last_id or 0
+
+
+_lock = threading.Lock()
+# (time first seen, largest evaluation id), oldest first
+_observed: Deque[Tuple[float, int]] = deque()
+
+
+def settled_id(max_id: int, now: float) -> Optional[int]:
+    # the largest id seen at least SETTLE_SECONDS ago, if any
+    with _lock:
+        if not _observed or _observed[-1][1] != max_id:
+            _observed.append((now, max_id))
+        settled = None
+        while _observed and _observed[0][0] <= now - SETTLE_SECONDS:
+            settled = _observed.popleft()[1]
+        return settled
+
+
+def refresh_rollups(session: Session) -> int:
+    state = session.get(RollupState, ROLLUP_NAME)
+    if state is None:
+        try:
+            session.add(RollupState(name=ROLLUP_NAME, last_id=0))
+            session.commit()
+        except IntegrityError:
+            # another worker created it first
+            session.rollback()
+        state = session.get(RollupState, ROLLUP_NAME)
+        if state is None:
+            return 0
+    last_id = state.last_id
+
+    max_id = session.scalar(select(func.max(Evaluation.id)))
+    until = None if max_id is None else settled_id(max_id, time.monotonic())
+    if until is None or until <= last_id:
+        session.rollback()
+        return 0
+
+    groups = aggregate(session, Evaluation.id > last_id, Evaluation.id <= until)
+
+    # claim the id range before applying it: a worker refreshing the same
+    # range at the same time finds last_id changed and gives up
+    claimed = session.execute(
+        update(RollupState)
+        .where(RollupState.name == ROLLUP_NAME, RollupState.last_id == last_id)
+        .values(last_id=until)
+    )
+    if claimed.rowcount != 1:  # type: ignore[attr-defined]
+        session.rollback()
+        return 0
+
+    added = 0
+    for group in groups:
+        bucket = int(group.temperature_bucket)
+        key = (group.prompt_class, group.model, bucket)
+        rollup = session.get(EvaluationRollup, key)
+        if rollup is None:
+            session.add(
+                EvaluationRollup(
+                    prompt_class=group.prompt_class,
+                    model=group.model,
+                    temperature_bucket=bucket,
+                    count=group.n,
+                    rating_sum=group.rating_sum,
+                    rating_min=group.rating_min,
+                    rating_max=group.rating_max,
+                    completion_tokens_sum=group.completion_tokens_sum,
+                    prompt_tokens_sum=group.prompt_tokens_sum,
+                )
+            )
+        else:
+            rollup.count += group.n
+            rollup.rating_sum += group.rating_sum
+            rollup.rating_min = min(rollup.rating_min, group.rating_min)
+            rollup.rating_max = max(rollup.rating_max, group.rating_max)
+            rollup.completion_tokens_sum += group.completion_tokens_sum
+            rollup.prompt_tokens_sum += group.prompt_tokens_sum
+        added += group.n
+    session.commit()
+    return added
+
+
+def _reset_after_fork() -> None:
+    global _lock
+    _lock = threading.Lock()
+    _observed.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
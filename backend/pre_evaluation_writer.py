@@ -0,0 +1,242 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import insert
+
+from pre_evaluation import Evaluation
+from pre_get_session import get_pooled_engine
+from pre_settings import Settings
+from pre_table_registry import (
+    invalidate,
+    is_missing_column_error,
+    is_missing_table_error,
+    outdated,
+)
+
+WRITE_MODE_WRITE_BEHIND = "WriteBehind"
+RETRY_INTERVAL_MAX = 30.0
+SUBMIT_TIMEOUT = 1.0
+# a replaced writer keeps taking rows this long before its final flush
+RETIRED_STOP_DELAY = 5.0
+
+
+class WriterQueueFullError(Exception):
+    pass
+
+
+class EvaluationWriter:
+    def __init__(self, settings: Settings, logger: logging.Logger):
+        self.settings = settings
+        self.logger = logger
+        self.batch_size = settings.eval_batch_size
+        self.flush_interval = settings.eval_flush_interval
+        self.spool_file = settings.eval_spool_file
+        self.queue_size = settings.eval_queue_size
+        # one item per submit: a request's rows are queued together or not at all
+        self._queue: queue.Queue[List[Dict[str, Any]]] = queue.Queue()
+        self._queued = 0
+        self._capacity = threading.Condition()
+        # rows taken from the queue but not yet committed
+        self._pending: List[Dict[str, Any]] = []
+        self._replay_file: Optional[str] = None
+        self._write_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._load_spool()
+        self._thread = threading.Thread(
+            target=self._run, name="pre-evaluation-writer", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, rows: List[Dict[str, Any]]) -> None:
+        with self._capacity:
+            if len(rows) > self.queue_size or not self._capacity.wait_for(
+                lambda: self._queued + len(rows) <= self.queue_size, SUBMIT_TIMEOUT
+            ):
+                raise WriterQueueFullError("Evaluation write queue is full.")
+            self._queued += len(rows)
+        self._queue.put(rows)
+
+    def qsize(self) -> int:
+        return self._queued + len(self._pending)
+
+    def flush(self) -> int:
+        with self._write_lock:
+            written = 0
+            while True:
+                self._fill_pending(block=False)
+                if not self._pending:
+                    return written
+                written += self._write_pending()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        try:
+            self.flush()
+        except Exception as e:
+            self.logger.error("evaluation writer: final flush failed: %s", e)
+            self._save_spool()
+
+    def _run(self) -> None:
+        retry_interval = self.flush_interval
+        while not self._stop_event.is_set():
+            try:
+                with self._write_lock:
+                    self._fill_pending(block=True)
+                    if self._pending:
+                        self._write_pending()
+                retry_interval = self.flush_interval
+            except Exception as e:
+                self.logger.error("evaluation writer: flush failed: %s", e)
+                self._stop_event.wait(retry_interval)
+                retry_interval = min(retry_interval * 2, RETRY_INTERVAL_MAX)
+
+    def _fill_pending(self, block: bool) -> None:
+        # flush when batch_size rows are collected or flush_interval has elapsed
+        deadline = time.monotonic() + self.flush_interval
+        while len(self._pending) < self.batch_size:
+            try:
+                if block:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    rows = self._queue.get(timeout=remaining)
+                else:
+                    rows = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            self._pending.extend(rows)
+            with self._capacity:
+                self._queued -= len(rows)
+                self._capacity.notify_all()
+
+    def _write_pending(self) -> int:
+        batch = self._pending[: self.batch_size]
+        engine = get_pooled_engine(self.settings)
+        try:
+            with engine.begin() as connection:
+                connection.execute(insert(Evaluation), batch)
+        except Exception as e:
+            if is_missing_column_error(e):
+                invalidate(self.settings.db_uri, Evaluation.__tablename__)
+                raise outdated(Evaluation.__tablename__, []) from e
+            if is_missing_table_error(e):
+                invalidate(self.settings.db_uri, Evaluation.__tablename__)
+            raise
+        del self._pending[: len(batch)]
+        if self._replay_file is not None and not self._pending:
+            os.remove(self._replay_file)
+            self._replay_file = None
+        self.logger.debug("evaluation writer: %s rows written", len(batch))
+        return len(batch)
+
+    def _load_spool(self) -> None:
+        if self.spool_file is None:
+            return
+        # rename first so that only one writer replays the spool; a reload
+        # can leave two writers in one process
+        replay_file = f"{self.spool_file}.{os.getpid()}.{id(self)}.replay"
+        try:
+            os.rename(self.spool_file, replay_file)
+        except FileNotFoundError:
+            return
+        with open(replay_file) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        for row in rows:
+            # spooled before evaluations recorded the model
+            row.setdefault("model", "")
+        self._pending.extend(rows)
+        self._replay_file = replay_file
+        self.logger.info("evaluation writer: %s rows loaded from spool", len(rows))
+
+    def _save_spool(self) -> None:
+        self._fill_pending(block=False)
+        if not self._pending:
+            return
+        if self.spool_file is None:
+            self.logger.error(
+                f"evaluation writer: {len(self._pending)} rows dropped "
+                "(PRE_EVAL_SPOOL_FILE is not set)"
+            )
+            return
+        with open(self.spool_file, "a") as f:
+            f.write("".join(json.dumps(row) + "\n" for row in self._pending))
+        if self._replay_file is not None:
+            os.remove(self._replay_file)
+            self._replay_file = None
+        self.logger.info(
+            "evaluation writer: %s rows saved to spool", len(self._pending)
+        )
+
+
+_lock = threading.Lock()
+_writer: Optional[EvaluationWriter] = None
+_retired: List[EvaluationWriter] = []
+
+
+def is_write_behind(settings: Settings) -> bool:
+    return settings.eval_write_mode == WRITE_MODE_WRITE_BEHIND
+
+
+def get_writer(settings: Settings, logger: logging.Logger) -> EvaluationWriter:
+    global _writer
+    with _lock:
+        if _writer is None:
+            _writer = EvaluationWriter(settings, logger)
+            _writer.start()
+        return _writer
+
+
+def replace_writer(settings: Settings, logger: logging.Logger) -> None:
+    # on reload: new rows go to a writer built from the new settings
+    global _writer
+    with _lock:
+        old = _writer
+        if old is None or settings == old.settings:
+            return
+        _writer = EvaluationWriter(settings, logger)
+        _writer.start()
+        _retired.append(old)
+
+    def stop_retired() -> None:
+        with _lock:
+            if old not in _retired:
+                return
+            _retired.remove(old)
+        old.stop()
+
+    timer = threading.Timer(RETIRED_STOP_DELAY, stop_retired)
+    timer.daemon = True
+    timer.start()
+
+
+def shutdown_writer() -> None:
+    global _writer
+    with _lock:
+        for writer in _retired:
+            writer.stop()
+        _retired.clear()
+        if _writer is not None:
+            _writer.stop()
+            _writer = None
+
+
+def _reset_after_fork() -> None:
+    # rows queued in the parent belong to the parent; the child starts empty
+    global _lock, _writer
+    _lock = threading.Lock()
+    _writer = None
+    _retired.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
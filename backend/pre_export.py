@@ -0,0 +1,579 @@
+import argparse
+import glob
+import io
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+import toml
+from flask import current_app
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.elements import ColumnElement
+
+from pre_evaluation import Evaluation
+from pre_get_session import get_session, remove_session
+from pre_qa_index import get_index, user_id_of
+from pre_qa_log import QA_LOGFILE_EXTENSION, QA_SEGMENT_EXTENSION, QA_SEGMENT_PREFIX
+from pre_response_errordata import ResponseErrorData
+from pre_settings import Settings, load_settings
+from pre_table_registry import is_table_ready
+
+try:
+    import pyarrow  # type: ignore[import-not-found, import-untyped]
+    import pyarrow.ipc  # type: ignore[import-not-found, import-untyped]
+    import pyarrow.parquet  # type: ignore[import-not-found, import-untyped]
+except ImportError:  # optional: needed only to export
+    pyarrow = None  # type: ignore[assignment]
+
+EXPORT_FORMATS = ("parquet", "arrow")
+EXPORT_EXTENSIONS = {"parquet": ".parquet", "arrow": ".arrow"}
+CHUNK_ROWS = 10000
+CHUNK_ROWS_MAX = 100000
+# QA logs younger than this may still be in a write queue: the next export
+# takes them
+SETTLE_SECONDS = 60.0
+# qa_ids per IN (...) query, below the SQLite variable limit together with
+# the evaluation gaps
+LOOKUP_BATCH = 500
+# evaluation ids not committed yet that a watermark remembers; the oldest are
+# given up first
+EVALUATION_GAPS_MAX = 200
+
+COLUMNS = [
+    ("qa_id", "string"),
+    ("user_id", "string"),
+    ("prompt_class", "string"),
+    ("selected_model", "string"),
+    ("model", "string"),
+    ("backend", "string"),
+    ("conversation_id", "string"),
+    ("fanout_id", "string"),
+    ("temperature", "float64"),
+    ("system_content", "string"),
+    ("user_content", "string"),
+    ("finish_reason", "string"),
+    ("content", "string"),
+    ("completion_tokens", "int64"),
+    ("prompt_tokens", "int64"),
+    ("evaluation_id", "int64"),
+    ("lines", "int64"),
+    ("rating", "float64"),
+    ("comment", "string"),
+]
+
+logger = logging.getLogger(__name__)
+
+
+class ExportUnavailableError(Exception):
+    pass
+
+
+@dataclass
+class Watermark:
+    # QA logs with a qa_id from qa_id on, and evaluations with an id above
+    # evaluation_id or in evaluation_gaps, are exported next time
+    qa_id: str = ""
+    evaluation_id: int = 0
+    # ids up to evaluation_id that were not committed when it was read
+    evaluation_gaps: List[int] = field(default_factory=list)
+
+
+@dataclass
+class ExportResult:
+    rows: int
+    since: Watermark
+    until: Watermark
+
+
+def arrow_schema() -> Any:
+    if pyarrow is None:
+        raise ExportUnavailableError("Exporting needs pyarrow (pip install pyarrow).")
+    return pyarrow.schema([(name, getattr(pyarrow, kind)()) for name, kind in COLUMNS])
+
+
+def qa_id_at(timestamp: float) -> str:
+    # the time part of the qa_ids made at timestamp (local time, like new_qa_id)
+    return datetime.fromtimestamp(timestamp).strftime("%Y%m%d_%H%M%S_%f")[:-3]
+
+
+def time_of(qa_id: str) -> float:
+    return datetime.strptime(qa_id[:15], "%Y%m%d_%H%M%S").timestamp()
+
+
+def export_bounds(
+    settings: Settings, session: Optional[Session], since: Watermark
+) -> Watermark:
+    # fixed before the first row is read, so rows added meanwhile are left
+    # for the next export instead of being half seen
+    now = time.time()
+    qa_id = qa_id_at(now - SETTLE_SECONDS)
+    if session is None:
+        return Watermark(qa_id, since.evaluation_id, since.evaluation_gaps)
+    evaluation_id = session.scalar(select(func.max(Evaluation.id))) or 0
+    # an id below the largest one may belong to a transaction that commits
+    # later: it is left for the next export, which takes it if it is there
+    gaps: List[int] = []
+    previous = since.evaluation_id
+    for next_id in session.scalars(
+        select(Evaluation.id)
+        .where(Evaluation.id > since.evaluation_id, Evaluation.id <= evaluation_id)
+        .order_by(Evaluation.id)
+        .execution_options(yield_per=CHUNK_ROWS)
+    ):
+        gaps.extend(range(max(previous + 1, next_id - EVALUATION_GAPS_MAX), next_id))
+        previous = next_id
+    if (
+        since.evaluation_gaps
+        and since.qa_id
+        and now - time_of(since.qa_id) < 2 * SETTLE_SECONDS
+    ):
+        # the last export ran less than SETTLE_SECONDS ago: its gaps may
+        # still be committing
+        committed = set(
+            session.scalars(
+                select(Evaluation.id).where(Evaluation.id.in_(since.evaluation_gaps))
+            )
+        )
+        gaps.extend(gap for gap in since.evaluation_gaps if gap not in committed)
+    # a rolled back transaction leaves a gap for good
+    gaps = sorted(set(gaps))[-EVALUATION_GAPS_MAX:]
+    return Watermark(qa_id, evaluation_id, gaps)
+
+
+def exported(until: Watermark) -> ColumnElement[bool]:
+    # the evaluations this export takes; the others are left for the next one
+    return and_(
+        Evaluation.id <= until.evaluation_id,
+        Evaluation.id.not_in(until.evaluation_gaps),
+    )
+
+
+def iter_logfiles(qa_log_dir: str, since: str, until: str) -> Iterator[Dict[str, Any]]:
+    # the file name is the qa_id: only the files in range are parsed
+    names = []
+    for logfile in glob.glob(os.path.join(qa_log_dir, "*" + QA_LOGFILE_EXTENSION)):
+        qa_id = os.path.basename(logfile)[: -len(QA_LOGFILE_EXTENSION)]
+        if since <= qa_id < until:
+            names.append(qa_id)
+    names.sort()
+    for qa_id in names:
+        logfile = os.path.join(qa_log_dir, qa_id + QA_LOGFILE_EXTENSION)
+        try:
+            log = toml.load(logfile)
+        except Exception as e:
+            logger.warning("skipped %s: %s", logfile, e)
+            continue
+        yield {"qa_id": qa_id, **log}
+
+
+def iter_segments(qa_log_dir: str, since: str, until: str) -> Iterator[Dict[str, Any]]:
+    since_time = time_of(since) if since else 0.0
+    for segment in sorted(
+        glob.glob(
+            os.path.join(qa_log_dir, QA_SEGMENT_PREFIX + "*" + QA_SEGMENT_EXTENSION)
+        )
+    ):
+        if os.path.getmtime(segment) < since_time:
+            # nothing was added to it since the last export
+            continue
+        with open(segment, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a segment cut short by a crash ends with a partial line
+                    continue
+                if since <= record["qa_id"] < until:
+                    yield record
+
+
+def iter_qa_logs(
+    settings: Settings, since: str, until: str
+) -> Iterator[Dict[str, Any]]:
+    if settings.qa_index_file is not None:
+        yield from get_index(settings.qa_index_file).records(since, until)
+        return
+    yield from iter_logfiles(settings.qa_log_dir, since, until)
+    yield from iter_segments(settings.qa_log_dir, since, until)
+
+
+def load_qa_logs(
+    settings: Settings, qa_ids: Iterable[str]
+) -> Dict[str, Dict[str, Any]]:
+    # QA logs of evaluations added after their QA log was exported; without
+    # an index, only <qa_id>.toml files can be found without a scan
+    found: Dict[str, Dict[str, Any]] = {}
+    for qa_id in qa_ids:
+        record = None
+        if settings.qa_index_file is not None:
+            record = get_index(settings.qa_index_file).get(qa_id)
+        elif os.sep not in qa_id:
+            logfile = os.path.join(settings.qa_log_dir, qa_id + QA_LOGFILE_EXTENSION)
+            if os.path.isfile(logfile):
+                record = {"qa_id": qa_id, **toml.load(logfile)}
+        if record is not None:
+            found[qa_id] = record
+    return found
+
+
+def evaluations_of(
+    session: Session, qa_ids: Sequence[str], until: Watermark
+) -> Dict[str, List[Evaluation]]:
+    by_qa_id: Dict[str, List[Evaluation]] = {}
+    for i in range(0, len(qa_ids), LOOKUP_BATCH):
+        for evaluation in session.scalars(
+            select(Evaluation)
+            .where(
+                Evaluation.qa_id.in_(qa_ids[i : i + LOOKUP_BATCH]),
+                exported(until),
+            )
+            .order_by(Evaluation.id)
+        ):
+            by_qa_id.setdefault(evaluation.qa_id, []).append(evaluation)
+    return by_qa_id
+
+
+def add_row(
+    columns: Dict[str, List[Any]],
+    qa_id: str,
+    record: Optional[Dict[str, Any]],
+    evaluation: Optional[Evaluation],
+) -> None:
+    qa_request: Dict[str, Any] = record["qa_request"] if record is not None else {}
+    qa_response: Dict[str, Any] = record["qa_response"] if record is not None else {}
+    contents: Dict[str, Any] = {}
+    for message in qa_request.get("messages", []):
+        # the last user message is the question; earlier ones are history
+        contents.setdefault(message.get("role"), message.get("content"))
+        if message.get("role") == "user":
+            contents["user"] = message.get("content")
+    values = {
+        "qa_id": qa_id,
+        "user_id": user_id_of(qa_id, qa_request) if record is not None else None,
+        "prompt_class": qa_request.get("prompt_class"),
+        "selected_model": qa_request.get("selected_model"),
+        "model": qa_request.get("model"),
+        "backend": qa_request.get("backend"),
+        "conversation_id": qa_request.get("conversation_id"),
+        "fanout_id": qa_request.get("fanout_id"),
+        "temperature": qa_request.get("temperature"),
+        "system_content": contents.get("system"),
+        "user_content": contents.get("user"),
+        "finish_reason": qa_response.get("finish_reason"),
+        "content": qa_response.get("content"),
+        "completion_tokens": qa_response.get("completion_tokens"),
+        "prompt_tokens": qa_response.get("prompt_tokens"),
+        "evaluation_id": None,
+        "lines": None,
+        "rating": None,
+        "comment": None,
+    }
+    if evaluation is not None:
+        values["evaluation_id"] = evaluation.id
+        values["lines"] = evaluation.lines
+        values["rating"] = evaluation.rating
+        values["comment"] = evaluation.comment
+        if record is None:
+            values["prompt_class"] = evaluation.prompt_class
+            values["selected_model"] = evaluation.model
+            values["temperature"] = evaluation.temperature
+            values["completion_tokens"] = evaluation.completion_tokens
+            values["prompt_tokens"] = evaluation.prompt_tokens
+    for name, value in values.items():
+        columns[name].append(value)
+
+
+def new_columns() -> Dict[str, List[Any]]:
+    return {name: [] for name, _ in COLUMNS}
+
+
+def iter_chunks(
+    settings: Settings,
+    session: Optional[Session],
+    since: Watermark,
+    until: Watermark,
+    chunk_rows: int,
+) -> Iterator[Dict[str, List[Any]]]:
+    # 1. new QA logs, one row per evaluation (or one row if not rated yet)
+    records: List[Dict[str, Any]] = []
+    rated: Set[str] = set()
+
+    def joined() -> Dict[str, List[Any]]:
+        columns = new_columns()
+        by_qa_id: Dict[str, List[Evaluation]] = {}
+        if session is not None:
+            by_qa_id = evaluations_of(session, [r["qa_id"] for r in records], until)
+            rated.update(by_qa_id)
+        for record in records:
+            evaluations = by_qa_id.get(record["qa_id"], [])
+            if not evaluations:
+                # not rated (yet)
+                add_row(columns, record["qa_id"], record, None)
+            for evaluation in evaluations:
+                add_row(columns, record["qa_id"], record, evaluation)
+        return columns
+
+    for record in iter_qa_logs(settings, since.qa_id, until.qa_id):
+        records.append(record)
+        if len(records) >= chunk_rows:
+            yield joined()
+            records = []
+    if records:
+        yield joined()
+    if session is None:
+        return
+
+    # 2. new evaluations of QA logs exported before, and evaluations in this
+    # qa_id range whose QA log was not found
+    after = 0
+    while True:
+        page = session.scalars(
+            select(Evaluation)
+            .where(
+                Evaluation.id > after,
+                exported(until),
+                or_(
+                    and_(
+                        Evaluation.qa_id < since.qa_id,
+                        or_(
+                            Evaluation.id > since.evaluation_id,
+                            Evaluation.id.in_(since.evaluation_gaps),
+                        ),
+                    ),
+                    and_(
+                        Evaluation.qa_id >= since.qa_id,
+                        Evaluation.qa_id < until.qa_id,
+                    ),
+                ),
+            )
+            .order_by(Evaluation.id)
+            .limit(chunk_rows)
+        ).all()
+        if not page:
+            return
+        after = page[-1].id
+        evaluations = [e for e in page if e.qa_id not in rated]
+        if not evaluations:
+            continue
+        found = load_qa_logs(settings, {e.qa_id for e in evaluations})
+        columns = new_columns()
+        for evaluation in evaluations:
+            add_row(columns, evaluation.qa_id, found.get(evaluation.qa_id), evaluation)
+        yield columns
+
+
+class ExportWriter:
+    def __init__(self, sink: Any, export_format: str):
+        self.schema = arrow_schema()
+        if export_format == "parquet":
+            self._writer = pyarrow.parquet.ParquetWriter(
+                sink, self.schema, compression="zstd"
+            )
+        else:
+            # the IPC file format, which can be memory-mapped
+            self._writer = pyarrow.ipc.new_file(sink, self.schema)
+
+    def write(self, columns: Dict[str, List[Any]]) -> int:
+        # one row group (parquet) or record batch (arrow) per chunk
+        batch = pyarrow.RecordBatch.from_pydict(columns, schema=self.schema)
+        self._writer.write_batch(batch)
+        return batch.num_rows
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+class StreamBuffer(io.RawIOBase):
+    # what the writer has written since the last take(), for a streamed
+    # response
+    def __init__(self) -> None:
+        super().__init__()
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def open_session(settings: Settings) -> Optional[Session]:
+    # without the evaluation table, the QA logs are exported alone
+    if not is_table_ready(settings, Evaluation.__tablename__):
+        return None
+    return get_session(settings)
+
+
+@dataclass
+class ExportStream:
+    until: Watermark
+    chunks: Iterator[bytes]
+
+
+def stream_chunks(
+    settings: Settings,
+    session: Optional[Session],
+    export_format: str,
+    since: Watermark,
+    until: Watermark,
+    chunk_rows: int,
+) -> Iterator[bytes]:
+    try:
+        buffer = StreamBuffer()
+        writer = ExportWriter(buffer, export_format)
+        for columns in iter_chunks(settings, session, since, until, chunk_rows):
+            writer.write(columns)
+            yield buffer.take()
+        writer.close()
+        yield buffer.take()
+    finally:
+        if session is not None:
+            remove_session()
+
+
+def export_stream(
+    settings: Settings,
+    export_format: str,
+    since: Watermark,
+    chunk_rows: int = CHUNK_ROWS,
+) -> Tuple[Union[ExportStream, ResponseErrorData], int]:
+    logger = current_app.logger
+    try:
+        logger.debug("- export_stream called -")
+        logger.debug(since)
+
+        arrow_schema()
+        session = open_session(settings)
+        until = export_bounds(settings, session, since)
+        logger.debug(until)
+
+        logger.debug("- export_stream return -")
+        return ExportStream(
+            until,
+            stream_chunks(settings, session, export_format, since, until, chunk_rows),
+        ), 200
+
+    except ExportUnavailableError as e:
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=str(e))
+        logger.warning("error_response: %s", error_response)
+        return error_response, 501
+
+    except Exception as e:
+        remove_session()
+        t = traceback.format_exception_only(type(e), e)
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=t[0])
+        logger.error("error_response: %s", error_response)
+        return error_response, 500
+
+
+def export_to_file(
+    settings: Settings,
+    export_format: str,
+    path: str,
+    since: Watermark,
+    chunk_rows: int = CHUNK_ROWS,
+) -> ExportResult:
+    arrow_schema()
+    session = open_session(settings)
+    rows = 0
+    try:
+        until = export_bounds(settings, session, since)
+        # written next to the target and renamed, so readers never see half
+        # a file
+        part = path + ".part"
+        writer = ExportWriter(part, export_format)
+        try:
+            for columns in iter_chunks(settings, session, since, until, chunk_rows):
+                rows += writer.write(columns)
+        finally:
+            writer.close()
+        os.replace(part, path)
+    finally:
+        if session is not None:
+            remove_session()
+    return ExportResult(rows=rows, since=since, until=until)
+
+
+def load_watermark(path: str) -> Watermark:
+    if not os.path.exists(path):
+        return Watermark()
+    with open(path, encoding="utf-8") as f:
+        return Watermark(**json.load(f))
+
+
+def save_watermark(path: str, watermark: Watermark) -> None:
+    with open(path + ".part", "w", encoding="utf-8") as f:
+        json.dump(asdict(watermark), f)
+        f.write("\n")
+    os.replace(path + ".part", path)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Export QA logs joined with their evaluations to a columnar file."
+    )
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="parquet")
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument(
+        "--watermark",
+        help="file with where the last export stopped"
+        " (default: <output-dir>/export_watermark.json)",
+    )
+    parser.add_argument(
+        "--full", action="store_true", help="export everything, not only new rows"
+    )
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    args = parser.parse_args(argv)
+
+    settings = load_settings()
+    watermark_file = args.watermark or os.path.join(
+        args.output_dir, "export_watermark.json"
+    )
+    since = Watermark() if args.full else load_watermark(watermark_file)
+    os.makedirs(args.output_dir, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    path = os.path.join(
+        args.output_dir, f"qa_export_{stamp}{EXPORT_EXTENSIONS[args.format]}"
+    )
+    try:
+        result = export_to_file(settings, args.format, path, since, args.chunk_rows)
+    except ExportUnavailableError as e:
+        print(e, file=sys.stderr)
+        return 1
+    save_watermark(watermark_file, result.until)
+    print(f"{result.rows} rows written to {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
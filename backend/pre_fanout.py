@@ -0,0 +1,188 @@
+import itertools
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Any, Iterator, List, Optional, Tuple, Union
+
+from flask import Flask, current_app
+
+import pre_chat_completion
+from pre_chat_completion import (
+    ResponseData,
+    ResponseErrorData,
+    run_chat_completion,
+    to_error_response,
+)
+from pre_metrics import current_endpoint, endpoint_of
+from pre_payload import PayloadError, Schema, dumps
+from pre_settings import Settings
+
+FANOUT_MAX = 16
+# calls of all fanout requests of a process running at the same time
+FANOUT_THREADS = 64
+
+
+@dataclass
+class RequestData:
+    system_content: str
+    user_content: str
+    prompt_class: str
+    user_id: str
+    models: List[str]
+    temperatures: List[float]
+    use_cache: bool = False
+
+
+REQUEST_SCHEMA = Schema(RequestData, bounds={"temperatures": (0.0, 2.0)})
+
+
+@dataclass
+class FanoutResult:
+    fanout_id: str
+    # position in models x temperatures
+    index: int
+    selected_model: str
+    temperature: float
+    status: int
+    seconds: float
+    response: Union[ResponseData, ResponseErrorData]
+
+
+@dataclass
+class FanoutStream:
+    fanout_id: str
+    lines: Iterator[bytes]
+
+
+def new_fanout_id() -> str:
+    return uuid.uuid4().hex
+
+
+def fanout_tasks(request_data: RequestData) -> List[Tuple[str, float]]:
+    tasks = list(itertools.product(request_data.models, request_data.temperatures))
+    if not tasks:
+        raise PayloadError({"body": "models and temperatures must not be empty"})
+    if len(tasks) > FANOUT_MAX:
+        raise PayloadError(
+            {"body": f"at most {FANOUT_MAX} models x temperatures, not {len(tasks)}"}
+        )
+    return tasks
+
+
+def run_one(
+    app: Flask,
+    endpoint: str,
+    settings: Settings,
+    request_data: RequestData,
+    fanout_id: str,
+    index: int,
+    model: str,
+    temperature: float,
+) -> FanoutResult:
+    with app.app_context(), endpoint_of(endpoint):
+        one = pre_chat_completion.RequestData(
+            system_content=request_data.system_content,
+            user_content=request_data.user_content,
+            temperature=temperature,
+            prompt_class=request_data.prompt_class,
+            user_id=request_data.user_id,
+            selected_model=model,
+            use_cache=request_data.use_cache,
+        )
+        start = time.perf_counter()
+        response: Union[ResponseData, ResponseErrorData]
+        try:
+            response, _ = run_chat_completion(
+                one, settings, links={"fanout_id": fanout_id}
+            )
+            status = 200
+        except Exception as e:
+            response, status = to_error_response(e)
+        return FanoutResult(
+            fanout_id=fanout_id,
+            index=index,
+            selected_model=model,
+            temperature=temperature,
+            status=status,
+            seconds=round(time.perf_counter() - start, 3),
+            response=response,
+        )
+
+
+_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=FANOUT_THREADS, thread_name_prefix="pre-fanout"
+            )
+        return _executor
+
+
+def generate(futures: List["Future[FanoutResult]"]) -> Iterator[bytes]:
+    # one JSON line per result, as soon as it is there
+    for future in as_completed(futures):
+        yield dumps(future.result()) + b"\n"
+
+
+def chat_completion_fanout(
+    request_data: RequestData,
+    settings: Settings,
+) -> Tuple[Union[FanoutStream, ResponseErrorData], int]:
+    logger = current_app.logger
+    # an invalid combination is a payload error (400), raised before any call
+    tasks = fanout_tasks(request_data)
+    try:
+        logger.debug("- chat_completion_fanout called -")
+        logger.debug(request_data)
+
+        fanout_id = new_fanout_id()
+        logger.debug("fanout_id: %s", fanout_id)
+        app: Any = current_app._get_current_object()  # type: ignore[attr-defined]
+        # every call at once, while threads are free: the answer takes as long
+        # as the slowest model
+        executor = get_executor()
+        futures = [
+            executor.submit(
+                run_one,
+                app,
+                current_endpoint(),
+                settings,
+                request_data,
+                fanout_id,
+                index,
+                model,
+                temperature,
+            )
+            for index, (model, temperature) in enumerate(tasks)
+        ]
+        # a client that goes away does not stop the calls, so every call
+        # still gets its QA log
+
+        logger.debug("- chat_completion_fanout return -")
+        return FanoutStream(fanout_id, generate(futures)), 200
+
+    except Exception as e:
+        t = traceback.format_exception_only(type(e), e)
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=t[0])
+        logger.error("error_response: %s", error_response)
+        return error_response, 500
+
+
+def _reset_after_fork() -> None:
+    # the parent's threads do not exist in the child
+    global _lock, _executor
+    _lock = threading.Lock()
+    _executor = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,371 @@
+import os
+import threading
+import traceback
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from flask import current_app
+from sqlalchemy import case, func, select
+from sqlalchemy.orm import Session
+
+from pre_evaluation import Evaluation, EvaluationRollup
+from pre_evaluation_rollup import (
+    TEMPERATURE_BUCKETS_PER_UNIT,
+    aggregate,
+    bucket_to_temperature,
+    refresh_rollups,
+    rollup_last_id,
+    temperature_bucket,
+)
+from pre_get_session import get_session, remove_session
+from pre_metrics import stage
+from pre_response_errordata import ResponseErrorData
+from pre_settings import Settings
+from pre_table_registry import TableNotFoundError, is_table_ready
+
+SUMMARY_SOURCES = ("rollup", "live")
+LIST_LIMIT_MAX = 1000
+ROLLUP_READ_ATTEMPTS = 3
+
+GroupKey = Tuple[str, str, int]
+
+
+@dataclass
+class SummaryRow:
+    prompt_class: str
+    model: str
+    temperature: float
+    count: int
+    rating_mean: float
+    rating_min: float
+    rating_max: float
+    completion_tokens: int
+    prompt_tokens: int
+    rating_p50: Optional[float] = None
+    rating_p90: Optional[float] = None
+
+
+@dataclass
+class SummaryResponseData:
+    source: str
+    rows: List[SummaryRow]
+
+
+@dataclass
+class EvaluationItem:
+    id: int
+    qa_id: str
+    lines: int
+    prompt_class: str
+    model: str
+    temperature: float
+    completion_tokens: int
+    prompt_tokens: int
+    rating: float
+    comment: str
+
+
+@dataclass
+class ListResponseData:
+    evaluations: List[EvaluationItem]
+    next_after_id: Optional[int]
+
+
+_refresh_lock = threading.Lock()
+
+
+def _refresh(session: Session) -> None:
+    # one refresh per process at a time; the others read what is there
+    if not _refresh_lock.acquire(blocking=False):
+        return
+    try:
+        refresh_rollups(session)
+    finally:
+        _refresh_lock.release()
+
+
+def _filters(columns: Any, prompt_class: Optional[str], model: Optional[str]) -> list:
+    conditions = []
+    if prompt_class is not None:
+        conditions.append(columns.prompt_class == prompt_class)
+    if model is not None:
+        conditions.append(columns.model == model)
+    return conditions
+
+
+def _rollup_rows(
+    session: Session, prompt_class: Optional[str], model: Optional[str]
+) -> List[SummaryRow]:
+    # the rollup holds the evaluations up to last_id; the newer ones are
+    # added from the evaluation table. Read again if a refresh moved last_id
+    # in between.
+    for _ in range(ROLLUP_READ_ATTEMPTS):
+        last_id = rollup_last_id(session)
+        rollups = session.execute(
+            select(
+                EvaluationRollup.prompt_class,
+                EvaluationRollup.model,
+                EvaluationRollup.temperature_bucket,
+                EvaluationRollup.count.label("n"),
+                EvaluationRollup.rating_sum,
+                EvaluationRollup.rating_min,
+                EvaluationRollup.rating_max,
+                EvaluationRollup.completion_tokens_sum,
+                EvaluationRollup.prompt_tokens_sum,
+            ).where(*_filters(EvaluationRollup, prompt_class, model))
+        ).all()
+        recent = aggregate(
+            session, Evaluation.id > last_id, *_filters(Evaluation, prompt_class, model)
+        )
+        if rollup_last_id(session) == last_id:
+            break
+
+    totals: Dict[GroupKey, List[Any]] = {}
+    for r in rollups:
+        if r.n:
+            key = (r.prompt_class, r.model, int(r.temperature_bucket))
+            totals[key] = list(r[3:])
+    for g in recent:
+        key = (g.prompt_class, g.model, int(g.temperature_bucket))
+        total = totals.get(key)
+        if total is None:
+            totals[key] = list(g[3:])
+            continue
+        total[0] += g.n
+        total[1] += g.rating_sum
+        total[2] = min(total[2], g.rating_min)
+        total[3] = max(total[3], g.rating_max)
+        total[4] += g.completion_tokens_sum
+        total[5] += g.prompt_tokens_sum
+    return [
+        SummaryRow(
+            prompt_class=key[0],
+            model=key[1],
+            temperature=bucket_to_temperature(key[2]),
+            count=count,
+            rating_mean=rating_sum / count,
+            rating_min=rating_min,
+            rating_max=rating_max,
+            completion_tokens=completion_tokens,
+            prompt_tokens=prompt_tokens,
+        )
+        for key, (
+            count,
+            rating_sum,
+            rating_min,
+            rating_max,
+            completion_tokens,
+            prompt_tokens,
+        ) in sorted(totals.items())
+    ]
+
+
+def _live_rows(
+    session: Session, prompt_class: Optional[str], model: Optional[str]
+) -> List[SummaryRow]:
+    bucket = temperature_bucket(Evaluation.temperature)
+    groups = session.execute(
+        select(
+            Evaluation.prompt_class,
+            Evaluation.model,
+            bucket.label("temperature_bucket"),
+            func.count().label("n"),
+            func.avg(Evaluation.rating).label("rating_mean"),
+            func.min(Evaluation.rating).label("rating_min"),
+            func.max(Evaluation.rating).label("rating_max"),
+            func.sum(Evaluation.completion_tokens).label("completion_tokens"),
+            func.sum(Evaluation.prompt_tokens).label("prompt_tokens"),
+        )
+        .where(*_filters(Evaluation, prompt_class, model))
+        .group_by(Evaluation.prompt_class, Evaluation.model, bucket)
+        .order_by(Evaluation.prompt_class, Evaluation.model, bucket)
+    ).all()
+    return [
+        SummaryRow(
+            prompt_class=g.prompt_class,
+            model=g.model,
+            temperature=bucket_to_temperature(g.temperature_bucket),
+            count=g.n,
+            rating_mean=g.rating_mean,
+            rating_min=g.rating_min,
+            rating_max=g.rating_max,
+            completion_tokens=g.completion_tokens,
+            prompt_tokens=g.prompt_tokens,
+        )
+        for g in groups
+    ]
+
+
+def _percentiles(
+    session: Session, prompt_class: Optional[str], model: Optional[str]
+) -> Dict[GroupKey, Tuple[float, float]]:
+    # nearest-rank percentiles: the smallest rating whose rank reaches n * p
+    bucket = temperature_bucket(Evaluation.temperature)
+    partition = (Evaluation.prompt_class, Evaluation.model, bucket)
+    ranked = (
+        select(
+            Evaluation.prompt_class,
+            Evaluation.model,
+            bucket.label("temperature_bucket"),
+            Evaluation.rating,
+            func.row_number()
+            .over(partition_by=partition, order_by=Evaluation.rating)
+            .label("rank"),
+            func.count().over(partition_by=partition).label("n"),
+        )
+        .where(*_filters(Evaluation, prompt_class, model))
+        .subquery()
+    )
+    groups = session.execute(
+        select(
+            ranked.c.prompt_class,
+            ranked.c.model,
+            ranked.c.temperature_bucket,
+            func.min(case((ranked.c.rank >= ranked.c.n * 0.5, ranked.c.rating))),
+            func.min(case((ranked.c.rank >= ranked.c.n * 0.9, ranked.c.rating))),
+        ).group_by(ranked.c.prompt_class, ranked.c.model, ranked.c.temperature_bucket)
+    ).all()
+    return {(g[0], g[1], g[2]): (g[3], g[4]) for g in groups}
+
+
+def get_evaluation_summary(
+    settings: Settings,
+    prompt_class: Optional[str] = None,
+    model: Optional[str] = None,
+    source: str = "rollup",
+    percentiles: bool = False,
+) -> Tuple[Union[SummaryResponseData, ResponseErrorData], int]:
+    logger = current_app.logger
+    session: Optional[Session] = None
+    try:
+        logger.debug("- get_evaluation_summary called -")
+
+        if source not in SUMMARY_SOURCES:
+            raise ValueError(f"source must be one of {', '.join(SUMMARY_SOURCES)}")
+        if source == "rollup" and not is_table_ready(
+            settings, EvaluationRollup.__tablename__
+        ):
+            # the schema has not been upgraded yet
+            source = "live"
+        if not is_table_ready(settings, Evaluation.__tablename__):
+            raise TableNotFoundError("Database or table does not exist.")
+
+        with stage("db_connect"):
+            session = get_session(settings)
+        with stage("query"):
+            if source == "rollup":
+                _refresh(session)
+                rows = _rollup_rows(session, prompt_class, model)
+            else:
+                rows = _live_rows(session, prompt_class, model)
+            if percentiles:
+                ranks = _percentiles(session, prompt_class, model)
+                for row in rows:
+                    key = (
+                        row.prompt_class,
+                        row.model,
+                        round(row.temperature * TEMPERATURE_BUCKETS_PER_UNIT),
+                    )
+                    if key in ranks:
+                        row.rating_p50, row.rating_p90 = ranks[key]
+
+        response_data = SummaryResponseData(source=source, rows=rows)
+        logger.debug("summary rows: %s", len(rows))
+        logger.debug("- get_evaluation_summary return -")
+        return response_data, 200
+
+    except ValueError as e:
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=str(e))
+        logger.debug("error_response: %s", error_response)
+        return error_response, 400
+
+    except Exception as e:
+        if session:
+            session.rollback()
+        t = traceback.format_exception_only(type(e), e)
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=t[0])
+        logger.error("error_response: %s", error_response)
+        return error_response, 500
+
+    finally:
+        if session:
+            remove_session()
+
+
+def get_evaluations(
+    settings: Settings,
+    prompt_class: Optional[str] = None,
+    model: Optional[str] = None,
+    after_id: int = 0,
+    limit: int = 100,
+) -> Tuple[Union[ListResponseData, ResponseErrorData], int]:
+    logger = current_app.logger
+    session: Optional[Session] = None
+    try:
+        logger.debug("- get_evaluations called -")
+
+        if not 0 < limit <= LIST_LIMIT_MAX:
+            raise ValueError(f"limit must be between 1 and {LIST_LIMIT_MAX}")
+        if not is_table_ready(settings, Evaluation.__tablename__):
+            raise TableNotFoundError("Database or table does not exist.")
+
+        with stage("db_connect"):
+            session = get_session(settings)
+        with stage("query"):
+            # keyset pagination: the cost of a page does not grow with its depth
+            evaluations = session.scalars(
+                select(Evaluation)
+                .where(
+                    Evaluation.id > after_id,
+                    *_filters(Evaluation, prompt_class, model),
+                )
+                .order_by(Evaluation.id)
+                .limit(limit)
+            ).all()
+
+        items = [
+            EvaluationItem(
+                id=e.id,
+                qa_id=e.qa_id,
+                lines=e.lines,
+                prompt_class=e.prompt_class,
+                model=e.model,
+                temperature=e.temperature,
+                completion_tokens=e.completion_tokens,
+                prompt_tokens=e.prompt_tokens,
+                rating=e.rating,
+                comment=e.comment,
+            )
+            for e in evaluations
+        ]
+        next_after_id = items[-1].id if len(items) == limit else None
+        response_data = ListResponseData(evaluations=items, next_after_id=next_after_id)
+        logger.debug("evaluations: %s", len(items))
+        logger.debug("- get_evaluations return -")
+        return response_data, 200
+
+    except ValueError as e:
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=str(e))
+        logger.debug("error_response: %s", error_response)
+        return error_response, 400
+
+    except Exception as e:
+        if session:
+            session.rollback()
+        t = traceback.format_exception_only(type(e), e)
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=t[0])
+        logger.error("error_response: %s", error_response)
+        return error_response, 500
+
+    finally:
+        if session:
+            remove_session()
+
+
+def _reset_after_fork() -> None:
+    global _refresh_lock
+    _refresh_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,60 @@
+import traceback
+from dataclasses import dataclass
+from typing import Dict, Tuple, Union
+
+from flask import current_app
+
+from pre_evaluation import Base
+from pre_lifecycle import is_draining
+from pre_response_errordata import ResponseErrorData
+from pre_settings import Settings
+from pre_table_registry import check_tables, get_status, outdated
+
+
+@dataclass
+class ResponseData:
+    status: str
+    tables: Dict[str, bool]
+
+
+def get_health(
+    settings: Settings,
+    refresh: bool = False,
+) -> Tuple[Union[ResponseData, ResponseErrorData], int]:
+    logger = current_app.logger
+    try:
+        logger.debug("- get_health called -")
+
+        if is_draining():
+            # take this worker out of the load balancer while it drains
+            return ResponseData(status="draining", tables={}), 503
+
+        table_names = list(Base.metadata.tables)
+        statuses = get_status(settings.db_uri)
+        if refresh or len(statuses) < len(table_names):
+            statuses = check_tables(settings, table_names)
+
+        tables = {status.name: status.ready for status in statuses}
+        ready = all(tables.values())
+        response_data = ResponseData(
+            status="ok" if ready else "unavailable", tables=tables
+        )
+        logger.debug(response_data)
+        logger.debug("- get_health return -")
+        return response_data, 200 if ready else 503
+
+    except Exception as e:
+        t = traceback.format_exception_only(type(e), e)
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=t[0])
+        logger.error("error_response: %s", error_response)
+        return error_response, 503
+
+
+def check_on_startup(settings: Settings) -> None:
+    for status in check_tables(settings, list(Base.metadata.tables)):
+        if status.missing_columns:
+            current_app.logger.warning(
+                "%s", outdated(status.name, status.missing_columns)
+            )
+        elif not status.ready:
+            current_app.logger.warning("table not found: %s", status.name)
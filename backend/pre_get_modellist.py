@@ -4,12 +4,20 @@ from typing import List, Tuple, Union
 
 from flask import current_app
 
-from pre_model import ModelDef, PreModel
+from pre_model import ModelDef, ModelGroup, get_pre_model, get_snapshot
+from pre_settings import Settings
 
 
 @dataclass
 class ResponseData:
     models: List[ModelDef]
+    model_groups: List[ModelGroup]
+
+
+@dataclass
+class ResponseBody:
+    body: bytes
+    etag: str
 
 
 @dataclass
@@ -18,21 +26,45 @@ class ResponseErrorData:
     detail: str
 
 
-def get_modellist() -> Tuple[Union[ResponseData, ResponseErrorData], int]:
+def get_modellist(
+    settings: Settings,
+) -> Tuple[Union[ResponseData, ResponseErrorData], int]:
     try:
         logger = current_app.logger
         logger.debug("- get_model called -")
 
-        pre_model = PreModel()
+        pre_model = get_pre_model(settings.def_model)
         models = pre_model.get_list()
 
-        response_data: ResponseData = ResponseData(models=models)
-        logger.debug(f"response_data : {response_data}")
+        response_data: ResponseData = ResponseData(
+            models=models, model_groups=pre_model.get_group_list()
+        )
+        logger.debug("response_data : %s", response_data)
         logger.debug("- get_model return -")
         return response_data, 200
 
     except Exception as e:
         t = traceback.format_exception_only(type(e), e)
         error_response = ResponseErrorData(error=e.__class__.__name__, detail=t[0])
-        logger.error(f"error_response: {error_response}")
+        logger.error("error_response: %s", error_response)
+        return error_response, 500
+
+
+def get_modellist_body(
+    settings: Settings,
+) -> Tuple[Union[ResponseBody, ResponseErrorData], int]:
+    try:
+        logger = current_app.logger
+        logger.debug("- get_modellist_body called -")
+
+        snapshot = get_snapshot(settings.def_model)
+        response_body = ResponseBody(body=snapshot.modellist_json, etag=snapshot.etag)
+        logger.debug("etag : %s", response_body.etag)
+        logger.debug("- get_modellist_body return -")
+        return response_body, 200
+
+    except Exception as e:
+        t = traceback.format_exception_only(type(e), e)
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=t[0])
+        logger.error("error_response: %s", error_response)
         return error_response, 500
@@ -0,0 +1,128 @@
+import os
+import traceback
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import toml
+from flask import current_app
+
+from pre_qa_index import SEARCH_LIMIT_MAX, QaLogSummary, get_index
+from pre_qa_log import QA_LOGFILE_EXTENSION
+from pre_response_errordata import ResponseErrorData
+from pre_settings import Settings
+
+
+class QaLogNotFoundError(Exception):
+    pass
+
+
+class QaIndexDisabledError(Exception):
+    pass
+
+
+@dataclass
+class ResponseData:
+    qa_id: str
+    qa_request: Dict[str, Any]
+    qa_response: Dict[str, Any]
+
+
+@dataclass
+class SearchResponseData:
+    qa_logs: List[QaLogSummary]
+    next_before: Optional[str]
+
+
+def read_logfile(settings: Settings, qa_id: str) -> Optional[Dict[str, Any]]:
+    if os.sep in qa_id or (os.altsep and os.altsep in qa_id):
+        return None
+    logfile = os.path.join(settings.qa_log_dir, qa_id + QA_LOGFILE_EXTENSION)
+    if not os.path.isfile(logfile):
+        return None
+    log = toml.load(logfile)
+    return {"qa_id": qa_id, **log}
+
+
+def get_qa_log(
+    settings: Settings, qa_id: str
+) -> Tuple[Union[ResponseData, ResponseErrorData], int]:
+    logger = current_app.logger
+    try:
+        logger.debug("- get_qa_log called -")
+
+        record = None
+        if settings.qa_index_file is not None:
+            record = get_index(settings.qa_index_file).get(qa_id)
+        if record is None:
+            # not indexed (yet): a <qa_id>.toml file is found without a scan
+            record = read_logfile(settings, qa_id)
+        if record is None:
+            raise QaLogNotFoundError(f"QA log {qa_id} not found.")
+
+        response_data = ResponseData(
+            qa_id=record["qa_id"],
+            qa_request=record["qa_request"],
+            qa_response=record["qa_response"],
+        )
+        logger.debug("- get_qa_log return -")
+        return response_data, 200
+
+    except QaLogNotFoundError as e:
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=str(e))
+        logger.debug("error_response: %s", error_response)
+        return error_response, 404
+
+    except Exception as e:
+        t = traceback.format_exception_only(type(e), e)
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=t[0])
+        logger.error("error_response: %s", error_response)
+        return error_response, 500
+
+
+def search_qa_logs(
+    settings: Settings,
+    text: Optional[str] = None,
+    user_id: Optional[str] = None,
+    prompt_class: Optional[str] = None,
+    model: Optional[str] = None,
+    before: Optional[str] = None,
+    limit: int = 50,
+) -> Tuple[Union[SearchResponseData, ResponseErrorData], int]:
+    logger = current_app.logger
+    try:
+        logger.debug("- search_qa_logs called -")
+
+        if settings.qa_index_file is None:
+            raise QaIndexDisabledError("QA log index is not enabled.")
+        if not 0 < limit <= SEARCH_LIMIT_MAX:
+            raise ValueError(f"limit must be between 1 and {SEARCH_LIMIT_MAX}")
+
+        qa_logs = get_index(settings.qa_index_file).search(
+            text=text,
+            user_id=user_id,
+            prompt_class=prompt_class,
+            model=model,
+            before=before,
+            limit=limit,
+        )
+        next_before = qa_logs[-1].qa_id if len(qa_logs) == limit else None
+        response_data = SearchResponseData(qa_logs=qa_logs, next_before=next_before)
+        logger.debug("qa_logs: %s", len(qa_logs))
+        logger.debug("- search_qa_logs return -")
+        return response_data, 200
+
+    except ValueError as e:
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=str(e))
+        logger.debug("error_response: %s", error_response)
+        return error_response, 400
+
+    except QaIndexDisabledError as e:
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=str(e))
+        logger.debug("error_response: %s", error_response)
+        return error_response, 503
+
+    except Exception as e:
+        t = traceback.format_exception_only(type(e), e)
+        error_response = ResponseErrorData(error=e.__class__.__name__, detail=t[0])
+        logger.error("error_response: %s", error_response)
+        return error_response, 500
@@ -1,12 +1,90 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session, sessionmaker
+import os
+import threading
+from typing import Any, Dict, Optional, Tuple
 
+from sqlalchemy import Engine, create_engine, make_url  # type: ignore[attr-defined]
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
 
-def get_session(db_uri: str) -> Session:
-    engine = create_engine(db_uri)
+from pre_settings import Settings
 
-    Session = sessionmaker(bind=engine)
+_lock = threading.Lock()
+_engine: Optional[Engine] = None
+_engine_key: Optional[Tuple[str, Tuple[Tuple[str, Any], ...]]] = None
+_engine_settings: Optional[Settings] = None
+_session_registry: Optional[scoped_session[Session]] = None
 
-    session = Session()
 
-    return session
+def get_engine_options(settings: Settings) -> Dict[str, Any]:
+    options: Dict[str, Any] = {
+        "pool_pre_ping": settings.db_pool_pre_ping,
+        "pool_recycle": settings.db_pool_recycle,
+    }
+    url = make_url(settings.db_uri)
+    # in-memory sqlite uses SingletonThreadPool, which has no size/overflow
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return options
+    options["pool_size"] = settings.db_pool_size
+    options["max_overflow"] = settings.db_max_overflow
+    return options
+
+
+def get_pooled_engine(settings: Settings) -> Engine:
+    global _engine, _engine_key, _engine_settings, _session_registry
+    engine = _engine
+    if engine is not None and _engine_settings is settings:
+        return engine
+
+    options = get_engine_options(settings)
+    key = (settings.db_uri, tuple(sorted(options.items())))
+    with _lock:
+        _engine_settings = settings
+        if _engine is not None and _engine_key == key:
+            return _engine
+        if _engine is not None:
+            if _session_registry is not None:
+                _session_registry.remove()
+            _engine.dispose()
+        _engine = create_engine(settings.db_uri, **options)
+        _engine_key = key
+        _session_registry = scoped_session(sessionmaker(bind=_engine))
+        return _engine
+
+
+def get_session(settings: Settings) -> Session:
+    get_pooled_engine(settings)
+    if _session_registry is None:
+        raise RuntimeError("Session registry is not initialized.")
+    return _session_registry()
+
+
+def remove_session() -> None:
+    if _session_registry is not None:
+        _session_registry.remove()
+
+
+def dispose_engine() -> None:
+    global _engine, _engine_key, _engine_settings, _session_registry
+    with _lock:
+        if _session_registry is not None:
+            _session_registry.remove()
+        if _engine is not None:
+            _engine.dispose()
+        _engine = None
+        _engine_key = None
+        _engine_settings = None
+        _session_registry = None
+
+
+def _reset_after_fork() -> None:
+    # The child must not reuse connections owned by the parent process.
+    # dispose(close=False) drops them from the pool without closing the sockets.
+    global _lock
+    _lock = threading.Lock()
+    if _session_registry is not None:
+        _session_registry.registry.clear()
+    if _engine is not None:
+        _engine.dispose(close=False)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,58 @@
+import os
+import threading
+import time
+
+_cond = threading.Condition()
+_in_flight = 0
+_draining = False
+
+
+def is_draining() -> bool:
+    return _draining
+
+
+def start_drain() -> None:
+    # called from signal handlers: only set the flag, take no lock
+    global _draining
+    _draining = True
+
+
+def request_started() -> None:
+    global _in_flight
+    with _cond:
+        _in_flight += 1
+
+
+def request_finished() -> None:
+    global _in_flight
+    with _cond:
+        _in_flight -= 1
+        if _in_flight <= 0:
+            _cond.notify_all()
+
+
+def in_flight() -> int:
+    return _in_flight
+
+
+def wait_idle(timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    with _cond:
+        while _in_flight > 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            _cond.wait(remaining)
+    return True
+
+
+def _reset_after_fork() -> None:
+    # requests in flight in the parent are not this process's to wait for
+    global _cond, _in_flight, _draining
+    _cond = threading.Condition()
+    _in_flight = 0
+    _draining = False
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
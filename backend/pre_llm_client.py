@@ -0,0 +1,146 @@
+import asyncio
+import os
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+
+from openai import AsyncAzureOpenAI, AsyncOpenAI, AzureOpenAI, OpenAI
+
+from pre_model import ModelDef
+from pre_settings import Settings
+
+# the longest an in-flight request may still use a replaced client (the
+# default timeout of the OpenAI clients)
+RETIRED_CLOSE_DELAY = 600.0
+
+ClientKey = Tuple[str, Optional[str], str, Optional[str]]
+AsyncClient = Union[AsyncAzureOpenAI, AsyncOpenAI]
+
+_lock = threading.Lock()
+_clients: Dict[ClientKey, Union[AzureOpenAI, OpenAI]] = {}
+# async clients and the event loop their connections belong to
+_async_clients: Dict[ClientKey, Tuple[AsyncClient, asyncio.AbstractEventLoop]] = {}
+
+
+def client_key(model_def: ModelDef) -> ClientKey:
+    return (
+        model_def.llm_service,
+        model_def.azure_endpoint,
+        model_def.api_key,
+        model_def.api_version,
+    )
+
+
+def _check_model_def(model_def: ModelDef) -> None:
+    if model_def.llm_service == "Azure":
+        if model_def.azure_endpoint is None:
+            raise Exception("azure_endpoint is None")
+    elif model_def.llm_service != "OpenAI":
+        raise Exception("invalid llm_service")
+
+
+# retries are made by pre_admission.call_with_retries, not by the clients
+def get_client(model_def: ModelDef) -> Union[AzureOpenAI, OpenAI]:
+    key = client_key(model_def)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    _check_model_def(model_def)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            api_key = os.environ.get(model_def.api_key)
+            if model_def.llm_service == "Azure":
+                client = AzureOpenAI(
+                    api_key=api_key,
+                    max_retries=0,
+                    api_version=model_def.api_version,
+                    azure_endpoint=model_def.azure_endpoint,  # type: ignore[arg-type]
+                )
+            else:
+                client = OpenAI(api_key=api_key, max_retries=0)
+            _clients[key] = client
+        return client
+
+
+def get_async_client(model_def: ModelDef) -> AsyncClient:
+    # for the event loop of the ASGI server (asgi.py): one worker process
+    # serves all its requests on one loop
+    key = client_key(model_def)
+    loop = asyncio.get_running_loop()
+    entry = _async_clients.get(key)
+    if entry is not None and entry[1] is loop:
+        return entry[0]
+
+    _check_model_def(model_def)
+    with _lock:
+        entry = _async_clients.get(key)
+        if entry is None or entry[1] is not loop:
+            api_key = os.environ.get(model_def.api_key)
+            client: AsyncClient
+            if model_def.llm_service == "Azure":
+                client = AsyncAzureOpenAI(
+                    api_key=api_key,
+                    max_retries=0,
+                    api_version=model_def.api_version,
+                    azure_endpoint=model_def.azure_endpoint,  # type: ignore[arg-type]
+                )
+            else:
+                client = AsyncOpenAI(api_key=api_key, max_retries=0)
+            entry = (client, loop)
+            _async_clients[key] = entry
+        return entry[0]
+
+
+def _close_async(
+    async_clients: List[Tuple[AsyncClient, asyncio.AbstractEventLoop]],
+) -> None:
+    # an async client is closed on its own loop, if that still runs
+    for client, loop in async_clients:
+        if loop.is_running():
+            asyncio.run_coroutine_threadsafe(client.close(), loop)
+
+
+def close_clients() -> None:
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+        async_clients = list(_async_clients.values())
+        _async_clients.clear()
+    for client in clients:
+        client.close()
+    _close_async(async_clients)
+
+
+def drop_clients(settings: Optional[Settings] = None) -> None:
+    # new requests get new clients (e.g. after an API key change); the old
+    # ones are closed once the requests still using them have had time to
+    # finish, so their connection pools are not left open
+    with _lock:
+        retired = list(_clients.values())
+        _clients.clear()
+        retired_async = list(_async_clients.values())
+        _async_clients.clear()
+    if not retired and not retired_async:
+        return
+
+    def close_retired() -> None:
+        for client in retired:
+            client.close()
+        _close_async(retired_async)
+
+    timer = threading.Timer(RETIRED_CLOSE_DELAY, close_retired)
+    timer.daemon = True
+    timer.start()
+
+
+def _reset_after_fork() -> None:
+    # connection pools are not usable in a forked child
+    global _lock
+    _lock = threading.Lock()
+    _clients.clear()
+    _async_clients.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
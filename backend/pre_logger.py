@@ -1,10 +1,20 @@
+import atexit
 import logging
 import logging.handlers
+import os
+import queue
+import threading
+from typing import Dict
+
+from pre_settings import LOG_LEVELS
 
 LOGFILE_EXTENSION = ".log"
 LOGFILE_MAXBYTES = 800000
 LOGFILE_BACKUPCOUNT = 8
 
+LOG_FORMAT = "%(asctime)s.%(msecs)03d %(levelname)-8s %(name)-8s %(message)s"
+LOG_DATEFMT = "%Y%m%d %H:%M:%S"
+
 mapping = {
     "DEBUG": "\x1b[0;36m",  # Cyan
     "INFO": "\x1b[0;32m",  # Green
@@ -15,40 +25,103 @@ mapping = {
 
 
 class CustomFormatter(logging.Formatter):
-    def format(self, record):
-        log_color = mapping.get(record.levelname, "\x1b[0m")  # Default to no color
+    def __init__(self) -> None:
+        super().__init__()
         reset_color = "\x1b[0m"
+        self._formatters: Dict[str, logging.Formatter] = {}
+        for levelname, log_color in [*mapping.items(), ("", reset_color)]:
+            self._formatters[levelname] = logging.Formatter(
+                f"{log_color}%(asctime)s.%(msecs)03d %(levelname)-8s %(name)-8s {reset_color}%(message)s",
+                datefmt=LOG_DATEFMT,
+            )
 
-        formatted_message = f"{log_color}%(asctime)s.%(msecs)03d %(levelname)-8s %(name)-8s {reset_color}%(message)s"
-
-        formatter = logging.Formatter(
-            formatted_message,
-            datefmt="%Y%m%d %H:%M:%S",
-        )
+    def format(self, record: logging.LogRecord) -> str:
+        # Default to no color
+        formatter = self._formatters.get(record.levelname) or self._formatters[""]
         return formatter.format(record)
 
 
-def pre_logger(module_name: str, log_dir: str) -> logging.Logger:
-    logger = logging.getLogger(module_name)
-    logger.handlers.clear()
+_lock = threading.Lock()
+# logger name -> where its log file goes, without the extension
+_logfiles: Dict[str, str] = {}
+_listeners: Dict[str, logging.handlers.QueueListener] = {}
+
 
+def _attach(logger: logging.Logger, logfile: str) -> logging.handlers.QueueListener:
     stream_handler = logging.StreamHandler()
-    logfile = log_dir + module_name + LOGFILE_EXTENSION
     file_handler = logging.handlers.RotatingFileHandler(
         logfile, maxBytes=LOGFILE_MAXBYTES, backupCount=LOGFILE_BACKUPCOUNT
     )
-    formatter = logging.Formatter(
-        "%(asctime)s.%(msecs)03d %(levelname)-8s %(name)-8s %(message)s",
-        datefmt="%Y%m%d %H:%M:%S",
-    )
+    formatter = logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT)
     stream_handler.setFormatter(CustomFormatter())
     file_handler.setFormatter(formatter)
 
-    logger.setLevel(logging.DEBUG)
     stream_handler.setLevel(logging.INFO)
     file_handler.setLevel(logging.DEBUG)
 
-    logger.addHandler(stream_handler)
-    logger.addHandler(file_handler)
+    # request threads only enqueue records; formatting, console output and
+    # file rotation happen on the listener thread
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        log_queue, stream_handler, file_handler, respect_handler_level=True
+    )
+    listener.start()
+
+    logger.handlers.clear()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    return listener
+
+
+def pre_logger(module_name: str, log_dir: str, level: str = "DEBUG") -> logging.Logger:
+    logger = logging.getLogger(module_name)
+    logger.setLevel(level)
+
+    with _lock:
+        previous = _listeners.pop(module_name, None)
+        if previous is not None:
+            previous.stop()
+        _logfiles[module_name] = log_dir + module_name
+        _listeners[module_name] = _attach(
+            logger, _logfiles[module_name] + LOGFILE_EXTENSION
+        )
 
     return logger
+
+
+def set_level(logger: logging.Logger, level: str) -> None:
+    if level not in LOG_LEVELS:
+        raise ValueError(f"level must be one of {LOG_LEVELS}, not {level!r}")
+    logger.setLevel(level)
+
+
+def get_level(logger: logging.Logger) -> str:
+    return logging.getLevelName(logger.getEffectiveLevel())
+
+
+def stop_listeners() -> None:
+    # drains the queues so nothing logged before shutdown is lost
+    with _lock:
+        for listener in _listeners.values():
+            listener.stop()
+        _listeners.clear()
+
+
+def _restart_after_fork() -> None:
+    # the listener threads were not copied into the child, and a file
+    # rotated by several processes is renamed under the others: each child
+    # gets its own queue, listener and log file
+    global _lock
+    _lock = threading.Lock()
+    for module_name, listener in list(_listeners.items()):
+        for handler in listener.handlers:
+            handler.close()
+        _listeners[module_name] = _attach(
+            logging.getLogger(module_name),
+            f"{_logfiles[module_name]}.{os.getpid()}{LOGFILE_EXTENSION}",
+        )
+
+
+atexit.register(stop_listeners)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_after_fork)
@@ -0,0 +1,316 @@
+import bisect
+import json
+import os
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from flask import current_app, g, has_request_context, request
+
+LabelValues = Tuple[str, ...]
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    # every sample names its worker process: each keeps its own counts, and
+    # a scrape is answered by whichever worker takes it
+    pairs = "".join(f',{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + f'pid="{os.getpid()}"' + pairs + "}"
+
+
+class Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    @abstractmethod
+    def _samples(self) -> List[str]: ...
+
+    @abstractmethod
+    def reset(self) -> None: ...
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labelnames, k)} {v:g}" for k, v in items
+        ]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1.0) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # per label set: bucket counts (last one is +Inf), sum
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = ([0] * (len(self.buckets) + 1), [0.0])
+                self._values[labels] = entry
+            entry[0][i] += 1
+            entry[1][0] += value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, (list(c), s[0])) for k, (c, s) in self._values.items())
+        lines = []
+        names = (*self.labelnames, "le")
+        for labels, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(names, (*labels, le))} {cumulative}"
+                )
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {total:g}")
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        for metric in self.metrics:
+            metric.reset()
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = Histogram(
+    "qae_request_seconds",
+    "Time spent handling a request.",
+    ("endpoint", "status"),
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "qae_requests_in_flight",
+    "Requests currently being handled.",
+    ("endpoint",),
+)
+STAGE_SECONDS = Histogram(
+    "qae_stage_seconds",
+    "Time spent in each stage of a request.",
+    ("endpoint", "stage"),
+)
+UPSTREAM_REQUESTS = Counter(
+    "qae_upstream_requests_total",
+    "Requests sent to the LLM service.",
+    ("model",),
+)
+UPSTREAM_ERRORS = Counter(
+    "qae_upstream_errors_total",
+    "Failed requests to the LLM service.",
+    ("model", "error"),
+)
+ROUTER_EVENTS = Counter(
+    "qae_router_events_total",
+    "Hedged requests, failovers and ejections within model groups.",
+    ("group", "model", "event"),
+)
+COST = Counter(
+    "qae_cost_total",
+    "Cost of the tokens reported by the LLM service, at the model's prices.",
+    ("model", "prompt_class"),
+)
+TOKENS = Counter(
+    "qae_tokens_total",
+    "Tokens reported by the LLM service.",
+    ("model", "prompt_class", "kind"),
+)
+
+for _metric in (
+    REQUEST_SECONDS,
+    REQUESTS_IN_FLIGHT,
+    STAGE_SECONDS,
+    UPSTREAM_REQUESTS,
+    UPSTREAM_ERRORS,
+    ROUTER_EVENTS,
+    TOKENS,
+    COST,
+):
+    REGISTRY.register(_metric)
+
+_sample_rate = 0.0
+_local = threading.local()
+
+
+def set_sample_rate(rate: float) -> None:
+    global _sample_rate
+    _sample_rate = rate
+
+
+def current_endpoint() -> str:
+    if has_request_context():
+        return request.endpoint or ""
+    return getattr(_local, "endpoint", "")
+
+
+@contextmanager
+def endpoint_of(endpoint: str) -> Iterator[None]:
+    # for threads a request starts: their stages count under its endpoint
+    previous = getattr(_local, "endpoint", "")
+    _local.endpoint = endpoint
+    try:
+        yield
+    finally:
+        _local.endpoint = previous
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, current_endpoint(), name)
+        if has_request_context():
+            stages: Optional[Dict[str, float]] = g.get("pre_metrics_stages")
+            if stages is not None:
+                stages[name] = stages.get(name, 0.0) + elapsed
+
+
+def count_tokens(
+    model: str, prompt_class: str, prompt_tokens: int, completion_tokens: int
+) -> None:
+    TOKENS.inc(model, prompt_class, "prompt", amount=prompt_tokens)
+    TOKENS.inc(model, prompt_class, "completion", amount=completion_tokens)
+
+
+def count_cost(model: str, prompt_class: str, cost: float) -> None:
+    COST.inc(model, prompt_class, amount=cost)
+
+
+def before_request() -> None:
+    g.pre_metrics_start = time.perf_counter()
+    g.pre_metrics_stages = {}
+    REQUESTS_IN_FLIGHT.inc(current_endpoint())
+
+
+def after_request(status_code: int) -> None:
+    g.pre_metrics_status = status_code
+
+
+def teardown_request() -> None:
+    # after the response is sent, the last chunk of a streamed one included
+    start: Optional[float] = g.get("pre_metrics_start")
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    endpoint = current_endpoint()
+    # no response was made if the request failed outside the error handlers
+    status_code = g.get("pre_metrics_status", 500)
+    REQUESTS_IN_FLIGHT.dec(endpoint)
+    REQUEST_SECONDS.observe(elapsed, endpoint, str(status_code))
+    g.pre_metrics_start = None
+    if _sample_rate > 0 and random.random() < _sample_rate:
+        current_app.logger.info(
+            "request_metrics %s",
+            json.dumps(
+                {
+                    "endpoint": endpoint,
+                    "status": status_code,
+                    "seconds": round(elapsed, 6),
+                    "stages": {k: round(v, 6) for k, v in g.pre_metrics_stages.items()},
+                }
+            ),
+        )
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+def _reset_after_fork() -> None:
+    # a worker reports only its own requests
+    for metric in REGISTRY.metrics:
+        metric._lock = threading.Lock()
+    REGISTRY.reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
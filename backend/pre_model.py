@@ -1,10 +1,14 @@
+import hashlib
 import os
-from dataclasses import dataclass, field
-from typing import List, Optional
+import threading
+from dataclasses import InitVar, dataclass, field
+from typing import Any, Dict, List, Optional
 
 import toml
 from dotenv import load_dotenv
 
+from pre_payload import dumps
+
 
 @dataclass
 class ModelDef:
@@ -14,6 +18,23 @@ class ModelDef:
     api_key: str
     api_version: Optional[str] = None
     azure_endpoint: Optional[str] = None
+    # admission control: requests and tokens per minute, concurrent requests
+    rpm: Optional[int] = None
+    tpm: Optional[int] = None
+    max_concurrency: Optional[int] = None
+    max_queue: int = 100
+    queue_timeout: float = 10.0
+    max_retries: int = 2
+    # prompt pre-flight: tokens of prompt and answer together, the part kept
+    # for the answer, and whether a longer prompt is rejected or truncated
+    context_window: Optional[int] = None
+    completion_reserve: int = 0
+    prompt_overflow: str = "reject"
+    # tiktoken encoding, looked up by deployment_name if not set
+    encoding: Optional[str] = None
+    # per million tokens
+    prompt_price: Optional[float] = None
+    completion_price: Optional[float] = None
 
     def __post_init__(self):
         if self.llm_service == "Azure":
@@ -21,23 +42,62 @@ class ModelDef:
                 raise ValueError("api_version is required")
             if not self.azure_endpoint:
                 raise ValueError("azure_endpoint is required")
+        if self.prompt_overflow not in ("reject", "truncate"):
+            raise ValueError('prompt_overflow must be "reject" or "truncate"')
+
+
+@dataclass
+class ModelGroup:
+    # one logical model served by equivalent deployments (the member models)
+    name: str
+    members: List[str]
+    # start a second request on another member when the first has not
+    # answered after the hedge_percentile latency of its backend, or after
+    # hedge_delay seconds until enough latencies are known
+    hedge_percentile: Optional[float] = None
+    hedge_delay: Optional[float] = None
+    # members tried per request, all of them if not set
+    max_attempts: Optional[int] = None
+    # circuit breaker: eject a member after failure_threshold failures in a
+    # row, try it again after open_seconds
+    failure_threshold: int = 5
+    open_seconds: float = 30.0
+
+    def __post_init__(self):
+        if not self.members:
+            raise ValueError(f"model_group {self.name}: members is empty")
+        if self.hedge_percentile is not None and not 0 < self.hedge_percentile < 100:
+            raise ValueError(
+                f"model_group {self.name}: hedge_percentile must be between 0 and 100"
+            )
 
 
 @dataclass
 class PreModel:
     models: List[ModelDef] = field(default_factory=list)
+    groups: List[ModelGroup] = field(default_factory=list)
+    index: Dict[str, ModelDef] = field(default_factory=dict, init=False, repr=False)
+    group_index: Dict[str, ModelGroup] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    load: InitVar[bool] = True
 
-    def __post_init__(self):
-        load_dotenv()
-        def_file = os.environ.get("PRE_DEF_MODEL")
-        if def_file is None:
-            raise Exception("PRE_DEF_MODEL not defined")
-        self.load_from_toml(def_file)
+    def __post_init__(self, load: bool):
+        if load:
+            load_dotenv()
+            def_file = os.environ.get("PRE_DEF_MODEL")
+            if def_file is None:
+                raise Exception("PRE_DEF_MODEL not defined")
+            self.load_from_toml(def_file)
+        self.build_index()
 
     def load_from_toml(self, file_path: str) -> None:
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"{file_path} dose not exist.")
         data = toml.load(file_path)
+        self.load_from_dict(data)
+
+    def load_from_dict(self, data: Dict[str, Any]) -> None:
         model_data_list = data.get("model", [])
 
         for model_data in model_data_list:
@@ -52,11 +112,129 @@ class PreModel:
                 )
             self.models.append(ModelDef(**model_data))
 
-    def get_def(self, model_name: str, key: Optional[str] = None) -> Optional[ModelDef]:
+        for group_data in data.get("model_group", []):
+            missing_fields = [
+                field for field in ["name", "members"] if field not in group_data
+            ]
+            if missing_fields:
+                raise ValueError(
+                    f"Missing required fields in model_group definition : {', '.join(missing_fields)}"
+                )
+            self.groups.append(ModelGroup(**group_data))
+
+    def build_index(self) -> None:
+        self.index = {}
         for model in self.models:
-            if model.name == model_name:
-                return model
-        return None
+            # the first definition of a name wins, as with the former linear scan
+            self.index.setdefault(model.name, model)
+        self.group_index = {}
+        for group in self.groups:
+            if group.name in self.index:
+                raise ValueError(f"model_group {group.name}: name is used by a model")
+            unknown = [name for name in group.members if name not in self.index]
+            if unknown:
+                raise ValueError(
+                    f"model_group {group.name}: unknown members: {', '.join(unknown)}"
+                )
+            self.group_index.setdefault(group.name, group)
+
+    def get_def(self, model_name: str, key: Optional[str] = None) -> Optional[ModelDef]:
+        return self.index.get(model_name)
+
+    def get_group(self, group_name: str) -> Optional[ModelGroup]:
+        return self.group_index.get(group_name)
 
     def get_list(self) -> List[ModelDef]:
         return self.models
+
+    def get_group_list(self) -> List[ModelGroup]:
+        return self.groups
+
+
+@dataclass(frozen=True)
+class ModelRegistrySnapshot:
+    pre_model: PreModel
+    def_file: str
+    mtime_ns: int
+    size: int
+    digest: str
+    modellist_json: bytes
+
+    @property
+    def etag(self) -> str:
+        return self.digest
+
+
+_lock = threading.Lock()
+_snapshot: Optional[ModelRegistrySnapshot] = None
+
+
+def _build_snapshot(def_file: str, st: os.stat_result) -> ModelRegistrySnapshot:
+    with open(def_file, "rb") as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest()
+    current = _snapshot
+    if current is not None and current.def_file == def_file:
+        if current.digest == digest:
+            # touched but unchanged: keep the parsed table, remember the new stat
+            return ModelRegistrySnapshot(
+                pre_model=current.pre_model,
+                def_file=def_file,
+                mtime_ns=st.st_mtime_ns,
+                size=st.st_size,
+                digest=digest,
+                modellist_json=current.modellist_json,
+            )
+
+    pre_model = PreModel(load=False)
+    pre_model.load_from_dict(toml.loads(content.decode("utf-8")))
+    pre_model.build_index()
+    # same bytes as jsonify(ResponseData(models=...)) with pre_payload installed
+    modellist_json = (
+        dumps({"models": pre_model.models, "model_groups": pre_model.groups}) + b"\n"
+    )
+    return ModelRegistrySnapshot(
+        pre_model=pre_model,
+        def_file=def_file,
+        mtime_ns=st.st_mtime_ns,
+        size=st.st_size,
+        digest=digest,
+        modellist_json=modellist_json,
+    )
+
+
+def get_snapshot(def_file: Optional[str] = None) -> ModelRegistrySnapshot:
+    global _snapshot
+    if def_file is None:
+        def_file = os.environ.get("PRE_DEF_MODEL")
+        if def_file is None:
+            raise Exception("PRE_DEF_MODEL not defined")
+    if not os.path.exists(def_file):
+        raise FileNotFoundError(f"{def_file} dose not exist.")
+
+    st = os.stat(def_file)
+    snapshot = _snapshot
+    if (
+        snapshot is not None
+        and snapshot.def_file == def_file
+        and snapshot.mtime_ns == st.st_mtime_ns
+        and snapshot.size == st.st_size
+    ):
+        return snapshot
+
+    with _lock:
+        snapshot = _snapshot
+        if (
+            snapshot is None
+            or snapshot.def_file != def_file
+            or snapshot.mtime_ns != st.st_mtime_ns
+            or snapshot.size != st.st_size
+        ):
+            # readers keep using the old snapshot until this assignment
+            snapshot = _build_snapshot(def_file, st)
+            _snapshot = snapshot
+        return snapshot
+
+
+def get_pre_model(def_file: Optional[str] = None) -> PreModel:
+    return get_snapshot(def_file).pre_model
@@ -1,72 +1,243 @@
+import asyncio
 import json
-from unittest.mock import MagicMock
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple, Type
 
+import httpx
+import toml
 from flask import current_app
+from openai import APIStatusError, InternalServerError, RateLimitError
 from openai.types.chat import (
     ChatCompletion,
+    ChatCompletionChunk,
 )
 
+from pre_settings import Settings
 
-def get_response(
-    loadfile: str,
-) -> ChatCompletion:
-    logger = current_app.logger
-    logger.debug("-- pre_openai_mock get_response called --")
-    logger.debug(f"   loadfile: {loadfile}")
-
-    response = MagicMock()
-    with open(loadfile) as file:
-        try:
-            res_mockdata = file.read()
-        except Exception:
-            pass
-
-    res_mockdata_json = json.loads(res_mockdata)
-
-    response.id = res_mockdata_json["id"]
-    logger.debug(f"   id: {response.id}")
-    response.choices[0].finish_reason = res_mockdata_json["choices"][0]["finish_reason"]
-    logger.debug(f"   choices[0].finish_reason: {response.choices[0].finish_reason}")
-    response.choices[0].index = res_mockdata_json["choices"][0]["index"]
-    logger.debug(f"   choices[0].index: {response.choices[0].index}")
-    response.choices[0].logprobs = res_mockdata_json["choices"][0]["logprobs"]
-    logger.debug(f"   choices[0].logprobs: {response.choices[0].logprobs}")
-    response.choices[0].message.content = res_mockdata_json["choices"][0]["message"][
-        "content"
-    ]
-    logger.debug(
-        f"   choices[0].message.content: {response.choices[0].message.content}"
-    )
-    response.choices[0].message.role = res_mockdata_json["choices"][0]["message"][
-        "role"
+MOCK_URL = "http://mock.invalid/chat/completions"
+
+
+@dataclass
+class FixtureRule:
+    file: str
+    model: Optional[str] = None
+    prompt_class: Optional[str] = None
+
+    def matches(self, model: str, prompt_class: str) -> bool:
+        return (self.model is None or self.model == model) and (
+            self.prompt_class is None or self.prompt_class == prompt_class
+        )
+
+
+@dataclass
+class MockProfile:
+    # seconds before the first token, +/- latency_jitter
+    latency: float = 0.0
+    latency_jitter: float = 0.0
+    # completion tokens generated per second; 0 returns them all at once
+    tokens_per_second: float = 0.0
+    # share of requests answered with an API error of error_status
+    error_rate: float = 0.0
+    error_status: int = 500
+    retry_after: Optional[float] = None
+    fixtures: List[FixtureRule] = field(default_factory=list)
+    # [[model_profile]]: the settings above for one model, e.g. to play
+    # several members of a model group that behave differently
+    models: Dict[str, "MockProfile"] = field(default_factory=dict)
+
+    def for_model(self, model: str) -> "MockProfile":
+        return self.models.get(model, self)
+
+    def first_token_delay(self) -> float:
+        jitter = random.uniform(-self.latency_jitter, self.latency_jitter)
+        return max(0.0, self.latency + jitter)
+
+    def generation_time(self, completion_tokens: int) -> float:
+        if self.tokens_per_second <= 0:
+            return 0.0
+        return completion_tokens / self.tokens_per_second
+
+    def select_fixture(self, model: str, prompt_class: str) -> Optional[str]:
+        for rule in self.fixtures:
+            if rule.matches(model, prompt_class):
+                return rule.file
+        return None
+
+
+def load_profile(profile_file: str) -> MockProfile:
+    profile_toml = toml.load(profile_file)
+    base_dir = os.path.dirname(profile_file)
+    fixtures = [
+        FixtureRule(
+            file=os.path.join(base_dir, rule["file"]),
+            model=rule.get("model"),
+            prompt_class=rule.get("prompt_class"),
+        )
+        for rule in profile_toml.get("fixture", [])
     ]
-    logger.debug(f"   choices[0].message.role: {response.choices[0].message.role}")
-    response.choices[0].message.function_call = res_mockdata_json["choices"][0][
-        "message"
-    ]["function_call"]
-    logger.debug(
-        f"   choices[0].message.function_call: {response.choices[0].message.function_call}"
+    base = profile_toml.get("profile", {})
+    models = {}
+    for model_profile in profile_toml.get("model_profile", []):
+        overrides = {k: v for k, v in model_profile.items() if k != "model"}
+        models[model_profile["model"]] = MockProfile(
+            **{**base, **overrides}, fixtures=fixtures
+        )
+    return MockProfile(**base, fixtures=fixtures, models=models)
+
+
+_lock = threading.Lock()
+_profiles: Dict[Optional[str], MockProfile] = {}
+_fixtures: Dict[str, ChatCompletion] = {}
+
+
+def get_profile(settings: Settings) -> MockProfile:
+    profile = _profiles.get(settings.mock_profile_file)
+    if profile is not None:
+        return profile
+    with _lock:
+        profile = _profiles.get(settings.mock_profile_file)
+        if profile is None:
+            if settings.mock_profile_file is None:
+                profile = MockProfile()
+            else:
+                profile = load_profile(settings.mock_profile_file)
+            _profiles[settings.mock_profile_file] = profile
+        return profile
+
+
+def get_fixture(loadfile: str) -> ChatCompletion:
+    # parsed once per file; the same immutable object serves every request
+    fixture = _fixtures.get(loadfile)
+    if fixture is not None:
+        return fixture
+    with _lock:
+        fixture = _fixtures.get(loadfile)
+        if fixture is None:
+            with open(loadfile) as file:
+                fixture = ChatCompletion.model_validate(json.load(file))
+            _fixtures[loadfile] = fixture
+        return fixture
+
+
+def clear_cache(settings: Optional[Settings] = None) -> None:
+    with _lock:
+        _profiles.clear()
+        _fixtures.clear()
+
+
+def make_error(status_code: int, retry_after: Optional[float]) -> APIStatusError:
+    headers = {}
+    if retry_after is not None:
+        headers["retry-after"] = str(retry_after)
+    response = httpx.Response(
+        status_code, headers=headers, request=httpx.Request("POST", MOCK_URL)
     )
-    response.choices[0].message.tool_calls = res_mockdata_json["choices"][0]["message"][
-        "tool_calls"
-    ]
-    logger.debug(
-        f"   choices[0].message.tool_calls: {response.choices[0].message.tool_calls}"
+    error_class: Type[APIStatusError] = APIStatusError
+    if status_code == 429:
+        error_class = RateLimitError
+    elif status_code >= 500:
+        error_class = InternalServerError
+    return error_class(
+        f"Mock error injected (status {status_code})", response=response, body=None
     )
 
-    response.created = res_mockdata_json["created"]
-    logger.debug(f"   created: {response.created}")
-    response.model = res_mockdata_json["model"]
-    logger.debug(f"   model: {response.model}")
-    response.object = res_mockdata_json["object"]
-    logger.debug(f"   object: {response.object}")
-    response.system_fingerprint = res_mockdata_json["system_fingerprint"]
-    logger.debug(f"   system_fingerprint: {response.system_fingerprint}")
-    response.usage.completion_tokens = res_mockdata_json["usage"]["completion_tokens"]
-    logger.debug(f"   usage.completion_tokens: {response.usage.completion_tokens}")
-    response.usage.prompt_tokens = res_mockdata_json["usage"]["prompt_tokens"]
-    logger.debug(f"   usage.prompt_tokens: {response.usage.prompt_tokens}")
-    response.usage.total_tokens = res_mockdata_json["usage"]["total_tokens"]
-    logger.debug(f"   usage.total_tokens: {response.usage.total_tokens}")
-    logger.debug("-- pre_openai_mock get_response return --")
+
+def select(
+    settings: Settings, model: str, prompt_class: str
+) -> Tuple[MockProfile, ChatCompletion]:
+    profile = get_profile(settings).for_model(model)
+    loadfile = profile.select_fixture(model, prompt_class) or settings.mockdata_file
+    if loadfile is None:
+        raise Exception("mockdata_file is None")
+    if profile.error_rate > 0 and random.random() < profile.error_rate:
+        raise make_error(profile.error_status, profile.retry_after)
+    return profile, get_fixture(loadfile)
+
+
+def response_delay(profile: MockProfile, response: ChatCompletion) -> float:
+    completion_tokens = response.usage.completion_tokens if response.usage else 0
+    return profile.first_token_delay() + profile.generation_time(completion_tokens)
+
+
+def get_response(
+    settings: Settings,
+    model: str,
+    prompt_class: str,
+) -> ChatCompletion:
+    profile, response = select(settings, model, prompt_class)
+    delay = response_delay(profile, response)
+    if delay > 0:
+        time.sleep(delay)
+    return response
+
+
+async def get_response_async(
+    settings: Settings,
+    model: str,
+    prompt_class: str,
+) -> ChatCompletion:
+    profile, response = select(settings, model, prompt_class)
+    delay = response_delay(profile, response)
+    if delay > 0:
+        await asyncio.sleep(delay)
     return response
+
+
+def get_stream_response(
+    settings: Settings,
+    model: str,
+    prompt_class: str,
+) -> Iterator[ChatCompletionChunk]:
+    logger = current_app.logger
+    profile, response = select(settings, model, prompt_class)
+    logger.debug("-- pre_openai_mock get_stream_response called --")
+
+    choice = response.choices[0]
+    content = choice.message.content or ""
+    chunk_size = settings.mock_stream_chunk_size
+    interval = settings.mock_stream_interval
+    if profile.tokens_per_second > 0 and content and response.usage is not None:
+        # spread the generation time of the fixture over its chunks
+        chunks = -(-len(content) // chunk_size)
+        interval = profile.generation_time(response.usage.completion_tokens) / chunks
+
+    def chunk(
+        delta: dict, finish_reason: str | None, **extra: object
+    ) -> ChatCompletionChunk:
+        return ChatCompletionChunk.model_validate(
+            {
+                "id": response.id,
+                "choices": [
+                    {
+                        "delta": delta,
+                        "finish_reason": finish_reason,
+                        "index": choice.index,
+                        "logprobs": None,
+                    }
+                ],
+                "created": response.created,
+                "model": response.model,
+                "object": "chat.completion.chunk",
+                "system_fingerprint": response.system_fingerprint,
+                **extra,
+            }
+        )
+
+    def generate() -> Iterator[ChatCompletionChunk]:
+        delay = profile.first_token_delay()
+        if delay > 0:
+            time.sleep(delay)
+        yield chunk({"role": choice.message.role, "content": ""}, None)
+        for i in range(0, len(content), chunk_size):
+            if interval > 0:
+                time.sleep(interval)
+            yield chunk({"content": content[i : i + chunk_size]}, None)
+        usage = response.usage.model_dump() if response.usage else None
+        yield chunk({}, choice.finish_reason, usage=usage)
+        logger.debug("-- pre_openai_mock get_stream_response return --")
+
+    return generate()
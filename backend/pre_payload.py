@@ -0,0 +1,221 @@
+import dataclasses
+import json
+import typing
+from typing import Any, Dict, Generic, List, Optional, Tuple, Type, TypeVar
+
+from flask import Flask, Response
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional: the standard json module is used instead
+    orjson = None  # type: ignore[assignment]
+
+T = TypeVar("T")
+
+
+class PayloadError(Exception):
+    def __init__(self, errors: Dict[str, str]):
+        super().__init__(
+            "Invalid request: " + "; ".join(f"{k}: {v}" for k, v in errors.items())
+        )
+        self.errors = errors
+
+
+def _default(o: Any) -> Any:
+    if dataclasses.is_dataclass(o) and not isinstance(o, type):
+        # the json module walks the fields itself: no asdict() deep copy
+        return {f.name: getattr(o, f.name) for f in dataclasses.fields(o)}
+    raise TypeError(f"Object of type {o.__class__.__name__} is not JSON serializable")
+
+
+def dumps(obj: Any) -> bytes:
+    # no spaces; dataclass fields in declaration order (orjson does not sort
+    # them, so neither does the fallback)
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(
+        obj, default=_default, separators=(",", ":"), ensure_ascii=False
+    ).encode("utf-8")
+
+
+def loads(data: Any) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def parse_json(data: bytes) -> Any:
+    try:
+        return loads(data)
+    except ValueError as e:
+        raise PayloadError({"body": f"is not valid JSON ({e})"}) from e
+
+
+class JSONProvider(DefaultJSONProvider):
+    # jsonify() and request.get_json() through dumps()/loads()
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return dumps(obj).decode("utf-8")
+
+    def loads(self, s: Any, **kwargs: Any) -> Any:
+        return loads(s)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj) + b"\n", mimetype=self.mimetype)
+
+
+def install(app: Flask) -> None:
+    app.json = JSONProvider(app)
+
+
+# JSON decoding only produces these exact types, so a type() lookup is enough
+# (and keeps True out of int fields)
+_TYPES: Dict[Any, Tuple[frozenset, str]] = {
+    str: (frozenset([str]), "must be a string"),
+    int: (frozenset([int]), "must be an integer"),
+    float: (frozenset([float, int]), "must be a number"),
+    bool: (frozenset([bool]), "must be true or false"),
+}
+
+
+_INVALID = object()
+
+
+@dataclasses.dataclass(frozen=True)
+class FieldSpec:
+    name: str
+    types: frozenset
+    message: str
+    to_float: bool
+    required: bool
+    nullable: bool
+    bounds: Optional[Tuple[float, float]]
+    # a list field: the checks above apply to each item
+    is_list: bool = False
+
+
+class Schema(Generic[T]):
+    # validators are built once from the dataclass's type hints; load() only
+    # runs the prepared checks. Fields are str, int, float, bool, a List of
+    # one of them, or Optional.
+    def __init__(
+        self,
+        cls: Type[T],
+        bounds: Optional[Dict[str, Tuple[float, float]]] = None,
+    ):
+        self.cls = cls
+        hints = typing.get_type_hints(cls)
+        bounds = bounds or {}
+        specs: List[FieldSpec] = []
+        for f in dataclasses.fields(cls):  # type: ignore[arg-type]
+            hint = hints[f.name]
+            args = typing.get_args(hint)
+            nullable = type(None) in args
+            if nullable:
+                hint = next(a for a in args if a is not type(None))
+            is_list = typing.get_origin(hint) is list
+            if is_list:
+                (hint,) = typing.get_args(hint)
+            types, message = _TYPES[hint]
+            required = (
+                f.default is dataclasses.MISSING
+                and f.default_factory is dataclasses.MISSING
+            )
+            specs.append(
+                FieldSpec(
+                    f.name,
+                    types,
+                    message,
+                    hint is float,
+                    required,
+                    nullable,
+                    bounds.get(f.name),
+                    is_list,
+                )
+            )
+        self.fields = tuple(specs)
+
+    def _check(
+        self, spec: FieldSpec, value: Any, key: str, errors: Dict[str, str]
+    ) -> Any:
+        # one item of a list field
+        if type(value) not in spec.types:
+            errors[key] = spec.message
+            return _INVALID
+        if spec.to_float:
+            value = float(value)
+        if spec.bounds is not None and not (spec.bounds[0] <= value <= spec.bounds[1]):
+            errors[key] = f"must be between {spec.bounds[0]:g} and {spec.bounds[1]:g}"
+            return _INVALID
+        return value
+
+    def _load(self, data: Any, prefix: str, errors: Dict[str, str]) -> Optional[T]:
+        if type(data) is not dict:
+            errors[prefix or "body"] = "must be a JSON object"
+            return None
+        values: Dict[str, Any] = {}
+        failed = False
+        for spec in self.fields:
+            if spec.name not in data:
+                if spec.required:
+                    errors[prefix + spec.name] = "is required"
+                    failed = True
+                continue
+            value = data[spec.name]
+            if spec.is_list:
+                if type(value) is not list:
+                    if value is None and spec.nullable:
+                        values[spec.name] = None
+                        continue
+                    errors[prefix + spec.name] = "must be an array"
+                    failed = True
+                    continue
+                items = [
+                    self._check(spec, item, f"{prefix}{spec.name}[{i}]", errors)
+                    for i, item in enumerate(value)
+                ]
+                if any(item is _INVALID for item in items):
+                    failed = True
+                    continue
+                values[spec.name] = items
+                continue
+            if type(value) not in spec.types:
+                if value is None and spec.nullable:
+                    values[spec.name] = None
+                    continue
+                errors[prefix + spec.name] = spec.message
+                failed = True
+                continue
+            if spec.to_float:
+                value = float(value)
+            if spec.bounds is not None and not (
+                spec.bounds[0] <= value <= spec.bounds[1]
+            ):
+                errors[prefix + spec.name] = (
+                    f"must be between {spec.bounds[0]:g} and {spec.bounds[1]:g}"
+                )
+                failed = True
+                continue
+            values[spec.name] = value
+        if failed:
+            return None
+        return self.cls(**values)
+
+    def load(self, data: Any) -> T:
+        errors: Dict[str, str] = {}
+        loaded = self._load(data, "", errors)
+        if loaded is None:
+            raise PayloadError(errors)
+        return loaded
+
+    def load_list(self, data: Any, max_items: Optional[int] = None) -> List[T]:
+        if not isinstance(data, list):
+            raise PayloadError({"body": "must be a JSON array"})
+        if max_items is not None and len(data) > max_items:
+            raise PayloadError({"body": f"must have at most {max_items} items"})
+        errors: Dict[str, str] = {}
+        loaded = [self._load(item, f"[{i}].", errors) for i, item in enumerate(data)]
+        if errors:
+            raise PayloadError(errors)
+        return typing.cast(List[T], loaded)
@@ -0,0 +1,92 @@
+import os
+import threading
+import time
+from datetime import datetime
+
+# Crockford base32: sorts in the same order as the numbers it encodes
+CROCKFORD_BASE32 = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+COUNTER_BITS = 80
+COUNTER_CHARS = 16
+
+
+def encode_base32(value: int, length: int) -> str:
+    chars = []
+    for _ in range(length):
+        chars.append(CROCKFORD_BASE32[value & 0x1F])
+        value >>= 5
+    return "".join(reversed(chars))
+
+
+class QaIdGenerator:
+    # yyyymmdd_HHMMSS_fff_<counter>_<user_id>
+    #
+    # The counter starts at a random 79-bit value each millisecond and is
+    # incremented for every further id in the same millisecond, so ids are
+    # strictly increasing within a process and unique across processes with
+    # overwhelming probability, like ULID's monotonic mode.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._counter = 0
+        self._second = -1
+        self._second_prefix = ""
+
+    def _random_counter(self) -> int:
+        # leave the top bit free so increments do not overflow in practice
+        return int.from_bytes(os.urandom(COUNTER_BITS // 8), "big") >> 1
+
+    def new_id(self, user_id: str) -> str:
+        now_ms = time.time_ns() // 1_000_000
+        with self._lock:
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                self._counter = self._random_counter()
+            else:
+                # same millisecond, or the clock went backwards
+                self._counter += 1
+                if self._counter >= 1 << COUNTER_BITS:
+                    self._last_ms += 1
+                    self._counter = self._random_counter()
+            ms = self._last_ms
+            counter = self._counter
+
+            second = ms // 1000
+            if second != self._second:
+                self._second = second
+                self._second_prefix = datetime.fromtimestamp(second).strftime(
+                    "%Y%m%d_%H%M%S"
+                )
+            prefix = self._second_prefix
+
+        return f"{prefix}_{ms % 1000:03d}_{encode_base32(counter, COUNTER_CHARS)}_{user_id}"
+
+    def reset(self) -> None:
+        self._lock = threading.Lock()
+        self._last_ms = -1
+
+
+def user_id_in(qa_id: str) -> str:
+    # yyyymmdd_HHMMSS_fff_<counter>_<user_id>, or yyyymmdd_HHMMSS_<user_id>
+    # for ids made before the counter; user_id may contain "_"
+    parts = qa_id.split("_", 4)
+    if (
+        len(parts) == 5
+        and len(parts[2]) == 3
+        and parts[2].isdigit()
+        and len(parts[3]) == COUNTER_CHARS
+        and all(c in CROCKFORD_BASE32 for c in parts[3])
+    ):
+        return parts[4]
+    return qa_id.split("_", 2)[-1]
+
+
+_generator = QaIdGenerator()
+
+
+def new_qa_id(user_id: str) -> str:
+    return _generator.new_id(user_id)
+
+
+if hasattr(os, "register_at_fork"):
+    # a forked child must not continue the parent's counter
+    os.register_at_fork(after_in_child=_generator.reset)
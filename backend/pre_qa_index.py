@@ -0,0 +1,271 @@
+import json
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from pre_qa_id import user_id_in
+
+SEARCH_LIMIT_MAX = 500
+
+IndexEntry = Tuple[str, Dict[str, Any], Dict[str, Any]]
+FileState = Tuple[str, int, float]
+
+
+@dataclass
+class QaLogSummary:
+    qa_id: str
+    user_id: str
+    prompt_class: str
+    model: str
+    temperature: Optional[float]
+    finish_reason: str
+
+
+def user_id_of(qa_id: str, qa_request: Dict[str, Any]) -> str:
+    if "user_id" in qa_request:
+        return str(qa_request["user_id"])
+    # QA logs written before user_id was recorded: the qa_id ends with it
+    return user_id_in(qa_id)
+
+
+def fts_query(text: str) -> str:
+    # every word must appear; quoting keeps FTS5 operators out of user input
+    return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+
+class QaIndex:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS qa_log ("
+            " qa_id TEXT PRIMARY KEY,"
+            " user_id TEXT NOT NULL,"
+            " prompt_class TEXT NOT NULL,"
+            " model TEXT NOT NULL,"
+            " temperature REAL,"
+            " finish_reason TEXT NOT NULL,"
+            " record TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS qa_log_user_id ON qa_log (user_id, qa_id);"
+            "CREATE INDEX IF NOT EXISTS qa_log_prompt_class"
+            " ON qa_log (prompt_class, qa_id);"
+            "CREATE INDEX IF NOT EXISTS qa_log_model ON qa_log (model, qa_id);"
+            "CREATE VIRTUAL TABLE IF NOT EXISTS qa_log_fts"
+            " USING fts5(prompt, content);"
+            # how far each log file has been indexed by pre_qa_index_rebuild.py
+            "CREATE TABLE IF NOT EXISTS qa_log_file ("
+            " path TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " mtime REAL NOT NULL);"
+        )
+        self._conn.commit()
+
+    def _add(
+        self, qa_id: str, qa_request: Dict[str, Any], qa_response: Dict[str, Any]
+    ) -> None:
+        record = json.dumps(
+            {"qa_id": qa_id, "qa_request": qa_request, "qa_response": qa_response},
+            ensure_ascii=False,
+        )
+        self._conn.execute(
+            "INSERT INTO qa_log"
+            " (qa_id, user_id, prompt_class, model, temperature, finish_reason, record)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (qa_id) DO UPDATE SET"
+            " user_id = excluded.user_id, prompt_class = excluded.prompt_class,"
+            " model = excluded.model, temperature = excluded.temperature,"
+            " finish_reason = excluded.finish_reason, record = excluded.record",
+            (
+                qa_id,
+                user_id_of(qa_id, qa_request),
+                qa_request.get("prompt_class", ""),
+                qa_request.get("selected_model") or qa_request.get("model", ""),
+                qa_request.get("temperature"),
+                qa_response.get("finish_reason") or "",
+                record,
+            ),
+        )
+        row = self._conn.execute(
+            "SELECT rowid FROM qa_log WHERE qa_id = ?", (qa_id,)
+        ).fetchone()
+        prompt = "\n".join(
+            str(m.get("content") or "") for m in qa_request.get("messages", [])
+        )
+        self._conn.execute("DELETE FROM qa_log_fts WHERE rowid = ?", (row[0],))
+        self._conn.execute(
+            "INSERT INTO qa_log_fts (rowid, prompt, content) VALUES (?, ?, ?)",
+            (row[0], prompt, qa_response.get("content") or ""),
+        )
+
+    def add(
+        self, qa_id: str, qa_request: Dict[str, Any], qa_response: Dict[str, Any]
+    ) -> None:
+        with self._lock:
+            try:
+                self._add(qa_id, qa_request, qa_response)
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def add_many(
+        self,
+        entries: Iterable[IndexEntry],
+        file_states: Iterable[FileState] = (),
+    ) -> int:
+        # one transaction, together with how far the files have been read
+        added = 0
+        with self._lock:
+            try:
+                for qa_id, qa_request, qa_response in entries:
+                    self._add(qa_id, qa_request, qa_response)
+                    added += 1
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO qa_log_file (path, size, mtime)"
+                    " VALUES (?, ?, ?)",
+                    file_states,
+                )
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+        return added
+
+    def file_state(self, path: str) -> Optional[Tuple[int, float]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime FROM qa_log_file WHERE path = ?", (path,)
+            ).fetchone()
+        return (row[0], row[1]) if row is not None else None
+
+    def get(self, qa_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT record FROM qa_log WHERE qa_id = ?", (qa_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def search(
+        self,
+        text: Optional[str] = None,
+        user_id: Optional[str] = None,
+        prompt_class: Optional[str] = None,
+        model: Optional[str] = None,
+        before: Optional[str] = None,
+        limit: int = 50,
+    ) -> List[QaLogSummary]:
+        # newest first; qa_ids sort by time, so `before` pages backwards
+        sql = (
+            "SELECT q.qa_id, q.user_id, q.prompt_class, q.model, q.temperature,"
+            " q.finish_reason FROM qa_log q"
+        )
+        conditions: List[str] = []
+        params: List[Any] = []
+        if text and text.split():
+            sql += " JOIN qa_log_fts f ON f.rowid = q.rowid"
+            conditions.append("qa_log_fts MATCH ?")
+            params.append(fts_query(text))
+        for column, value in (
+            ("user_id", user_id),
+            ("prompt_class", prompt_class),
+            ("model", model),
+        ):
+            if value is not None:
+                conditions.append(f"q.{column} = ?")
+                params.append(value)
+        if before is not None:
+            conditions.append("q.qa_id < ?")
+            params.append(before)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY q.qa_id DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [QaLogSummary(*row) for row in rows]
+
+    def records(
+        self, since: str, until: str, batch_size: int = 1000
+    ) -> Iterator[Dict[str, Any]]:
+        # qa_ids from since up to (not including) until, in order; the lock is
+        # held for one batch at a time so requests are not kept waiting
+        after = ""
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT qa_id, record FROM qa_log"
+                    " WHERE qa_id >= ? AND qa_id > ? AND qa_id < ?"
+                    " ORDER BY qa_id LIMIT ?",
+                    (since, after, until, batch_size),
+                ).fetchall()
+            for row in rows:
+                yield json.loads(row[1])
+            if len(rows) < batch_size:
+                return
+            after = rows[-1][0]
+
+    def user_records(
+        self, user_id: str, batch_size: int = 1000
+    ) -> Iterator[Dict[str, Any]]:
+        # every QA log of user_id, in qa_id order, one batch at a time
+        after = ""
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT qa_id, record FROM qa_log"
+                    " WHERE user_id = ? AND qa_id > ?"
+                    " ORDER BY qa_id LIMIT ?",
+                    (user_id, after, batch_size),
+                ).fetchall()
+            for row in rows:
+                yield json.loads(row[1])
+            if len(rows) < batch_size:
+                return
+            after = rows[-1][0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM qa_log")
+            self._conn.execute("DELETE FROM qa_log_fts")
+            self._conn.execute("DELETE FROM qa_log_file")
+            self._conn.commit()
+
+    def count(self) -> int:
+        with self._lock:
+            return int(self._conn.execute("SELECT COUNT(*) FROM qa_log").fetchone()[0])
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_lock = threading.Lock()
+_indexes: Dict[str, QaIndex] = {}
+
+
+def get_index(path: str) -> QaIndex:
+    index = _indexes.get(path)
+    if index is not None:
+        return index
+    with _lock:
+        index = _indexes.get(path)
+        if index is None:
+            index = QaIndex(path)
+            _indexes[path] = index
+        return index
+
+
+def _reset_after_fork() -> None:
+    # a sqlite connection must not be used across fork
+    global _lock
+    _lock = threading.Lock()
+    _indexes.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
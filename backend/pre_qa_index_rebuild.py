@@ -0,0 +1,109 @@
+import argparse
+import glob
+import json
+import os
+import sys
+from typing import List, Optional
+
+import toml
+
+from pre_qa_index import FileState, IndexEntry, QaIndex, get_index
+from pre_qa_log import QA_LOGFILE_EXTENSION, QA_SEGMENT_EXTENSION, QA_SEGMENT_PREFIX
+from pre_settings import load_settings
+
+BATCH_SIZE = 1000
+
+
+def index_logfiles(index: QaIndex, qa_log_dir: str) -> int:
+    # <qa_id>.toml files are written once: index the ones not seen yet
+    added = 0
+    entries: List[IndexEntry] = []
+    file_states: List[FileState] = []
+    for logfile in glob.glob(os.path.join(qa_log_dir, "*" + QA_LOGFILE_EXTENSION)):
+        stat = os.stat(logfile)
+        if index.file_state(logfile) == (stat.st_size, stat.st_mtime):
+            continue
+        try:
+            log = toml.load(logfile)
+        except Exception as e:
+            print(f"skipped {logfile}: {e}", file=sys.stderr)
+            continue
+        qa_id = os.path.basename(logfile)[: -len(QA_LOGFILE_EXTENSION)]
+        entries.append((qa_id, log["qa_request"], log["qa_response"]))
+        file_states.append((logfile, stat.st_size, stat.st_mtime))
+        if len(entries) >= BATCH_SIZE:
+            added += index.add_many(entries, file_states)
+            entries, file_states = [], []
+            print(f"{added} QA logs indexed")
+    return added + index.add_many(entries, file_states)
+
+
+def index_segment(index: QaIndex, segment: str) -> int:
+    # segments only grow: continue from where the last run stopped
+    state = index.file_state(segment)
+    offset = state[0] if state is not None else 0
+    added = 0
+    with open(segment, "rb") as f:
+        f.seek(offset)
+        while True:
+            lines = f.readlines(BATCH_SIZE * 4096)
+            if not lines:
+                break
+            if not lines[-1].endswith(b"\n"):
+                # still being written: leave the partial line for the next run
+                lines.pop()
+                if not lines:
+                    break
+            entries: List[IndexEntry] = []
+            for line in lines:
+                offset += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                entries.append(
+                    (record["qa_id"], record["qa_request"], record["qa_response"])
+                )
+            added += index.add_many(
+                entries, [(segment, offset, os.path.getmtime(segment))]
+            )
+            f.seek(offset)
+    return added
+
+
+def rebuild(qa_log_dir: str, index_file: str, full: bool = False) -> int:
+    index = get_index(index_file)
+    if full:
+        index.clear()
+    added = index_logfiles(index, qa_log_dir)
+    for segment in sorted(
+        glob.glob(
+            os.path.join(qa_log_dir, QA_SEGMENT_PREFIX + "*" + QA_SEGMENT_EXTENSION)
+        )
+    ):
+        added += index_segment(index, segment)
+    return added
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Bring the QA log index (PRE_QA_INDEX_FILE) up to date."
+    )
+    parser.add_argument(
+        "--full", action="store_true", help="drop the index and index every QA log"
+    )
+    args = parser.parse_args(argv)
+
+    settings = load_settings()
+    if settings.qa_index_file is None:
+        print("PRE_QA_INDEX_FILE is not set.", file=sys.stderr)
+        return 1
+    added = rebuild(settings.qa_log_dir, settings.qa_index_file, full=args.full)
+    index = get_index(settings.qa_index_file)
+    print(f"{added} QA logs indexed, {index.count()} in the index")
+    index.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,262 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Any, Dict, List, Optional, TextIO
+
+import toml
+
+from pre_qa_index import QaIndex, get_index
+from pre_settings import Settings
+
+QA_LOGFILE_EXTENSION = ".toml"
+QA_SEGMENT_PREFIX = "qa_log_"
+QA_SEGMENT_EXTENSION = ".jsonl"
+QA_LOG_FORMAT_TOML = "toml"
+QA_LOG_FORMAT_JSONL = "jsonl"
+QA_LOG_WRITE_MODE_ASYNC = "Async"
+# a replaced sink stays open this long for writers that already hold it
+RETIRED_CLOSE_DELAY = 5.0
+
+
+@dataclass
+class QaLogRecord:
+    qa_id: str
+    qa_request: Dict[str, Any]
+    qa_response: Dict[str, Any]
+
+
+class QaLogSink(ABC):
+    @abstractmethod
+    def write(self, record: QaLogRecord) -> None: ...
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class TomlFileSink(QaLogSink):
+    # one <qa_id>.toml per record: the original layout read by existing tools
+    def __init__(self, qa_log_dir: str):
+        self.qa_log_dir = qa_log_dir
+
+    def write(self, record: QaLogRecord) -> None:
+        logfile = self.qa_log_dir + record.qa_id + QA_LOGFILE_EXTENSION
+        with open(logfile, "w") as f:
+            toml.dump({"qa_request": record.qa_request}, f)
+            toml.dump({"qa_response": record.qa_response}, f)
+
+
+class JsonlSegmentSink(QaLogSink):
+    # one JSON object per line, appended to qa_log_<start>_<pid>.jsonl segments
+    def __init__(self, qa_log_dir: str, max_bytes: int, max_seconds: float):
+        self.qa_log_dir = qa_log_dir
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self._lock = threading.Lock()
+        self._file: Optional[TextIO] = None
+        self._opened_at = 0.0
+        self._size = 0
+
+    def _open_segment(self) -> TextIO:
+        started = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        path = os.path.join(
+            self.qa_log_dir,
+            f"{QA_SEGMENT_PREFIX}{started}_{os.getpid()}{QA_SEGMENT_EXTENSION}",
+        )
+        self._file = open(path, "a", encoding="utf-8")
+        self._opened_at = time.monotonic()
+        self._size = self._file.tell()
+        return self._file
+
+    def _segment(self) -> TextIO:
+        f = self._file
+        if f is not None and (
+            self._size >= self.max_bytes
+            or time.monotonic() - self._opened_at >= self.max_seconds
+        ):
+            f.close()
+            f = None
+        if f is None:
+            f = self._open_segment()
+        return f
+
+    def write(self, record: QaLogRecord) -> None:
+        line = json.dumps(asdict(record), ensure_ascii=False) + "\n"
+        with self._lock:
+            f = self._segment()
+            f.write(line)
+            f.flush()
+            self._size += len(line.encode("utf-8"))
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class IndexingSink(QaLogSink):
+    # keeps the QA log index in step with the files; the files stay the record
+    def __init__(self, sink: QaLogSink, index: QaIndex, logger: logging.Logger):
+        self.sink = sink
+        self.index = index
+        self.logger = logger
+
+    def write(self, record: QaLogRecord) -> None:
+        self.sink.write(record)
+        try:
+            self.index.add(record.qa_id, record.qa_request, record.qa_response)
+        except Exception as e:
+            self.logger.error("qa index update failed: %s: %s", record.qa_id, e)
+
+    def flush(self) -> None:
+        self.sink.flush()
+
+    def close(self) -> None:
+        self.sink.close()
+
+
+class BackgroundSink(QaLogSink):
+    def __init__(self, sink: QaLogSink, queue_size: int, logger: logging.Logger):
+        self.sink = sink
+        self.logger = logger
+        self._queue: queue.Queue[Optional[QaLogRecord]] = queue.Queue(
+            maxsize=queue_size
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="pre-qa-log-writer", daemon=True
+        )
+        self._thread.start()
+
+    def write(self, record: QaLogRecord) -> None:
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            # never drop a QA log: fall back to writing on the caller's thread
+            self.logger.warning("qa log queue is full, writing synchronously")
+            self.sink.write(record)
+
+    def _run(self) -> None:
+        while True:
+            record = self._queue.get()
+            try:
+                if record is None:
+                    return
+                self.sink.write(record)
+            except Exception as e:
+                self.logger.error("qa log write failed: %s", e)
+            finally:
+                self._queue.task_done()
+
+    def flush(self) -> None:
+        self._queue.join()
+        self.sink.flush()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+        self.sink.close()
+
+
+def create_sink(settings: Settings, logger: logging.Logger) -> QaLogSink:
+    sink: QaLogSink
+    if settings.qa_log_format == QA_LOG_FORMAT_JSONL:
+        sink = JsonlSegmentSink(
+            settings.qa_log_dir,
+            settings.qa_log_segment_max_bytes,
+            settings.qa_log_segment_seconds,
+        )
+    else:
+        sink = TomlFileSink(settings.qa_log_dir)
+    if settings.qa_index_file is not None:
+        sink = IndexingSink(sink, get_index(settings.qa_index_file), logger)
+    if settings.qa_log_write_mode == QA_LOG_WRITE_MODE_ASYNC:
+        sink = BackgroundSink(sink, settings.qa_log_queue_size, logger)
+    return sink
+
+
+_lock = threading.Lock()
+_sink: Optional[QaLogSink] = None
+# the settings _sink was built from; None for a sink passed to set_sink
+_sink_settings: Optional[Settings] = None
+_retired: List[QaLogSink] = []
+
+
+def get_sink(settings: Settings, logger: logging.Logger) -> QaLogSink:
+    global _sink, _sink_settings
+    sink = _sink
+    if sink is not None:
+        return sink
+    with _lock:
+        if _sink is None:
+            _sink = create_sink(settings, logger)
+            _sink_settings = settings
+        return _sink
+
+
+def set_sink(sink: QaLogSink) -> None:
+    global _sink, _sink_settings
+    with _lock:
+        _sink = sink
+        _sink_settings = None
+
+
+def replace_sink(settings: Settings, logger: logging.Logger) -> None:
+    # on reload: new records go to a sink built from the new settings
+    global _sink, _sink_settings
+    with _lock:
+        old = _sink
+        if old is None or _sink_settings is None or settings == _sink_settings:
+            return
+        _sink = create_sink(settings, logger)
+        _sink_settings = settings
+        _retired.append(old)
+
+    def close_retired() -> None:
+        with _lock:
+            if old not in _retired:
+                return
+            _retired.remove(old)
+        old.close()
+
+    timer = threading.Timer(RETIRED_CLOSE_DELAY, close_retired)
+    timer.daemon = True
+    timer.start()
+
+
+def shutdown_sink() -> None:
+    global _sink, _sink_settings
+    with _lock:
+        for sink in _retired:
+            sink.close()
+        _retired.clear()
+        if _sink is not None:
+            _sink.close()
+            _sink = None
+            _sink_settings = None
+
+
+def _reset_after_fork() -> None:
+    # the writer thread and open segment belong to the parent
+    global _lock, _sink, _sink_settings
+    _lock = threading.Lock()
+    _sink = None
+    _sink_settings = None
+    _retired.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,7 +1,13 @@
 from dataclasses import dataclass
+from typing import Dict
 
 
 @dataclass
 class ResponseErrorData:
     error: str
     detail: str
+
+
+@dataclass
+class ResponseFieldErrorData(ResponseErrorData):
+    fields: Dict[str, str]
@@ -0,0 +1,412 @@
+import asyncio
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+from openai import APIStatusError
+
+from pre_admission import AdmissionRejectedError, is_retryable
+from pre_metrics import ROUTER_EVENTS
+from pre_model import ModelGroup
+
+T = TypeVar("T")
+
+EWMA_ALPHA = 0.2
+LATENCY_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+EXPLORE_RATE = 0.05
+ERROR_RATE_MAX = 0.95
+# the member, not the request, is at fault: another member may answer
+FAILOVER_STATUS_CODES = (401, 403, 404)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class NoBackendAvailableError(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_backend_failure(e: Exception) -> bool:
+    if isinstance(e, APIStatusError) and e.status_code in FAILOVER_STATUS_CODES:
+        return True
+    return is_retryable(e)
+
+
+def should_failover(e: Exception) -> bool:
+    # a full admission queue is not a failure of the member, but another
+    # member may still have room
+    return isinstance(e, AdmissionRejectedError) or is_backend_failure(e)
+
+
+class Backend:
+    def __init__(self, name: str):
+        self.name = name
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.samples: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        # circuit breaker
+        self.state = CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    def score(self) -> float:
+        # expected seconds to an answer; members without a latency yet are
+        # tried first
+        latency = self.latency or 0.0
+        return latency / (1.0 - min(self.error_rate, ERROR_RATE_MAX))
+
+
+class GroupRouter:
+    def __init__(self, group: ModelGroup):
+        self.group = group
+        self.backends = {name: Backend(name) for name in group.members}
+        self._lock = threading.Lock()
+
+    def _available(self, backend: Backend, now: float) -> bool:
+        if backend.state == OPEN:
+            if now < backend.open_until:
+                return False
+            backend.state = HALF_OPEN
+            backend.probing = False
+        if backend.state == HALF_OPEN:
+            # one request at a time finds out whether it has recovered
+            return not backend.probing
+        return True
+
+    def candidates(self) -> List[str]:
+        now = time.monotonic()
+        with self._lock:
+            available = [b for b in self.backends.values() if self._available(b, now)]
+            available.sort(key=Backend.score)
+            names = [b.name for b in available]
+        if len(names) > 1 and random.random() < EXPLORE_RATE:
+            # now and then lead with another member, so its latency stays current
+            i = random.randrange(1, len(names))
+            names[0], names[i] = names[i], names[0]
+        return names
+
+    def start(self, name: str) -> bool:
+        with self._lock:
+            backend = self.backends[name]
+            if not self._available(backend, time.monotonic()):
+                return False
+            if backend.state == HALF_OPEN:
+                backend.probing = True
+            backend.in_flight += 1
+            backend.requests += 1
+            return True
+
+    def finish(self, name: str, latency: float, failed: Optional[bool]) -> None:
+        # failed is None when the request itself was at fault: the health of
+        # the member is unknown
+        event = None
+        with self._lock:
+            backend = self.backends[name]
+            backend.in_flight -= 1
+            if failed is None:
+                if backend.state == HALF_OPEN:
+                    backend.probing = False
+                return
+            backend.error_rate += EWMA_ALPHA * (float(failed) - backend.error_rate)
+            if failed:
+                backend.errors += 1
+                backend.failures += 1
+                if backend.state == HALF_OPEN or (
+                    backend.state == CLOSED
+                    and backend.failures >= self.group.failure_threshold
+                ):
+                    backend.state = OPEN
+                    backend.open_until = time.monotonic() + self.group.open_seconds
+                    backend.probing = False
+                    event = "ejected"
+            else:
+                if backend.state != CLOSED:
+                    event = "restored"
+                backend.state = CLOSED
+                backend.failures = 0
+                backend.probing = False
+                if backend.latency is None:
+                    backend.latency = latency
+                else:
+                    backend.latency += EWMA_ALPHA * (latency - backend.latency)
+                backend.samples.append(latency)
+        if event is not None:
+            ROUTER_EVENTS.inc(self.group.name, name, event)
+
+    def hedge_delay(self, name: str) -> Optional[float]:
+        group = self.group
+        if group.hedge_percentile is not None:
+            with self._lock:
+                samples = sorted(self.backends[name].samples)
+            if len(samples) >= HEDGE_MIN_SAMPLES:
+                i = int(len(samples) * group.hedge_percentile / 100)
+                return samples[min(i, len(samples) - 1)]
+        return group.hedge_delay
+
+    def retry_after(self) -> float:
+        now = time.monotonic()
+        with self._lock:
+            open_until = min(b.open_until for b in self.backends.values())
+        return max(0.0, open_until - now)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                b.name: {
+                    "state": b.state,
+                    "latency": b.latency,
+                    "error_rate": b.error_rate,
+                    "in_flight": b.in_flight,
+                    "requests": b.requests,
+                    "errors": b.errors,
+                    "open_for": max(0.0, b.open_until - now)
+                    if b.state == OPEN
+                    else 0.0,
+                }
+                for b in self.backends.values()
+            }
+
+
+def route(
+    router: GroupRouter,
+    call: Callable[[str, bool], T],
+    hedge: bool = True,
+) -> Tuple[str, T]:
+    # call(member, last) runs the request on one member; last is True when no
+    # other member is left to fail over to. Hedged calls run in threads of
+    # their own, and a call that loses the race finishes in the background.
+    group = router.group
+    members = router.candidates()
+    if not members:
+        raise NoBackendAvailableError(
+            f"{group.name}: all members are ejected", router.retry_after()
+        )
+    max_attempts = min(len(members), group.max_attempts or len(members))
+    delay = router.hedge_delay(members[0]) if hedge else None
+    inline = delay is None
+    results: "queue.Queue[Tuple[str, Any, Optional[Exception]]]" = queue.Queue()
+    attempts = 0
+    pending = 0
+
+    def attempt(name: str, last: bool) -> None:
+        start = time.monotonic()
+        try:
+            value = call(name, last)
+        except Exception as e:
+            failed = True if is_backend_failure(e) else None
+            router.finish(name, time.monotonic() - start, failed)
+            results.put((name, None, e))
+            return
+        router.finish(name, time.monotonic() - start, False)
+        results.put((name, value, None))
+
+    def launch(run_inline: bool) -> Optional[str]:
+        nonlocal attempts, pending
+        while members and attempts < max_attempts:
+            name = members.pop(0)
+            if not router.start(name):
+                continue
+            attempts += 1
+            pending += 1
+            last = attempts >= max_attempts or not members
+            if run_inline:
+                attempt(name, last)
+            else:
+                threading.Thread(target=attempt, args=(name, last), daemon=True).start()
+            return name
+        return None
+
+    if launch(inline) is None:
+        raise NoBackendAvailableError(
+            f"{group.name}: all members are ejected", router.retry_after()
+        )
+    hedge_at = time.monotonic() + (delay or 0.0)
+    hedged = False
+    stopped = False
+    last_error: Optional[Exception] = None
+    while pending > 0:
+        timeout = None
+        if not (inline or hedged or stopped) and members and attempts < max_attempts:
+            timeout = max(0.0, hedge_at - time.monotonic())
+        try:
+            name, value, error = results.get(timeout=timeout)
+        except queue.Empty:
+            hedged = True
+            started = launch(False)
+            if started is not None:
+                ROUTER_EVENTS.inc(group.name, started, "hedge")
+            continue
+        pending -= 1
+        if error is None:
+            return name, value
+        last_error = error
+        if not should_failover(error):
+            # another member would get the same request wrong
+            stopped = True
+            continue
+        if not stopped:
+            started = launch(inline)
+            if started is not None:
+                ROUTER_EVENTS.inc(group.name, started, "failover")
+    if last_error is None:
+        raise NoBackendAvailableError(
+            f"{group.name}: all members are ejected", router.retry_after()
+        )
+    raise last_error
+
+
+# calls of route_async() that lost the race; kept so they are not collected
+# before they finish
+_background: "Set[asyncio.Task[None]]" = set()
+
+
+async def route_async(
+    router: GroupRouter,
+    call: Callable[[str, bool], Awaitable[T]],
+    hedge: bool = True,
+) -> Tuple[str, T]:
+    # route() for coroutines: every call is a task of its own
+    group = router.group
+    members = router.candidates()
+    if not members:
+        raise NoBackendAvailableError(
+            f"{group.name}: all members are ejected", router.retry_after()
+        )
+    max_attempts = min(len(members), group.max_attempts or len(members))
+    delay = router.hedge_delay(members[0]) if hedge else None
+    results: "asyncio.Queue[Tuple[str, Any, Optional[Exception]]]" = asyncio.Queue()
+    attempts = 0
+    pending = 0
+
+    async def attempt(name: str, last: bool) -> None:
+        start = time.monotonic()
+        try:
+            value = await call(name, last)
+        except Exception as e:
+            failed = True if is_backend_failure(e) else None
+            router.finish(name, time.monotonic() - start, failed)
+            results.put_nowait((name, None, e))
+            return
+        router.finish(name, time.monotonic() - start, False)
+        results.put_nowait((name, value, None))
+
+    def launch() -> Optional[str]:
+        nonlocal attempts, pending
+        while members and attempts < max_attempts:
+            name = members.pop(0)
+            if not router.start(name):
+                continue
+            attempts += 1
+            pending += 1
+            last = attempts >= max_attempts or not members
+            task = asyncio.create_task(attempt(name, last))
+            _background.add(task)
+            task.add_done_callback(_background.discard)
+            return name
+        return None
+
+    if launch() is None:
+        raise NoBackendAvailableError(
+            f"{group.name}: all members are ejected", router.retry_after()
+        )
+    hedge_at = time.monotonic() + (delay or 0.0)
+    hedged = False
+    stopped = False
+    last_error: Optional[Exception] = None
+    while pending > 0:
+        timeout = None
+        if (
+            not (delay is None or hedged or stopped)
+            and members
+            and attempts < max_attempts
+        ):
+            timeout = max(0.0, hedge_at - time.monotonic())
+        try:
+            name, value, error = await asyncio.wait_for(results.get(), timeout)
+        except asyncio.TimeoutError:
+            hedged = True
+            started = launch()
+            if started is not None:
+                ROUTER_EVENTS.inc(group.name, started, "hedge")
+            continue
+        pending -= 1
+        if error is None:
+            return name, value
+        last_error = error
+        if not should_failover(error):
+            # another member would get the same request wrong
+            stopped = True
+            continue
+        if not stopped:
+            started = launch()
+            if started is not None:
+                ROUTER_EVENTS.inc(group.name, started, "failover")
+    if last_error is None:
+        raise NoBackendAvailableError(
+            f"{group.name}: all members are ejected", router.retry_after()
+        )
+    raise last_error
+
+
+RouterKey = Tuple[str, Tuple[str, ...]]
+
+_lock = threading.Lock()
+_routers: Dict[RouterKey, GroupRouter] = {}
+
+
+def get_router(group: ModelGroup) -> GroupRouter:
+    # the statistics outlive a reload of the model definitions as long as
+    # the members stay the same
+    key = (group.name, tuple(group.members))
+    router = _routers.get(key)
+    if router is None:
+        with _lock:
+            router = _routers.get(key)
+            if router is None:
+                router = GroupRouter(group)
+                _routers[key] = router
+    if router.group is not group:
+        router.group = group
+    return router
+
+
+def get_stats() -> Dict[str, Dict[str, Dict[str, Any]]]:
+    with _lock:
+        routers = list(_routers.values())
+    return {router.group.name: router.stats() for router in routers}
+
+
+def _reset_after_fork() -> None:
+    # in-flight counts and probes belong to the parent's threads
+    global _lock
+    _lock = threading.Lock()
+    _routers.clear()
+    _background.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
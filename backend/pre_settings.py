@@ -0,0 +1,278 @@
+import os
+import signal
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Mapping, Optional
+
+from dotenv import load_dotenv
+
+RUNMODE_MOCK = "Mock"
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+EVAL_WRITE_MODES = ("", "WriteBehind")
+QA_LOG_FORMATS = ("toml", "jsonl")
+QA_LOG_WRITE_MODES = ("", "Async")
+
+
+class SettingsError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Settings:
+    # --- for input ---
+    def_model: str
+    runmode: str
+    mockdata_file: Optional[str]
+    # --- for output ---
+    log_dir: str
+    qa_log_dir: str
+    db_uri: str
+    # --- optional ---
+    log_level: str = "DEBUG"
+    metrics_sample_rate: float = 0.0
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_pre_ping: bool = True
+    db_pool_recycle: int = 3600
+    eval_write_mode: str = ""
+    eval_batch_size: int = 500
+    eval_flush_interval: float = 1.0
+    eval_queue_size: int = 100000
+    eval_spool_file: Optional[str] = None
+    mock_stream_chunk_size: int = 16
+    mock_stream_interval: float = 0.0
+    mock_profile_file: Optional[str] = None
+    qa_log_format: str = "toml"
+    qa_log_write_mode: str = ""
+    qa_log_queue_size: int = 10000
+    qa_log_segment_max_bytes: int = 64 * 1024 * 1024
+    qa_log_segment_seconds: float = 3600.0
+    qa_index_file: Optional[str] = None
+    completion_cache_max_entries: int = 0
+    completion_cache_ttl: float = 3600.0
+    completion_cache_file: Optional[str] = None
+    completion_cache_max_bytes: int = 256 * 1024 * 1024
+    conversation_max_entries: int = 1000
+    conversation_max_turns: int = 100
+    conversation_max_tokens: int = 4000
+    conversation_ttl: float = 86400.0
+    conversation_file: Optional[str] = None
+    # worker processes serving the app (set by gunicorn.conf.py)
+    workers: int = 1
+
+    @property
+    def is_mock(self) -> bool:
+        return self.runmode == RUNMODE_MOCK
+
+
+class _Reader:
+    def __init__(self, environ: Mapping[str, str]):
+        self.environ = environ
+        self.errors: List[str] = []
+
+    def required(self, name: str) -> str:
+        value = self.environ.get(name)
+        if not value:
+            self.errors.append(f"{name} is not set.")
+            return ""
+        return value
+
+    def optional(self, name: str) -> Optional[str]:
+        value = self.environ.get(name)
+        return value if value else None
+
+    def choice(self, name: str, choices: tuple, default: str = "") -> str:
+        value = self.environ.get(name) or default
+        if value not in choices:
+            self.errors.append(f"{name} must be one of {choices}, not {value!r}.")
+        return value
+
+    def get_int(self, name: str, default: int) -> int:
+        value = self.environ.get(name)
+        if not value:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            self.errors.append(f"{name} must be an integer, not {value!r}.")
+            return default
+
+    def get_float(self, name: str, default: float) -> float:
+        value = self.environ.get(name)
+        if not value:
+            return default
+        try:
+            return float(value)
+        except ValueError:
+            self.errors.append(f"{name} must be a number, not {value!r}.")
+            return default
+
+    def get_bool(self, name: str, default: bool) -> bool:
+        value = self.environ.get(name)
+        if not value:
+            return default
+        if value.lower() in ("1", "true", "yes", "on"):
+            return True
+        if value.lower() in ("0", "false", "no", "off"):
+            return False
+        self.errors.append(f"{name} must be true or false, not {value!r}.")
+        return default
+
+    def directory(self, name: str) -> str:
+        value = self.required(name)
+        if value and not os.path.isdir(value):
+            self.errors.append(f"{name}: directory {value} does not exist.")
+        return value
+
+    def file(self, name: str, required: bool = True) -> Optional[str]:
+        value = self.required(name) if required else self.optional(name)
+        if value and not os.path.isfile(value):
+            self.errors.append(f"{name}: file {value} does not exist.")
+        return value
+
+
+def settings_from_environ(environ: Mapping[str, str]) -> Settings:
+    reader = _Reader(environ)
+    runmode = environ.get("PRE_RUNMODE", "")
+    settings = Settings(
+        def_model=reader.file("PRE_DEF_MODEL") or "",
+        runmode=runmode,
+        mockdata_file=reader.file(
+            "PRE_MOCKDATA_FILE", required=runmode == RUNMODE_MOCK
+        ),
+        log_dir=reader.directory("PRE_LOG_DIR"),
+        qa_log_dir=reader.directory("PRE_QA_LOG_DIR"),
+        db_uri=reader.required("PRE_DB_URI"),
+        log_level=reader.choice("PRE_LOG_LEVEL", LOG_LEVELS, "DEBUG"),
+        metrics_sample_rate=reader.get_float("PRE_METRICS_LOG_SAMPLE_RATE", 0.0),
+        db_pool_size=reader.get_int("PRE_DB_POOL_SIZE", 5),
+        db_max_overflow=reader.get_int("PRE_DB_MAX_OVERFLOW", 10),
+        db_pool_pre_ping=reader.get_bool("PRE_DB_POOL_PRE_PING", True),
+        db_pool_recycle=reader.get_int("PRE_DB_POOL_RECYCLE", 3600),
+        eval_write_mode=reader.choice("PRE_EVAL_WRITE_MODE", EVAL_WRITE_MODES),
+        eval_batch_size=reader.get_int("PRE_EVAL_BATCH_SIZE", 500),
+        eval_flush_interval=reader.get_float("PRE_EVAL_FLUSH_INTERVAL", 1.0),
+        eval_queue_size=reader.get_int("PRE_EVAL_QUEUE_SIZE", 100000),
+        eval_spool_file=reader.optional("PRE_EVAL_SPOOL_FILE"),
+        mock_stream_chunk_size=reader.get_int("PRE_MOCK_STREAM_CHUNK_SIZE", 16),
+        mock_stream_interval=reader.get_float("PRE_MOCK_STREAM_INTERVAL", 0.0),
+        mock_profile_file=reader.file("PRE_MOCK_PROFILE", required=False),
+        qa_log_format=reader.choice("PRE_QA_LOG_FORMAT", QA_LOG_FORMATS, "toml"),
+        qa_log_write_mode=reader.choice("PRE_QA_LOG_WRITE_MODE", QA_LOG_WRITE_MODES),
+        qa_log_queue_size=reader.get_int("PRE_QA_LOG_QUEUE_SIZE", 10000),
+        qa_log_segment_max_bytes=reader.get_int(
+            "PRE_QA_LOG_SEGMENT_MAXBYTES", 64 * 1024 * 1024
+        ),
+        qa_log_segment_seconds=reader.get_float("PRE_QA_LOG_SEGMENT_SECONDS", 3600.0),
+        qa_index_file=reader.optional("PRE_QA_INDEX_FILE"),
+        completion_cache_max_entries=reader.get_int(
+            "PRE_COMPLETION_CACHE_MAX_ENTRIES", 0
+        ),
+        completion_cache_ttl=reader.get_float("PRE_COMPLETION_CACHE_TTL", 3600.0),
+        completion_cache_file=reader.optional("PRE_COMPLETION_CACHE_FILE"),
+        completion_cache_max_bytes=reader.get_int(
+            "PRE_COMPLETION_CACHE_MAXBYTES", 256 * 1024 * 1024
+        ),
+        conversation_max_entries=reader.get_int("PRE_CONVERSATION_MAX_ENTRIES", 1000),
+        conversation_max_turns=reader.get_int("PRE_CONVERSATION_MAX_TURNS", 100),
+        conversation_max_tokens=reader.get_int("PRE_CONVERSATION_MAX_TOKENS", 4000),
+        conversation_ttl=reader.get_float("PRE_CONVERSATION_TTL", 86400.0),
+        conversation_file=reader.optional("PRE_CONVERSATION_FILE"),
+        workers=max(1, reader.get_int("WEB_CONCURRENCY", 1)),
+    )
+    if settings.workers > 1 and settings.conversation_file is None:
+        # each worker process would have its own conversations
+        reader.errors.append(
+            "PRE_CONVERSATION_FILE is not set: it is required when"
+            " WEB_CONCURRENCY is above 1."
+        )
+    if reader.errors:
+        raise SettingsError("Invalid settings: " + " ".join(reader.errors))
+    return settings
+
+
+_lock = threading.Lock()
+_settings: Optional[Settings] = None
+_reload_callbacks: Dict[str, Callable[[Settings], None]] = {}
+_reload_requested = threading.Event()
+_reload_on_error: Optional[Callable[[Exception], None]] = None
+
+
+def load_settings(override: bool = False) -> Settings:
+    global _settings
+    load_dotenv(override=override)
+    settings = settings_from_environ(os.environ)
+    with _lock:
+        _settings = settings
+    return settings
+
+
+def get_settings() -> Settings:
+    settings = _settings
+    if settings is None:
+        settings = load_settings()
+    return settings
+
+
+def on_reload(name: str, callback: Callable[[Settings], None]) -> None:
+    # one callback per name: a second create_app replaces, not adds
+    _reload_callbacks[name] = callback
+
+
+def reload_settings() -> Settings:
+    # .env wins over the values loaded at startup, so edits take effect
+    settings = load_settings(override=True)
+    for callback in list(_reload_callbacks.values()):
+        callback(settings)
+    return settings
+
+
+def _run_reloader() -> None:
+    while True:
+        _reload_requested.wait()
+        _reload_requested.clear()
+        try:
+            reload_settings()
+        except Exception as e:
+            if _reload_on_error is not None:
+                _reload_on_error(e)
+
+
+def _start_reloader() -> None:
+    threading.Thread(
+        target=_run_reloader, name="pre-settings-reload", daemon=True
+    ).start()
+
+
+def install_reload_signal(on_error: Callable[[Exception], None]) -> bool:
+    global _reload_on_error
+    if not hasattr(signal, "SIGHUP"):
+        return False
+
+    def handle_sighup(signum, frame) -> None:
+        # the handler interrupts whatever the main thread holds, so the
+        # reload itself runs on its own thread
+        _reload_requested.set()
+
+    try:
+        signal.signal(signal.SIGHUP, handle_sighup)
+    except ValueError:
+        # signal handlers can only be installed from the main thread
+        return False
+    if _reload_on_error is None:
+        _start_reloader()
+    _reload_on_error = on_error
+    return True
+
+
+def _reset_after_fork() -> None:
+    # the reload thread belongs to the parent
+    global _lock, _reload_requested
+    _lock = threading.Lock()
+    _reload_requested = threading.Event()
+    if _reload_on_error is not None:
+        _start_reloader()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -3,11 +3,27 @@ import sys
 from typing import NoReturn
 
 from dotenv import load_dotenv
+from sqlalchemy import Engine, inspect, text  # type: ignore[attr-defined]
 
-from pre_evaluation import Base
+from pre_evaluation import Base, Evaluation
 from pre_get_engine import get_engine
 
 
+def upgrade_evaluation_table(engine: Engine) -> None:
+    # create_all() leaves existing tables alone: add what older versions lack
+    columns = [c["name"] for c in inspect(engine).get_columns(Evaluation.__tablename__)]
+    if "model" not in columns:
+        with engine.begin() as connection:
+            connection.execute(
+                text(
+                    f"ALTER TABLE {Evaluation.__tablename__} "
+                    "ADD COLUMN model VARCHAR NOT NULL DEFAULT ''"
+                )
+            )
+    for index in Base.metadata.tables[Evaluation.__tablename__].indexes:
+        index.create(engine, checkfirst=True)
+
+
 def main() -> NoReturn:
     print("PRE: Connect database and Create table")
 
@@ -20,6 +36,7 @@ def main() -> NoReturn:
     # create table
     engine = get_engine(db_uri)
     Base.metadata.create_all(engine)
+    upgrade_evaluation_table(engine)
 
     # exit
     sys.exit(0)
@@ -0,0 +1,126 @@
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import inspect
+from sqlalchemy.exc import DBAPIError
+
+from pre_evaluation import Base
+from pre_get_session import get_pooled_engine
+from pre_settings import Settings
+
+MISSING_TABLE_MESSAGES = (
+    "no such table",  # sqlite
+    "does not exist",  # postgresql
+    "doesn't exist",  # mysql
+    "undefinedtable",  # psycopg
+    "invalid object name",  # sql server
+)
+MISSING_COLUMN_MESSAGES = (
+    "no such column",  # sqlite
+    "has no column named",  # sqlite
+    "unknown column",  # mysql
+    "undefinedcolumn",  # psycopg
+    "invalid column name",  # sql server
+)
+
+
+class TableNotFoundError(Exception):
+    pass
+
+
+class SchemaOutdatedError(Exception):
+    pass
+
+
+@dataclass
+class TableStatus:
+    name: str
+    ready: bool
+    checked_at: str
+    # columns of the model that the table lacks until pre_setup.py is run
+    missing_columns: List[str] = field(default_factory=list)
+
+
+def _missing_columns(inspector: Any, name: str) -> List[str]:
+    table = Base.metadata.tables.get(name)
+    if table is None:
+        return []
+    present = {column["name"] for column in inspector.get_columns(name)}
+    return [column.name for column in table.columns if column.name not in present]
+
+
+def outdated(table_name: str, columns: List[str]) -> SchemaOutdatedError:
+    # columns: the missing ones, if known
+    lacks = f"column {', '.join(columns)}" if columns else "columns of this version"
+    return SchemaOutdatedError(
+        f"Table {table_name} lacks {lacks}: run pre_setup.py to upgrade the database."
+    )
+
+
+_lock = threading.Lock()
+_status: Dict[Tuple[str, str], TableStatus] = {}
+
+
+def check_tables(settings: Settings, table_names: Iterable[str]) -> List[TableStatus]:
+    db_uri = settings.db_uri
+    engine = get_pooled_engine(settings)
+    inspector = inspect(engine)
+    checked_at = datetime.now().isoformat(timespec="seconds")
+    result = []
+    for name in table_names:
+        exists = inspector.has_table(name)
+        missing = _missing_columns(inspector, name) if exists else []
+        result.append(
+            TableStatus(
+                name=name,
+                ready=exists and not missing,
+                checked_at=checked_at,
+                missing_columns=missing,
+            )
+        )
+    with _lock:
+        for table_status in result:
+            _status[(db_uri, table_status.name)] = table_status
+    return result
+
+
+def is_table_ready(settings: Settings, table_name: str) -> bool:
+    table_status = _status.get((settings.db_uri, table_name))
+    if table_status is None or not table_status.ready:
+        table_status = check_tables(settings, [table_name])[0]
+    if table_status.missing_columns:
+        raise outdated(table_name, table_status.missing_columns)
+    return table_status.ready
+
+
+def invalidate(db_uri: Optional[str] = None, table_name: Optional[str] = None) -> None:
+    with _lock:
+        for key in list(_status):
+            if (db_uri is None or key[0] == db_uri) and (
+                table_name is None or key[1] == table_name
+            ):
+                del _status[key]
+
+
+def is_missing_column_error(e: Exception) -> bool:
+    if not isinstance(e, DBAPIError):
+        return False
+    message = str(e.orig).lower()
+    if message.startswith("column ") and "does not exist" in message:
+        # postgresql: column "model" of relation "evaluation" does not exist
+        return True
+    return any(text in message for text in MISSING_COLUMN_MESSAGES)
+
+
+def is_missing_table_error(e: Exception) -> bool:
+    if not isinstance(e, DBAPIError) or is_missing_column_error(e):
+        return False
+    message = str(e.orig).lower()
+    return any(text in message for text in MISSING_TABLE_MESSAGES)
+
+
+def get_status(db_uri: str) -> List[TableStatus]:
+    with _lock:
+        return [status for key, status in _status.items() if key[0] == db_uri]
@@ -0,0 +1,215 @@
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from pre_model import ModelDef
+
+try:
+    import tiktoken  # type: ignore[import-not-found]
+except ImportError:  # optional: token counts are estimated from the text instead
+    tiktoken = None  # type: ignore[assignment]
+
+DEFAULT_ENCODING = "cl100k_base"
+# each chat message is framed by a few tokens of its own, and a few more
+# prime the answer
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+
+class PromptTooLongError(Exception):
+    def __init__(self, message: str, prompt_tokens: int, limit: int):
+        super().__init__(message)
+        self.prompt_tokens = prompt_tokens
+        self.limit = limit
+
+
+class Tokenizer:
+    # without tiktoken, or without its encodings: an estimate on the high
+    # side, since it decides whether a prompt is rejected. Three characters
+    # per token for ASCII text (English averages about four) and two tokens
+    # per character of the other scripts, from the UTF-8 length
+    name = "estimate"
+
+    def count(self, text: str) -> int:
+        n = len(text)
+        if text.isascii():
+            return n // 3 + 1
+        multibyte = (len(text.encode("utf-8")) - n) // 2
+        return (n - multibyte) // 3 + 2 * multibyte + 1
+
+    def fit(self, text: str, max_tokens: int) -> Tuple[str, int]:
+        # text cut to at most max_tokens, and the token count of the whole text
+        tokens = self.count(text)
+        if tokens <= max_tokens:
+            return text, tokens
+        return text[: len(text) * max_tokens // tokens], tokens
+
+
+class TiktokenTokenizer(Tokenizer):
+    def __init__(self, encoding: Any):
+        self.encoding = encoding
+        self.name = encoding.name
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode_ordinary(text))
+
+    def fit(self, text: str, max_tokens: int) -> Tuple[str, int]:
+        # one encoding pass; only a cut text is decoded again
+        tokens = self.encoding.encode_ordinary(text)
+        if len(tokens) <= max_tokens:
+            return text, len(tokens)
+        return self.encoding.decode(tokens[:max_tokens]), len(tokens)
+
+
+_lock = threading.Lock()
+_tokenizers: Dict[Tuple[Optional[str], str], Tokenizer] = {}
+_estimate = Tokenizer()
+
+
+def _load_encoding(encoding_name: Optional[str], deployment_name: str) -> Any:
+    if encoding_name is not None:
+        return tiktoken.get_encoding(encoding_name)
+    try:
+        return tiktoken.encoding_for_model(deployment_name)
+    except KeyError:
+        # a deployment name that is not a model name (Azure)
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def _load(encoding_name: Optional[str], deployment_name: str) -> Tokenizer:
+    if tiktoken is None:
+        return _estimate
+    try:
+        return TiktokenTokenizer(_load_encoding(encoding_name, deployment_name))
+    except OSError:
+        # the encoding is downloaded on first use (cached in TIKTOKEN_CACHE_DIR);
+        # without network access it cannot be loaded, but requests go on
+        return _estimate
+
+
+def get_tokenizer(model_def: ModelDef) -> Tokenizer:
+    # loading an encoding reads its ranks, so each one is loaded once
+    key = (model_def.encoding, model_def.deployment_name)
+    tokenizer = _tokenizers.get(key)
+    if tokenizer is not None:
+        return tokenizer
+    with _lock:
+        tokenizer = _tokenizers.get(key)
+        if tokenizer is None:
+            tokenizer = _load(model_def.encoding, model_def.deployment_name)
+            _tokenizers[key] = tokenizer
+        return tokenizer
+
+
+def estimated_limits(models: Sequence[ModelDef]) -> List[str]:
+    # models whose context_window is checked against an estimate; loads their
+    # encodings, so a preloading server has them before forking the workers
+    return [
+        m.name
+        for m in models
+        if m.context_window is not None
+        and not isinstance(get_tokenizer(m), TiktokenTokenizer)
+    ]
+
+
+def prompt_limit(model_def: ModelDef) -> Optional[int]:
+    if model_def.context_window is None:
+        return None
+    return model_def.context_window - model_def.completion_reserve
+
+
+@dataclass
+class Preflight:
+    user_content: str
+    user_tokens: int
+    prompt_tokens: int
+    truncated: bool
+    # leading history messages left out to stay within the budget
+    dropped: int = 0
+
+
+def keep_history(
+    history_tokens: Sequence[int], budget: Optional[int]
+) -> Tuple[int, int]:
+    # the newest exchanges (a user message and its answer) that fit in
+    # budget: the number of messages left out, and the tokens of the rest
+    if budget is None:
+        return 0, sum(history_tokens) + len(history_tokens) * TOKENS_PER_MESSAGE
+    start = len(history_tokens)
+    used = 0
+    while start >= 2:
+        pair = history_tokens[start - 2] + history_tokens[start - 1]
+        pair += 2 * TOKENS_PER_MESSAGE
+        if used + pair > budget:
+            break
+        used += pair
+        start -= 2
+    return start, used
+
+
+def preflight(
+    name: str,
+    model_defs: List[ModelDef],
+    system_content: str,
+    user_content: str,
+    history_tokens: Sequence[int] = (),
+    history_budget: Optional[int] = None,
+) -> Preflight:
+    # model_defs are the selected model or the members of a model group: the
+    # smallest window applies, and the prompt is cut only if all of them allow
+    # it. The new user message comes first; earlier messages (history_tokens,
+    # counted when they were added) fill what is left of the window.
+    tokenizer = get_tokenizer(model_defs[0])
+    fixed = tokenizer.count(system_content) + 2 * TOKENS_PER_MESSAGE + TOKENS_PER_REPLY
+    limits = [limit for limit in map(prompt_limit, model_defs) if limit is not None]
+    limit = min(limits) if limits else None
+    fitted = user_content
+    truncated = False
+    if limit is None:
+        user_tokens = tokenizer.count(user_content)
+    else:
+        room = max(0, limit - fixed)
+        fitted, user_tokens = tokenizer.fit(user_content, room)
+        if fixed + user_tokens > limit:
+            if room == 0 or any(d.prompt_overflow != "truncate" for d in model_defs):
+                raise PromptTooLongError(
+                    f"The prompt has about {fixed + user_tokens} tokens,"
+                    f" more than the {limit} allowed for {name}.",
+                    fixed + user_tokens,
+                    limit,
+                )
+            user_tokens = room
+            truncated = True
+        left = limit - fixed - user_tokens
+        history_budget = left if history_budget is None else min(history_budget, left)
+    dropped, used = keep_history(history_tokens, history_budget)
+    return Preflight(
+        user_content=fitted,
+        user_tokens=user_tokens,
+        prompt_tokens=fixed + user_tokens + used,
+        truncated=truncated,
+        dropped=dropped,
+    )
+
+
+def estimate_cost(
+    model_def: ModelDef, prompt_tokens: int, completion_tokens: int
+) -> Optional[float]:
+    # prices are per million tokens
+    if model_def.prompt_price is None and model_def.completion_price is None:
+        return None
+    return (
+        prompt_tokens * (model_def.prompt_price or 0.0)
+        + completion_tokens * (model_def.completion_price or 0.0)
+    ) / 1_000_000
+
+
+def _reset_after_fork() -> None:
+    # the loaded encodings are kept: preloading shares them with the workers
+    global _lock
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -41,6 +41,7 @@ interface RequestData {
   prompt_tokens: number;
   rating: number;
   comment: string;
+  model: string;
 }
 interface ResponseData {
   result: string;
@@ -59,6 +60,7 @@ interface AnswerProps {
   content: string;
   promptClass: string;
   temperature: number;
+  selectedModel: string;
   setQaId: (qaId: string) => void;
   setUserContent: (newValue: string) => void;
   setPromptClass: (promptClass: string) => void;
@@ -78,6 +80,7 @@ const Answer: React.FC<AnswerProps> = ({
   content,
   promptClass,
   temperature,
+  selectedModel,
   setQaId,
   setUserContent,
   setPromptClass,
@@ -123,6 +126,7 @@ const Answer: React.FC<AnswerProps> = ({
       prompt_tokens: promptTokens,
       rating: rating,
       comment: comment,
+      model: selectedModel,
     };
     const url = process.env.NEXT_PUBLIC_API_SERVER_URL + ANSWER_ENDPOINT;
     try {
@@ -56,8 +56,13 @@ interface ModelData {
   api_version: string | null;
   azure_endpoint: string | null;
 }
+interface ModelGroupData {
+  name: string;
+  members: string[];
+}
 interface ModelListResponseData {
   models: ModelData[];
+  model_groups?: ModelGroupData[];
 }
 interface ResponseErrorData {
   error: string;
@@ -107,6 +112,7 @@ const Question: React.FC<QuestionProps> = ({
   const [getModellistLoading, setGetModellistLoading] =
     useState<boolean>(false);
   const [models, setModels] = useState<ModelData[]>([]);
+  const [modelGroups, setModelGroups] = useState<ModelGroupData[]>([]);
   const inputPromptClassHandler = (e: ChangeEvent<HTMLInputElement>) => {
     const inputValue: string = e.target.value;
     console.log(inputValue);
@@ -185,6 +191,7 @@ const Question: React.FC<QuestionProps> = ({
       console.log(response.data);
       if ("models" in response.data) {
         setModels(response.data.models);
+        setModelGroups(response.data.model_groups ?? []);
         setSelectedModel(response.data.models[0].name);
       } else {
         setGetModellistError("Invalid response data");
@@ -231,6 +238,11 @@ const Question: React.FC<QuestionProps> = ({
                     {model.name}
                   </MenuItem>
                 ))}
+                {modelGroups.map((group) => (
+                  <MenuItem key={group.name} value={group.name}>
+                    {group.name}
+                  </MenuItem>
+                ))}
               </TextField>
             </Box>
           </Grid>
@@ -79,6 +79,7 @@ const App = () => {
               content={content}
               promptClass={promptClass}
               temperature={temperature}
+              selectedModel={selectedModel}
               setQaId={setQaId}
               setUserContent={setUserContent}
               setPromptClass={setPromptClass}